@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+"""
+Benchmark the code that runs on every tick of a Relay control loop.
+
+Each benchmark is run for a range of sizes (ie --lookback values).  For
+each size, we report percentiles of the time per tick and the memory
+allocated per tick.  Results are written as json so that they can be
+compared against a previous run:
+
+    python bin/benchmark.py --output baseline.json
+    # ... change some code ...
+    python bin/benchmark.py --baseline baseline.json
+
+When a baseline is given, any benchmark whose median time per tick grew by
+more than --threshold is reported as a regression, and the script exits
+with a non-zero return code.
+"""
+from __future__ import division, print_function
+
+import argparse
+import io
+import json
+import logging
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from relay import log, configure_logging, add_zmq_log_handler
+from relay import controllers
+from relay import stop_conditions
+from relay.archive import ArchiveWriter
+from relay import tuning
+from relay.history import ErrorHistory
+from relay.loop import ControlLoop, ramp_schedule
+from relay.plugins import cache
+from relay.profiling import NullTickTimer, TickTimer
+from relay.runner import PHASES
+from relay.scheduling import AdaptiveDelay
+
+SIZES = [10, 100, 1000, 10000, 100000, 1000000]
+
+
+def _filled_history(n):
+    h = ErrorHistory(n)
+    h.extend(np.random.randn(n))
+    return h
+
+
+def bench_calc_weight(n):
+    errdata = np.random.randn(n)
+    return lambda: tuning.calc_weight(errdata)
+
+
+def bench_sliding_dft(n):
+    h = _filled_history(n)
+    engine = tuning.SlidingDFTEngine(n)
+    engine.weight(h.view())
+    xs = iter(np.random.randn(10 ** 6))
+
+    def tick():
+        x = next(xs)
+        engine.push(x, h.append(x))
+        engine.weight(h.view())
+    return tick
+
+
+def bench_calc_weight_batch(n):
+    errmatrix = np.random.randn(100, n)
+    return lambda: tuning.calc_weight_batch(errmatrix)
+
+
+def bench_history(n):
+    h = _filled_history(n)
+    xs = iter(np.random.randn(10 ** 6))
+
+    def tick():
+        h.append(next(xs))
+        h.view()
+        h.mean
+    return tick
+
+
+def bench_control_loop(n, controller=None):
+    loop = ControlLoop(n, controller=controller)
+    xs = iter(np.random.randn(10 ** 6))
+    for _ in range(min(n, 1000)):
+        loop.update(0, next(xs))
+    return lambda: loop.update(0, next(xs))
+
+
+def bench_ramp_schedule(n):
+    return lambda: ramp_schedule(100, n, 'scurve')
+
+
+def _null_stream_logger():
+    logger = logging.getLogger('relay.benchmark')
+    configure_logging(True, log=logger)
+    for h in logger.handlers:
+        h.stream = io.StringIO()
+    return logger
+
+
+def bench_json_formatter(n):
+    logger = _null_stream_logger()
+    stream = logger.handlers[0].stream
+
+    def tick():
+        logger.info('data', extra=dict(data=[1., 2., 3.], PV=1, SP=2))
+        stream.seek(0)
+        stream.truncate()
+    return tick
+
+
+def bench_zmq_handler(n):
+    handlers = log.handlers[:]
+    add_zmq_log_handler('ipc:///tmp/relay-benchmark')
+    zmq_handler = log.handlers[-1]
+    log.handlers = [zmq_handler]
+
+    def tick():
+        log.info('data', extra=dict(data=[1., 2., 3.], PV=1, SP=2))
+    tick.cleanup = lambda: setattr(log, 'handlers', handlers)
+    return tick
+
+
+def bench_tick_timer(n, timer=None):
+    """The overhead --profile_ticks adds to each tick.  `n` is the window"""
+    timer = timer or TickTimer(PHASES, budget=1, window=n, interval=1e9)
+
+    def tick():
+        timer.start()
+        for phase in PHASES:
+            timer.mark(phase)
+        timer.end()
+    return tick
+
+
+def bench_archive(n):
+    """Append a record to an archive with segments of `n` records"""
+    path = tempfile.mkdtemp()
+    writer = ArchiveWriter(path, capacity=n)
+    ts = iter(range(10 ** 7))
+
+    def tick():
+        writer.append(next(ts), 1., 2., -1., 1, .5, .1)
+
+    def cleanup():
+        writer.close()
+        shutil.rmtree(path)
+    tick.cleanup = cleanup
+    return tick
+
+
+def bench_stop_condition(n, cls=stop_conditions.DivergenceRatio):
+    """Append an error to a history of `n` and check the stop condition"""
+    h = _filled_history(n)
+    loop = argparse.Namespace(errors=h)
+    monitor = stop_conditions.build(cls, loop, n)
+    errs = iter(np.random.randn(10 ** 7).tolist())
+
+    def tick():
+        h.append(next(errs))
+        monitor.check()
+    return tick
+
+
+def bench_adaptive_delay(n):
+    """Choose the next delay given an error history of `n`"""
+    errs = np.random.randn(n)
+    sp = np.fft.fft(errs)[1: n // 2]
+    scheduler = AdaptiveDelay(1., .1, 10., 1.)
+
+    def tick():
+        scheduler.target(errs, sp, n)
+    return tick
+
+
+def bench_metric_cache(n, scope='process'):
+    """Poll a cached metric whose value is still fresh"""
+    directory = tempfile.mkdtemp()
+
+    def metric():
+        while True:
+            yield 1.
+
+    metric.__qualname__ = 'bench_metric_cache_%s_%s' % (scope, n)
+    it = cache.cached(metric, 1e9, scope, directory)()
+
+    def tick():
+        next(it)
+
+    def cleanup():
+        shutil.rmtree(directory)
+    tick.cleanup = cleanup
+    return tick
+
+
+def _legacy_stop_if_mostly_diverging(errdata):
+    n_increases = sum([
+        abs(y) - abs(x) > 0 for x, y in zip(errdata, errdata[1:])])
+    return 0 if len(errdata) * 0.5 < n_increases else -1
+
+
+# name: (setup function, max size it makes sense to run)
+BENCHMARKS = {
+    'calc_weight': (bench_calc_weight, 10 ** 4),
+    'sliding_dft': (bench_sliding_dft, 10 ** 6),
+    'calc_weight_batch_x100': (bench_calc_weight_batch, 10 ** 4),
+    'error_history': (bench_history, 10 ** 6),
+    'control_loop': (bench_control_loop, 10 ** 6),
+    'control_loop_pid': (
+        lambda n: bench_control_loop(n, controllers.PIDController()), 10 ** 6),
+    'control_loop_mpc': (
+        lambda n: bench_control_loop(n, controllers.MPCController()), 10 ** 5),
+    'ramp_schedule': (bench_ramp_schedule, 10 ** 6),
+    'json_formatter': (bench_json_formatter, 10),
+    'zmq_log_handler': (bench_zmq_handler, 10),
+    'tick_timer': (bench_tick_timer, 10 ** 4),
+    'archive_append': (bench_archive, 10 ** 6),
+    'stop_condition': (bench_stop_condition, 10 ** 6),
+    'stop_condition_oscillation': (
+        lambda n: bench_stop_condition(n, stop_conditions.Oscillation),
+        10 ** 6),
+    'stop_condition_legacy': (
+        lambda n: bench_stop_condition(n, _legacy_stop_if_mostly_diverging),
+        10 ** 4),
+    'adaptive_delay': (bench_adaptive_delay, 10 ** 6),
+    'metric_cache_hit': (bench_metric_cache, 10),
+    'tick_timer_off': (
+        lambda n: bench_tick_timer(n, NullTickTimer()), 10),
+}
+
+
+def measure(tick, seconds, min_iterations=10, max_iterations=10000,
+            alloc_iterations=10):
+    """Return timing percentiles (in seconds) and allocations (in bytes)
+    per call of `tick`"""
+    tick()  # warm up
+    times = []
+    deadline = time.time() + seconds
+    while len(times) < max_iterations and (
+            len(times) < min_iterations or time.time() < deadline):
+        start = time.perf_counter()
+        tick()
+        times.append(time.perf_counter() - start)
+    times = np.array(times)
+
+    tracemalloc.start()
+    peaks = []
+    before = tracemalloc.get_traced_memory()[0]
+    for _ in range(alloc_iterations):
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        tick()
+        peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    net = (tracemalloc.get_traced_memory()[0] - before) / alloc_iterations
+    tracemalloc.stop()
+
+    return dict(
+        iterations=len(times),
+        mean=float(times.mean()),
+        p50=float(np.percentile(times, 50)),
+        p90=float(np.percentile(times, 90)),
+        p99=float(np.percentile(times, 99)),
+        max=float(times.max()),
+        alloc_peak_bytes=int(np.median(peaks)),
+        alloc_net_bytes=float(net),
+    )
+
+
+def run(names, sizes, seconds):
+    results = []
+    for name in names:
+        setup, max_size = BENCHMARKS[name]
+        _sizes = [n for n in sizes if n <= max_size] or [min(sizes)]
+        if max_size <= min(sizes):
+            _sizes = [max_size]
+        for n in _sizes:
+            try:
+                tick = setup(n)
+            except ImportError as err:
+                print('skipping %s: %s' % (name, err), file=sys.stderr)
+                break
+            result = dict(name=name, size=n)
+            result.update(measure(tick, seconds))
+            getattr(tick, 'cleanup', lambda: None)()
+            print('%-24s size=%-8s p50=%.3gs p99=%.3gs alloc_peak=%sB' % (
+                name, n, result['p50'], result['p99'],
+                result['alloc_peak_bytes']), file=sys.stderr)
+            results.append(result)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Return the results whose median time grew by more than `threshold`
+    (a fraction) relative to the baseline"""
+    old = dict(((r['name'], r['size']), r) for r in baseline['results'])
+    regressions = []
+    for r in results:
+        b = old.get((r['name'], r['size']))
+        if b and r['p50'] > b['p50'] * (1 + threshold):
+            regressions.append(dict(
+                name=r['name'], size=r['size'], baseline_p50=b['p50'],
+                p50=r['p50'], ratio=r['p50'] / b['p50']))
+    return regressions
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--only', nargs='+', choices=sorted(BENCHMARKS),
+        default=sorted(BENCHMARKS), help='Run only these benchmarks')
+    parser.add_argument(
+        '--sizes', type=lambda x: [int(v) for v in x.split(',')],
+        default=SIZES, help='Comma separated list of sizes to run')
+    parser.add_argument(
+        '--seconds', type=float, default=.5,
+        help='Approximate time spent timing each benchmark and size')
+    parser.add_argument('--output', help='Write the json results here')
+    parser.add_argument(
+        '--baseline', help='Compare the results to this json file')
+    parser.add_argument(
+        '--threshold', type=float, default=.2,
+        help='Report a regression if the median time grew by this fraction')
+    return parser
+
+
+def main(ns):
+    log.setLevel(logging.ERROR)
+    results = dict(
+        meta=dict(
+            python=platform.python_version(), numpy=np.__version__,
+            platform=platform.platform(), timestamp=time.time()),
+        results=run(ns.only, ns.sizes, ns.seconds))
+    if ns.output:
+        with open(ns.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if ns.baseline:
+        with open(ns.baseline) as fp:
+            regressions = compare(
+                results['results'], json.load(fp), ns.threshold)
+        for r in regressions:
+            print('REGRESSION %(name)s size=%(size)s: median %(p50).3gs vs'
+                  ' %(baseline_p50).3gs (x%(ratio).2f)' % r, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(build_arg_parser().parse_args())
@@ -1,44 +1,60 @@
-import json
-import zmq
-import pandas as pd
-import pylab
+#!/usr/bin/env python
+"""
+Load a time range of a Relay archive (see `relay --archive`) into a pandas
+DataFrame, plot it, and drop into an IPython shell to look around:
 
+    python bin/debugger.py /var/lib/relay --loop queue1 --since 3600
 
-def getstream(address):
-    c = zmq.Context()
-    s = c.socket(zmq.SUB)
-    s.setsockopt(zmq.SUBSCRIBE, '')
-    s.connect(address)
-    while True:
-        yield s.recv()
+In the shell, `df` is the DataFrame and `archive` is the
+relay.archive.Archive, for more queries.
+"""
+from __future__ import division, print_function
 
+import argparse
+import time
 
-def populate(df, n, stream):
-    m = df.shape[0]
-    while True:
-        next(stream)
-        j = next(stream)
+import pylab
 
-        d = json.loads(j).get('data')
-        if d:
-            df.loc[df.shape[0]] = d
+from relay.archive import Archive
 
-        if df.shape[0] >= n + m:
-            break
+COLUMNS = ['PV', 'SP', 'MV', 'err', 'weight']
 
 
 def plot_df(df):
-    for i in range(df.shape[1]):
-        pylab.subplot(df.shape[1], 1, i + 1)
-        pylab.plot(df[i])
+    for i, k in enumerate(COLUMNS):
+        pylab.subplot(len(COLUMNS), 1, i + 1)
+        pylab.plot(df['ts'], df[k])
+        pylab.ylabel(k)
     pylab.show(block=False)
 
 
-address = 'ipc:///tmp/relaylog'
-df = pd.DataFrame(columns=[0, 1, 2])
-populate(df, 500, getstream(address))
-plot_df(df)
-
-
-import IPython
-IPython.embed()
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('archive', help="the --archive directory of Relay")
+    parser.add_argument(
+        '--loop', help="the name of a loop, if it ran in a fleet")
+    parser.add_argument(
+        '--since', type=float, default=3600,
+        help="load the records of the last n seconds")
+    parser.add_argument(
+        '--start', type=float, help="load records from this unix time")
+    parser.add_argument(
+        '--end', type=float, help="load records up to this unix time")
+    return parser
+
+
+def main(ns):
+    archive = Archive(ns.archive)
+    start = ns.start if ns.start is not None else time.time() - ns.since
+    df = archive.dataframe(ns.loop, start, ns.end)
+    print("loaded %s records of loop %s.  Loops in the archive: %s" % (
+        len(df), ns.loop or 'relay', ', '.join(archive.loops())))
+    if len(df):
+        plot_df(df)
+
+    import IPython
+    IPython.embed()
+
+
+if __name__ == '__main__':
+    main(build_arg_parser().parse_args())
@@ -1,8 +1,26 @@
 import logging
+import sys
 log = logging.getLogger('relay.runner')
 
 # expose configure_logging to those who wish to develop relay
 from relay.relay_logging import configure_logging, add_zmq_log_handler
 
-import pkg_resources as _pkg_resources
-__version__ = _pkg_resources.get_distribution('relay.runner').version
+
+def _get_version():
+    try:
+        from importlib.metadata import version
+    except ImportError:  # python < 3.8
+        import pkg_resources
+        return pkg_resources.get_distribution('relay.runner').version
+    return version('relay.runner')
+
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        # look the version up only when it's asked for.  It's slow
+        if name == '__version__':
+            return _get_version()
+        raise AttributeError(
+            "module %r has no attribute %r" % (__name__, name))
+else:
+    __version__ = _get_version()
@@ -1,11 +1,31 @@
 """
 Convert a directory into an executable
 """
-from relay.runner import main, build_arg_parser
+import importlib
+import sys
+
+from relay import parsers
+from relay.util import STARTUP
+
+# `relay <subcommand> ...` runs the main() of one of these modules.  It's
+# imported once the command-line is parsed, since it imports numpy & co
+SUBCOMMANDS = {
+    'fleet': (parsers.build_fleet_arg_parser, 'relay.fleet'),
+    'simulate': (parsers.build_simulate_arg_parser, 'relay.simulate'),
+}
 
 
 def go():
-    NS = build_arg_parser().parse_args()
+    STARTUP.mark('import')
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        build_arg_parser, module = SUBCOMMANDS[sys.argv[1]]
+        NS = build_arg_parser().parse_args(sys.argv[2:])
+        importlib.import_module(module).main(NS)
+        return
+    NS = parsers.build_relay_arg_parser().parse_args()
+    STARTUP.mark('parse_args')
+    from relay.runner import main
+    STARTUP.mark('import_runner')
     main(NS)
 
 if __name__ == '__main__':
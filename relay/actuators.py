@@ -0,0 +1,239 @@
+"""
+Decide when and how much to actuate, and call warmers and coolers from a
+bounded pool of worker threads.
+
+ActuationShaper sits between the controller and the actuators.  It sums
+MVs over a time window, spaces out calls to each actuator, caps the size
+of each call and ignores MVs that are too small to be worth applying.
+
+Each actuator (ie the warmer, or the cooler) gets its own ActuatorExecutor
+with at most `max_inflight` calls running at any given time.  When all
+workers are busy, new MVs are handled according to a backpressure policy:
+
+    merge - (default) add the MV to the pending MV.  The next free worker
+            applies the whole pending MV in one call.
+    drop - discard the MV
+    block - wait until a worker is free.  This slows down the control loop
+"""
+from __future__ import division
+
+import threading
+
+from relay import log
+from relay import util
+from relay.constants import BACKPRESSURE_POLICIES as POLICIES
+
+
+class ActuationShaper(object):
+    """
+    Accumulate MVs and release them to the actuators in fewer, larger calls.
+
+    `window` seconds to sum MVs over before releasing them
+    `min_interval` min seconds between two calls to the same actuator
+    `max_step` (optional) max absolute MV of a single call.  The remainder
+        stays pending and is released later
+    `deadband` when the accumulated MV is released, discard it if its
+        absolute value is smaller than this
+    `clock` a monotonic clock
+
+    With the default arguments, every MV is released immediately.
+
+    The MV that has been accumulated but not released is available as
+    `pending`, so the controller can account for it.
+    """
+    def __init__(self, window=0, min_interval=0, max_step=None, deadband=0,
+                 clock=util.monotonic):
+        self.window = window
+        self.min_interval = min_interval
+        self.max_step = max_step
+        self.deadband = deadband
+        self.clock = clock
+        self.pending = 0
+        self._window_start = None
+        self._last_call = {1: None, -1: None}  # keyed by the sign of MV
+        self._ncalls = 0
+        self._nskipped = 0
+
+    def add(self, MV):
+        if MV and self._window_start is None:
+            self._window_start = self.clock()
+        self.pending += MV
+
+    def release(self):
+        """Return the MV to apply now.  It is removed from `pending`"""
+        if not self.pending:
+            self._window_start = None
+            return 0
+        now = self.clock()
+        if now - self._window_start < self.window:
+            return 0
+        if abs(self.pending) < self.deadband:
+            self._nskipped += 1
+            self.pending = 0
+            self._window_start = None
+            return 0
+        sign = 1 if self.pending > 0 else -1
+        last = self._last_call[sign]
+        if last is not None and now - last < self.min_interval:
+            return 0
+        MV = self.pending
+        if self.max_step is not None and abs(MV) > self.max_step:
+            MV = sign * self.max_step
+        self.pending -= MV
+        if not self.pending:
+            self._window_start = None
+        self._last_call[sign] = now
+        self._ncalls += 1
+        return MV
+
+    def stats(self):
+        return dict(
+            shaper_pending=self.pending, shaper_calls=self._ncalls,
+            shaper_deadband_skips=self._nskipped)
+
+
+class ActuatorExecutor(object):
+    """
+    Apply MVs with `func`, in at most `max_inflight` concurrent calls
+
+    `func` a warmer or cooler function.  It receives the MV
+    `name` identifies the actuator in log messages
+    `max_inflight` max number of calls to `func` running at the same time
+    `policy` what to do with an MV when `max_inflight` calls are running.
+        One of POLICIES
+    """
+    def __init__(self, func, name, max_inflight=4, policy='merge'):
+        if policy not in POLICIES:
+            raise ValueError("Unrecognized backpressure policy: %s" % policy)
+        if max_inflight < 1:
+            raise ValueError("max_inflight must be at least 1")
+        self.func = func
+        self.name = name
+        self.max_inflight = max_inflight
+        self.policy = policy
+        self._cond = threading.Condition()
+        self._pending = 0  # MV submitted but not yet picked up by a worker
+        self._inflight = 0
+        self._inflight_MV = 0  # MV passed to `func` that it hasn't applied
+        self._ndropped = 0
+        self._ncoalesced = 0
+        self._closed = False
+        self._workers = []
+        for i in range(max_inflight):
+            t = threading.Thread(
+                target=self._work, name='relay-%s-%s' % (name, i))
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+    def _idle(self):
+        return self._inflight < self.max_inflight and not self._pending
+
+    def submit(self, MV):
+        """Schedule a call to func(MV).  Return False if MV was dropped"""
+        with self._cond:
+            if not self._idle():
+                if self.policy == 'drop':
+                    self._ndropped += 1
+                    log.debug(
+                        'dropped MV because actuator is busy',
+                        extra=dict(actuator=self.name, MV=MV))
+                    return False
+                elif self.policy == 'block':
+                    while not self._idle():
+                        self._cond.wait()
+            if self._pending:
+                self._ncoalesced += 1
+            self._pending += MV
+            self._cond.notify_all()
+        return True
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                MV, self._pending = self._pending, 0
+                self._inflight += 1
+                self._inflight_MV += MV
+            try:
+                self.func(MV)
+            except Exception as err:
+                log.exception('actuator failed', extra=dict(
+                    actuator=self.name, MV=MV, error=err))
+            finally:
+                with self._cond:
+                    self._inflight -= 1
+                    self._inflight_MV -= MV
+                    self._cond.notify_all()
+
+    @property
+    def pending(self):
+        """MV that was submitted but not applied yet, including the MV that
+        `func` is applying now"""
+        with self._cond:
+            return self._pending + self._inflight_MV
+
+    def stats(self):
+        with self._cond:
+            return {
+                '%s_inflight' % self.name: self._inflight,
+                '%s_inflight_MV' % self.name: self._inflight_MV,
+                '%s_pending' % self.name: self._pending,
+                '%s_dropped' % self.name: self._ndropped,
+                '%s_coalesced' % self.name: self._ncoalesced,
+            }
+
+    def shutdown(self, wait=True):
+        """Stop the workers once they have applied all pending MV"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if wait:
+            for t in self._workers:
+                t.join()
+
+
+class Actuator(object):
+    """Send positive MVs to the warmer and negative MVs to the cooler"""
+    def __init__(self, warmer, cooler, max_inflight=4, policy='merge'):
+        self.executors = {}
+        if warmer:
+            self.executors['warmer'] = ActuatorExecutor(
+                warmer, 'warmer', max_inflight, policy)
+        if cooler:
+            self.executors['cooler'] = ActuatorExecutor(
+                cooler, 'cooler', max_inflight, policy)
+
+    def stats(self):
+        rv = {}
+        for executor in self.executors.values():
+            rv.update(executor.stats())
+        return rv
+
+    @property
+    def pending(self):
+        """MV that was submitted to the actuators but not yet applied,
+        including the MV of the calls that are running"""
+        return sum(e.pending for e in self.executors.values())
+
+    def __call__(self, MV, **extra):
+        if MV > 0:
+            name, msg, else_msg = 'warmer', 'adding heat', 'too cold'
+        elif MV < 0:
+            name, msg, else_msg = 'cooler', 'removing heat', 'too hot'
+        else:
+            log.debug('stabilized PV at setpoint', extra=dict(
+                MV=MV, **dict(extra, **self.stats())))
+            return
+        if name not in self.executors:
+            log.warn(else_msg, extra=extra)
+            return
+        self.executors[name].submit(MV)
+        log.debug(msg, extra=dict(MV=MV, **dict(extra, **self.stats())))
+
+    def shutdown(self, wait=True):
+        for executor in self.executors.values():
+            executor.shutdown(wait)
@@ -0,0 +1,287 @@
+"""
+An asyncio-native Relay control loop.  Enable it with `relay --asyncio`.
+
+Plugins may be written for asyncio:
+
+    metric, target - async generator functions
+    warmer, cooler, stop_condition - coroutine functions
+
+Regular (sync) plugins work too.  They are wrapped automatically and run in
+a thread pool so they don't block the event loop.
+
+On every tick, the metric and target are polled concurrently.  Ticks are
+scheduled against a monotonic deadline, so the time spent polling doesn't
+stretch the sample period as long as it takes less than `--delay` seconds.
+Warmers and coolers run in the background, in at most --max_inflight tasks
+each, and only delay the next tick if --backpressure is block.
+"""
+import asyncio
+import functools
+import time
+
+from relay import log, configure_logging
+from relay import actuators
+from relay import util
+from relay import stop_conditions
+from relay.actuators import POLICIES
+from relay.archive import ArchiveWriter
+from relay.checkpoint import Checkpointer
+from relay.coordination import Coordinator
+from relay.scheduling import AdaptiveDelay
+from relay import runner
+
+
+def as_async_iterator(plugin):
+    """Call a metric or target plugin and return an async iterator over its
+    values.  Sync generators are polled in a thread pool"""
+    it = plugin()
+    if hasattr(it, '__anext__'):
+        return it
+
+    def _next():
+        # StopIteration can't be raised through a Future
+        try:
+            return (next(it), )
+        except StopIteration:
+            return ()
+
+    async def _poll():
+        loop = asyncio.get_running_loop()
+        while True:
+            rv = await loop.run_in_executor(None, _next)
+            if not rv:
+                return
+            yield rv[0]
+    return _poll()
+
+
+def as_coroutine_function(plugin):
+    """Return a coroutine function that calls the given warmer, cooler or
+    stop_condition.  Sync functions are called in a thread pool"""
+    if plugin is None or util.is_async_plugin(plugin):
+        return plugin
+
+    @functools.wraps(plugin)
+    async def _call(*args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, plugin, *args)
+    return _call
+
+
+class ActuatorExecutor(object):
+    """
+    Apply MVs with the coroutine function `func`, in at most `max_inflight`
+    concurrent tasks.  The asyncio version of
+    relay.actuators.ActuatorExecutor, with the same backpressure policies.
+
+    `func` a warmer or cooler coroutine function.  It receives the MV
+    `name` identifies the actuator in log messages
+    `max_inflight` max number of calls to `func` running at the same time
+    `policy` what to do with an MV when `max_inflight` calls are running.
+        One of relay.actuators.POLICIES
+    """
+    def __init__(self, func, name, max_inflight=4, policy='merge'):
+        if policy not in POLICIES:
+            raise ValueError("Unrecognized backpressure policy: %s" % policy)
+        if max_inflight < 1:
+            raise ValueError("max_inflight must be at least 1")
+        self.func = func
+        self.name = name
+        self.max_inflight = max_inflight
+        self.policy = policy
+        self._cond = asyncio.Condition()
+        self._pending = 0  # MV submitted but not yet passed to `func`
+        self._inflight = 0
+        self._inflight_MV = 0  # MV passed to `func` that it hasn't applied
+        self._ndropped = 0
+        self._ncoalesced = 0
+        self._tasks = set()
+
+    def _idle(self):
+        return self._inflight < self.max_inflight and not self._pending
+
+    async def submit(self, MV):
+        """Schedule a call to func(MV).  Return False if MV was dropped"""
+        if not self._idle():
+            if self.policy == 'drop':
+                self._ndropped += 1
+                log.debug(
+                    'dropped MV because actuator is busy',
+                    extra=dict(actuator=self.name, MV=MV))
+                return False
+            elif self.policy == 'block':
+                async with self._cond:
+                    await self._cond.wait_for(self._idle)
+        if self._pending:
+            self._ncoalesced += 1
+        self._pending += MV
+        self._start()
+        return True
+
+    def _start(self):
+        """Pass the pending MV to `func` if fewer than `max_inflight` calls
+        are running"""
+        if self._pending and self._inflight < self.max_inflight:
+            MV, self._pending = self._pending, 0
+            self._inflight += 1
+            self._inflight_MV += MV
+            task = asyncio.ensure_future(self._apply(MV))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _apply(self, MV):
+        try:
+            await self.func(MV)
+        except Exception as err:
+            log.exception('actuator failed', extra=dict(
+                actuator=self.name, MV=MV, error=err))
+        finally:
+            self._inflight -= 1
+            self._inflight_MV -= MV
+            self._start()  # the MV merged while every call was running
+            async with self._cond:
+                self._cond.notify_all()
+
+    @property
+    def pending(self):
+        """MV that was submitted but not applied yet, including the MV that
+        `func` is applying now"""
+        return self._pending + self._inflight_MV
+
+    def stats(self):
+        return {
+            '%s_inflight' % self.name: self._inflight,
+            '%s_inflight_MV' % self.name: self._inflight_MV,
+            '%s_pending' % self.name: self._pending,
+            '%s_dropped' % self.name: self._ndropped,
+            '%s_coalesced' % self.name: self._ncoalesced,
+        }
+
+    async def shutdown(self):
+        """Wait until all pending MV is applied"""
+        while self._tasks:
+            await asyncio.gather(*self._tasks)
+
+
+class Actuator(actuators.Actuator):
+    """Send positive MVs to the warmer and negative MVs to the cooler,
+    without waiting for them (unless --backpressure is block)"""
+    def __init__(self, warmer, cooler, max_inflight=4, policy='merge'):
+        self.executors = {}
+        if warmer:
+            self.executors['warmer'] = ActuatorExecutor(
+                as_coroutine_function(warmer), 'warmer', max_inflight,
+                policy)
+        if cooler:
+            self.executors['cooler'] = ActuatorExecutor(
+                as_coroutine_function(cooler), 'cooler', max_inflight,
+                policy)
+
+    async def __call__(self, MV, **extra):
+        if MV > 0:
+            name, msg, else_msg = 'warmer', 'adding heat', 'too cold'
+        elif MV < 0:
+            name, msg, else_msg = 'cooler', 'removing heat', 'too hot'
+        else:
+            log.debug('stabilized PV at setpoint', extra=dict(
+                MV=MV, **dict(extra, **self.stats())))
+            return
+        if name not in self.executors:
+            log.warn(else_msg, extra=extra)
+            return
+        await self.executors[name].submit(MV)
+        log.debug(msg, extra=dict(MV=MV, **dict(extra, **self.stats())))
+
+    async def shutdown(self):
+        for executor in self.executors.values():
+            await executor.shutdown()
+
+
+async def run(ns):
+    metric = as_async_iterator(ns.metric)
+    target = as_async_iterator(ns.target)
+    # stop condition classes are cheap and called inline.  Functions of the
+    # error history may be slow, so sync ones run in the thread pool
+    streaming = stop_conditions.is_streaming(ns.stop_condition)
+    stop_condition = None if streaming \
+        else as_coroutine_function(ns.stop_condition)
+    actuate = Actuator(
+        ns.warmer, ns.cooler, ns.max_inflight, ns.backpressure)
+    loop = runner.build_loop(ns)
+    clock = asyncio.get_running_loop().time  # monotonic
+    shaper = runner.build_shaper(ns, clock)
+    telemetry = runner.build_telemetry(ns)
+    archive = ArchiveWriter.from_ns(ns)
+    checkpoint = Checkpointer.from_ns(ns, loop)
+    coordinator = Coordinator.from_ns(ns)
+    stop = stop_conditions.Monitor.from_ns(ns, loop) if streaming else None
+    scheduler = AdaptiveDelay.from_ns(ns)
+    util.STARTUP.mark('build')
+
+    try:
+        deadline = clock()
+        while True:
+            SP, PV = await asyncio.gather(
+                target.__anext__(), metric.__anext__())
+            shaper.add(loop.update(
+                SP, PV, shaper.pending + actuate.pending))
+            MV = runner.release(shaper, coordinator, loop.err)
+            await actuate(MV, err=loop.err, PV=PV, SP=SP,
+                          **runner.tick_stats(shaper, coordinator))
+            now = time.time()
+            if telemetry:
+                telemetry.publish_tick(now, loop, MV)
+            if archive:
+                archive.append_tick(now, loop, MV)
+            if checkpoint:
+                checkpoint.maybe_save()
+            if not util.STARTUP.done:
+                runner.report_startup(ns)
+
+            return_code = None
+            if stop:
+                return_code = stop.check()
+            elif stop_condition:
+                return_code = await stop_condition(loop.errors.view())
+                if return_code == -1:
+                    return_code = None
+            if return_code is not None:
+                log.info(
+                    'Stop condition triggered!  Relay is terminating.',
+                    extra=dict(return_code=return_code))
+                return return_code
+
+            deadline += scheduler.update(loop) if scheduler else ns.delay
+            now = clock()
+            if deadline < now:
+                log.warn('missed the tick deadline', extra=dict(
+                    seconds_late=now - deadline))
+                deadline = now
+            await asyncio.sleep(deadline - now)
+    finally:
+        await actuate.shutdown()
+        if telemetry:
+            telemetry.close()
+        if archive:
+            archive.close()
+        if checkpoint:
+            checkpoint.save()
+        if coordinator:
+            coordinator.close()
+
+
+def main(ns):
+    runner.validate_ns_or_sysexit(ns)
+    configure_logging(True)
+    runner.configure_sendstats(ns.sendstats)
+    runner.configure_log_pipeline(ns)
+    runner.configure_shell_plugins(ns)
+    runner.configure_metric_cache(ns)
+    runner.exit_on_sigterm()
+    log.info(
+        "Starting relay with asyncio!",
+        extra={k: str(v) for k, v in ns.__dict__.items()})
+    util.STARTUP.mark('configure')
+    return_code = asyncio.run(run(ns))
+    if return_code is not None:
+        raise SystemExit(return_code)
@@ -0,0 +1,235 @@
+"""
+An append-only archive of per-tick records, for post-mortems.  Enable it
+with `relay --archive <directory>`.
+
+Every tick, Relay appends one record with the fields in
+relay.telemetry.FIELDS (ts, PV, SP, err, MV, weight and mean) to the
+archive.  Values that aren't known yet are NaN.  Each loop (see `relay
+fleet`) has its own subdirectory, named after the loop, or 'relay'.
+
+A loop's records are split into segments.  A segment is a file with a fixed
+size header (HEADER) followed by one column of --archive_segment_size
+little endian doubles per field.  Segments are created at their full size
+as sparse files and named after the timestamp of their first record, so a
+directory listing is the index of segments by time, and records within a
+segment are found with a binary search of the `ts` column.  A record is
+written into a memory map and then counted in the header, so appending
+costs no system call, and readers never see a partial record.  Readers skip
+segments that aren't their full size, ie that were truncated when the disk
+filled up.
+
+To read an archive:
+
+    archive = Archive('/var/lib/relay')
+    data = archive.query('queue1', start=time.time() - 86400)
+    data['PV'], data['MV']  # numpy arrays
+    df = archive.dataframe('queue1', start=time.time() - 86400)  # pandas
+
+Records within one segment are returned as views of the memory map,
+without copying them.  See also bin/debugger.py.
+"""
+from __future__ import division
+
+import bisect
+import os
+import struct
+
+import numpy as np
+
+from relay import log
+from relay.telemetry import FIELDS
+
+MAGIC = b'RELAYARC'
+VERSION = 1
+# magic, version, capacity (records per segment), number of fields, and
+# the number of records written so far, which is updated in place
+HEADER = struct.Struct('<8sB7xqqq')
+COUNT_OFFSET = 32
+HEADER_SIZE = 64
+DEFAULT_LOOP = 'relay'
+
+
+class InvalidSegment(Exception):
+    pass
+
+
+def segment_name(ts):
+    """Segments sort by the time of their first record"""
+    return '%016d.seg' % int(ts * 1e6)
+
+
+class Segment(object):
+    """
+    One memory mapped segment file.
+
+    `path` of the segment
+    `mode` 'r' to read or 'r+' to append
+    """
+    def __init__(self, path, mode='r'):
+        self.path = path
+        mm = np.memmap(path, dtype=np.uint8, mode=mode)
+        try:
+            magic, version, capacity, nfields, _ = HEADER.unpack(
+                mm[:HEADER.size].tobytes())
+        except struct.error:
+            magic = version = capacity = nfields = None
+        if magic != MAGIC or version != VERSION or nfields != len(FIELDS) \
+                or len(mm) != HEADER_SIZE + 8 * nfields * capacity:
+            raise InvalidSegment("Unrecognized archive segment: %s" % path)
+        self.capacity = capacity
+        self._count = mm[COUNT_OFFSET:COUNT_OFFSET + 8].view('<i8')
+        self._n = self.count  # records appended by this process
+        self.data = mm[HEADER_SIZE:].view('<f8').reshape(nfields, capacity)
+        self._mm = mm
+
+    @classmethod
+    def create(cls, path, capacity):
+        with open(path, 'wb') as fp:
+            fp.write(HEADER.pack(
+                MAGIC, VERSION, capacity, len(FIELDS), 0).ljust(
+                    HEADER_SIZE, b'\0'))
+            fp.truncate(HEADER_SIZE + 8 * len(FIELDS) * capacity)
+        return cls(path, 'r+')
+
+    @property
+    def count(self):
+        """The number of complete records.  A corrupt count is clamped to
+        the segment's capacity"""
+        return min(max(int(self._count[0]), 0), self.capacity)
+
+    @property
+    def full(self):
+        return self._n >= self.capacity
+
+    def append(self, values):
+        self.data[:, self._n] = values
+        self._n += 1
+        self._count[0] = self._n  # publish the record once it's written
+
+    def slice(self, start=None, end=None):
+        """The records with start <= ts <= end, as a (field, record) view"""
+        n = self.count
+        ts = self.data[0, :n]
+        lo = 0 if start is None else np.searchsorted(ts, start, 'left')
+        hi = n if end is None else np.searchsorted(ts, end, 'right')
+        return self.data[:, lo:hi]
+
+    def flush(self):
+        self._mm.flush()
+
+
+class ArchiveWriter(object):
+    """
+    Append the records of one loop to an archive.
+
+    `path` the archive's directory
+    `loop` the loop's name
+    `capacity` records per segment
+    """
+    def __init__(self, path, loop=None, capacity=2 ** 20):
+        self.dir = os.path.join(path, loop or DEFAULT_LOOP)
+        self.capacity = capacity
+        if not os.path.isdir(self.dir):
+            os.makedirs(self.dir)
+        self._segment = None
+        # keep appending to the last segment, if it has room
+        names = sorted(n for n in os.listdir(self.dir) if n.endswith('.seg'))
+        if names:
+            try:
+                segment = Segment(os.path.join(self.dir, names[-1]), 'r+')
+            except (InvalidSegment, ValueError) as err:
+                log.warn('not appending to an unrecognized archive segment',
+                         extra=dict(error=err))
+            else:
+                if not segment.full:
+                    self._segment = segment
+
+    @classmethod
+    def from_ns(cls, ns, name=None):
+        """Return an ArchiveWriter or None, as requested on the
+        command-line"""
+        if getattr(ns, 'archive', None):
+            return cls(ns.archive, name, ns.archive_segment_size)
+
+    def append(self, ts, PV, SP, err, MV, weight=None, mean=None):
+        if self._segment is None or self._segment.full:
+            if self._segment is not None:
+                self._segment.flush()
+            self._segment = Segment.create(
+                os.path.join(self.dir, segment_name(ts)), self.capacity)
+        self._segment.append((
+            ts, PV, SP, err, MV,
+            np.nan if weight is None else weight,
+            np.nan if mean is None else mean))
+
+    def append_tick(self, ts, control_loop, MV):
+        """Append the state of a relay.loop.ControlLoop after a tick"""
+        if control_loop.err is None:
+            return
+        self.append(
+            ts, control_loop.PV, control_loop.SP, control_loop.err, MV,
+            control_loop.last_weight, control_loop.history.mean)
+
+    def close(self):
+        if self._segment is not None:
+            self._segment.flush()
+            self._segment = None
+
+
+class Archive(object):
+    """Query the records of an archive by time.  `path` its directory"""
+    def __init__(self, path):
+        self.path = path
+
+    def loops(self):
+        """The names of the loops that have records in the archive"""
+        return sorted(
+            n for n in os.listdir(self.path)
+            if os.path.isdir(os.path.join(self.path, n)))
+
+    def segments(self, loop=None):
+        """(time of the first record, path) of each segment, sorted"""
+        d = os.path.join(self.path, loop or DEFAULT_LOOP)
+        return sorted(
+            (int(n[:-4]) / 1e6, os.path.join(d, n))
+            for n in os.listdir(d) if n.endswith('.seg'))
+
+    def block(self, loop=None, start=None, end=None):
+        """The records of `loop` with start <= ts <= end, as a 2d array of
+        (field, record).  It's a view of the archive if all the records are
+        in one segment, and a copy otherwise"""
+        segments = self.segments(loop)
+        starts = [s for s, _ in segments]
+        first = 0 if start is None \
+            else max(bisect.bisect_right(starts, start) - 1, 0)
+        last = len(segments) if end is None \
+            else bisect.bisect_right(starts, end)
+        blocks = []
+        for _, path in segments[first:last]:
+            try:
+                segment = Segment(path)
+            except (InvalidSegment, ValueError) as err:
+                # ie a segment that was truncated while it was created
+                log.warn('skipping an unrecognized archive segment',
+                         extra=dict(error=err))
+                continue
+            block = segment.slice(start, end)
+            if block.shape[1]:
+                blocks.append(block)
+        if not blocks:
+            return np.empty((len(FIELDS), 0))
+        if len(blocks) == 1:
+            return blocks[0]
+        return np.concatenate(blocks, axis=1)
+
+    def query(self, loop=None, start=None, end=None):
+        """The records of `loop` with start <= ts <= end, as a dict of
+        field: numpy array"""
+        return dict(zip(FIELDS, self.block(loop, start, end)))
+
+    def dataframe(self, loop=None, start=None, end=None):
+        """The records of `loop` with start <= ts <= end, as a
+        pandas.DataFrame with a column per field"""
+        import pandas as pd
+        return pd.DataFrame(
+            self.block(loop, start, end).T, columns=FIELDS, copy=False)
@@ -8,6 +8,11 @@ from argparse_tools import (
     lazy_kwargs, build_arg_parser, group, add_argument_default_from_env_factory)
 
 from relay import util
+from relay.constants import (
+    BACKPRESSURE_POLICIES, CONTROLLERS, DEFAULT_CONTROLLER,
+    COORDINATION_MODES, RAMP_SHAPES, RESAMPLE_METHODS, TUNING_ENGINES,
+    DEFAULT_TUNING_ENGINE, METRIC_CACHE_SCOPES, DEFAULT_METRIC_CACHE_SCOPE,
+    SHELL_PREFIX, DEFAULT_SHELL_TIMEOUT)
 
 # expose argparse_tools code
 build_arg_parser
@@ -15,13 +20,33 @@ group
 add_argument = add_argument_default_from_env_factory(env_prefix='RELAY_')
 
 
+def csv_list(type):
+    """An argparse type for a comma separated list of values"""
+    def _csv_list(x):
+        return [type(v) for v in str(x).split(',')]
+    return _csv_list
+
+
+def plugintype(kind):
+    """An argparse type that loads a `kind` of plugin (metric, target,
+    warmer or cooler) from a python import path or from a 'shell:<command>'
+    (see relay.plugins.shell)"""
+    def _plugintype(x):
+        if x.startswith(SHELL_PREFIX):
+            from relay.plugins import shell
+            return shell.load(kind, x)
+        return util.load_obj_from_path(x, prefix='relay.plugins')
+    return _plugintype
+
+
 @lazy_kwargs
 def metric(
     parser,
-    type=lambda x: util.load_obj_from_path(x, prefix='relay.plugins'),
+    type=plugintype('metric'),
     help=(
         ' This should point to generator (function or class) that,'
-        ' when called, returns a metric value.  In a PID controller, this'
+        ' when called, returns a metric value (or a batch of them.'
+        ' See relay.sampling).  In a PID controller, this'
         ' corresponds to the process variable (PV).  Warming the system'
         ' should eventually increase metric values and cooling should'
         ' decrease them. '
@@ -41,7 +66,7 @@ def targettype(x):
             return (_target for _ in iter(int, 1))
         return infinite_iterator
     except ValueError:
-        return util.load_obj_from_path(x, prefix='relay.plugins')
+        return plugintype('target')(x)
 
 
 @lazy_kwargs
@@ -60,21 +85,22 @@ def target(
 @lazy_kwargs
 def warmer(
     parser,
-    type=lambda x: util.load_obj_from_path(x, prefix='relay.plugins'),
+    type=plugintype('warmer'),
     help=(
         ' This should point to a function that starts n additional tasks.'
         ' In a PID controller, this is the manipulated variable (MV).'
         '  Valid examples:\n'
         '  "bash_echo_warmer",\n'
         '  "relay.plugins.bash_echo_warmer",\n'
-        '  "mycode.my_warmer_func"\n')):
+        '  "mycode.my_warmer_func",\n'
+        '  "shell:./my_plugin.sh" (see relay.plugins.shell)\n')):
     add_argument('-w', '--warmer', type=type, help=help)(parser)
 
 
 @lazy_kwargs
 def cooler(
     parser,
-    type=lambda x: util.load_obj_from_path(x, prefix='relay.plugins'),
+    type=plugintype('cooler'),
     help=(
         ' This should point to a function or class that terminates n'
         " instances of your tasks."
@@ -87,13 +113,34 @@ def cooler(
 
 
 @lazy_kwargs
-def delay(parser, default=1):
+def delay(parser, default=1, type=float):
     add_argument(
-        '-d', '--delay', type=float, default=default,
+        '-d', '--delay', type=type, default=default,
         help='num seconds to wait between metric polling. ie. 1/sample_rate'
     )(parser)
 
 
+@lazy_kwargs
+def min_delay(parser):
+    add_argument(
+        '--min_delay', type=float, help=(
+            'Optional.  With --max_delay, adapt the seconds between metric'
+            ' polls to the error: poll as often as every --min_delay seconds'
+            ' while the error moves, and back off to every --max_delay'
+            ' seconds while it is just noise.  Defaults to --delay.'
+            '  See relay.scheduling')
+    )(parser)
+
+
+@lazy_kwargs
+def max_delay(parser):
+    add_argument(
+        '--max_delay', type=float, help=(
+            'Optional.  The longest delay between metric polls when they'
+            ' adapt to the error.  Defaults to --delay.  See --min_delay')
+    )(parser)
+
+
 @lazy_kwargs
 def sendstats(parser):
     add_argument(
@@ -109,34 +156,527 @@ def sendstats(parser):
 
 
 @lazy_kwargs
-def lookback(parser, default=1000):
+def telemetry(parser):
+    add_argument(
+        '--telemetry', help=(
+            'Optional.  A zmq uri to publish a compact binary record of'
+            ' each tick to (time, PV, SP, err, MV, weight and mean error).'
+            ' Records are sent from a background thread and dropped rather'
+            ' than delay the control loop.  See relay.telemetry'
+        ))(parser)
+
+
+@lazy_kwargs
+def log_async(parser, default=False):
+    add_argument(
+        '--log_async', action='store_true', default=default, help=(
+            'Format and write log messages in a background thread, so a'
+            ' slow terminal or pipe never delays the control loop.  If'
+            ' messages arrive faster than they can be written, the excess'
+            ' is dropped')
+    )(parser)
+
+
+@lazy_kwargs
+def log_debug_every(parser, default=1):
+    add_argument(
+        '--log_debug_every', type=int, default=default, help=(
+            'Log only 1 in every n debug messages of each kind, ie'
+            ' "got metric value".  Other log levels are always logged')
+    )(parser)
+
+
+@lazy_kwargs
+def log_debug_rate(parser, default=None):
+    add_argument(
+        '--log_debug_rate', type=float, default=default, help=(
+            'Optional.  Log at most this many debug messages of each kind'
+            ' per second')
+    )(parser)
+
+
+@lazy_kwargs
+def checkpoint(parser):
+    add_argument(
+        '--checkpoint', help=(
+            'Optional.  Periodically save the error history, ramp position'
+            ' and weight to this file, and resume from it when Relay'
+            ' starts.  See relay.checkpoint')
+    )(parser)
+
+
+@lazy_kwargs
+def archive(parser, default=None):
+    add_argument(
+        '--archive', default=default, help=(
+            'Append a record of every tick (ts, PV, SP, err, MV, weight,'
+            ' mean) to the segmented archive in this directory.  Query it'
+            ' with relay.archive.Archive or bin/debugger.py')
+    )(parser)
+
+
+@lazy_kwargs
+def archive_segment_size(parser, default=2 ** 20):
+    add_argument(
+        '--archive_segment_size', type=int, default=default, help=(
+            'The number of records in each file of the --archive')
+    )(parser)
+
+
+@lazy_kwargs
+def profile_startup(parser):
+    add_argument(
+        '--profile_startup', action='store_true', help=(
+            'Log how long each phase of startup took (imports, loading'
+            ' each plugin, parsing options, building the control loop and'
+            ' the first tick) once the first tick completes')
+    )(parser)
+
+
+@lazy_kwargs
+def profile_ticks(parser):
+    add_argument(
+        '--profile_ticks', action='store_true', help=(
+            'Time each phase of every tick, count the ticks that take'
+            ' longer than --delay and periodically log percentiles of the'
+            ' timings.  Send SIGUSR1 to log them now, and SIGUSR2 to start'
+            ' or stop a sampling profiler.  See relay.profiling')
+    )(parser)
+
+
+@lazy_kwargs
+def profile_window(parser, default=1000):
+    add_argument(
+        '--profile_window', type=int, default=default, help=(
+            'Compute the percentiles of --profile_ticks over this many of'
+            ' the most recent ticks')
+    )(parser)
+
+
+@lazy_kwargs
+def profile_interval(parser, default=60):
+    add_argument(
+        '--profile_interval', type=float, default=default, help=(
+            'Seconds between the reports of --profile_ticks')
+    )(parser)
+
+
+@lazy_kwargs
+def profile_sample_interval(parser, default=0.005):
+    add_argument(
+        '--profile_sample_interval', type=float, default=default, help=(
+            'Seconds between samples of the sampling profiler that SIGUSR2'
+            ' toggles')
+    )(parser)
+
+
+@lazy_kwargs
+def checkpoint_interval(parser, default=60):
+    add_argument(
+        '--checkpoint_interval', type=float, default=default, help=(
+            'Seconds between checkpoints')
+    )(parser)
+
+
+@lazy_kwargs
+def checkpoint_max_age(parser, default=None):
+    add_argument(
+        '--checkpoint_max_age', type=float, default=default, help=(
+            "Don't resume from checkpoints older than this many seconds."
+            ' Defaults to the time the error history spans, ie'
+            ' --lookback * --delay')
+    )(parser)
+
+
+@lazy_kwargs
+def coordinate(parser):
+    add_argument(
+        '--coordinate', choices=COORDINATION_MODES, help=(
+            'Optional.  Coordinate with other Relay processes that control'
+            ' the same metric.  "split": each alive process applies an equal'
+            ' share of the MV.  "leader": only one process applies the MV'
+            ' and the others are hot standbys.  See relay.coordination')
+    )(parser)
+
+
+@lazy_kwargs
+def coordinate_bind(parser):
+    add_argument(
+        '--coordinate_bind', help=(
+            'A zmq uri (ie ipc:///tmp/relay1) this process publishes its'
+            ' heartbeats on.  Required with --coordinate')
+    )(parser)
+
+
+@lazy_kwargs
+def coordinate_peers(parser):
+    add_argument(
+        '--coordinate_peers', type=csv_list(str), default=[], help=(
+            'Comma separated zmq uris that the other Relay processes bind'
+            ' to.  It may include this process\'s own --coordinate_bind')
+    )(parser)
+
+
+@lazy_kwargs
+def coordinate_timeout(parser, default=None):
+    add_argument(
+        '--coordinate_timeout', type=float, default=default, help=(
+            'Seconds without a heartbeat after which a peer is presumed'
+            ' dead.  Defaults to 3 * --delay, and at least 1 second')
+    )(parser)
+
+
+@lazy_kwargs
+def lookback(parser, default=1000, type=int):
     add_argument(
-        '--lookback', default=default, type=int,
+        '--lookback', default=default, type=type,
         help=(
             'Keep a history of the last n PV samples for online tuning')
     )(parser)
 
 
 @lazy_kwargs
-def ramp(parser, default=1):
+def ramp(parser, default=1, type=int):
     add_argument(
-        '--ramp', type=int, default=default, help=(
+        '--ramp', type=type, default=default, help=(
             'Add heat or cooling over the first n samples.  This is useful'
             ' if you do not want to add a lot of heat all at once')
     )(parser)
 
 
+@lazy_kwargs
+def ramp_shape(parser, default='linear'):
+    add_argument(
+        '--ramp_shape', choices=RAMP_SHAPES, default=default, help=(
+            'How to spread heat or cooling over the --ramp.  "linear"'
+            ' adds less heat on every sample, "exponential" adds most of'
+            ' it at the start and "scurve" starts and ends slowly')
+    )(parser)
+
+
+@lazy_kwargs
+def gain_schedule(parser):
+    add_argument(
+        '--gain_schedule', help=(
+            'Optional.  Path to a json file that defines regions of the PV'
+            ' (or SP), each with its own gain, lookback, ramp and weight.'
+            ' See relay.gain_scheduling for the file format')
+    )(parser)
+
+
+@lazy_kwargs
+def controller(parser, default=DEFAULT_CONTROLLER):
+    add_argument(
+        '--controller', choices=CONTROLLERS,
+        default=default, help=(
+            'How Relay computes the MV.  "fft_pi" is Relay\'s classic'
+            ' controller, tuned by the spectrum of the error history.'
+            ' "pid" is a PID controller with hand tuned gains.  "mpc" fits'
+            ' a model of the metric and plans the MV with it.'
+            ' See relay.controllers')
+    )(parser)
+
+
+@lazy_kwargs
+def pid_kp(parser, default=1.):
+    add_argument(
+        '--pid_kp', type=float, default=default, help=(
+            'Proportional gain of --controller pid')
+    )(parser)
+
+
+@lazy_kwargs
+def pid_ki(parser, default=0.):
+    add_argument(
+        '--pid_ki', type=float, default=default, help=(
+            'Integral gain of --controller pid')
+    )(parser)
+
+
+@lazy_kwargs
+def pid_kd(parser, default=0.):
+    add_argument(
+        '--pid_kd', type=float, default=default, help=(
+            'Derivative gain of --controller pid')
+    )(parser)
+
+
+@lazy_kwargs
+def pid_windup(parser, default=None):
+    add_argument(
+        '--pid_windup', type=float, default=default, help=(
+            'Optional.  Limit the integral term of --controller pid to'
+            ' +/- this value')
+    )(parser)
+
+
+@lazy_kwargs
+def mpc_horizon(parser, default=10):
+    add_argument(
+        '--mpc_horizon', type=int, default=default, help=(
+            '--controller mpc aims to reach the SP this many samples after'
+            ' the dead time.  Larger values give gentler MVs')
+    )(parser)
+
+
+@lazy_kwargs
+def mpc_max_dead_time(parser, default=5):
+    add_argument(
+        '--mpc_max_dead_time', type=int, default=default, help=(
+            'The longest dead time, in samples, that --controller mpc'
+            ' considers when it fits a model of the metric')
+    )(parser)
+
+
 @lazy_kwargs
 def stop_condition(parser):
     add_argument(
         '--stop_condition',
         type=lambda x: util.load_obj_from_path(x, prefix='relay.plugins'),
         help=(
-            'Optional.  This should point to a function that examines the'
-            ' error history and determines whether Relay should exit. The'
-            ' return code returned by this function gets passed to'
-            ' sys.exit(...)'
-            '  Valid examples:\n'
+            'Optional.  This should point to a class whose update(err) method'
+            ' sees each new error and determines whether Relay should exit,'
+            ' or to a function that examines the whole error history. The'
+            ' return code returned gets passed to sys.exit(...)'
+            '  See relay.stop_conditions.  Valid examples:\n'
             '  "stop_if_mostly_diverging",\n'
+            '  "relay.stop_conditions.Oscillation",\n'
             '  "mycode.my_stop_condition"\n')
     )(parser)
+
+
+@lazy_kwargs
+def tuning_engine(parser, default=DEFAULT_TUNING_ENGINE):
+    add_argument(
+        '--tuning_engine', default=default, choices=TUNING_ENGINES,
+        help=(
+            'How Relay computes the weight it gives to the error history.'
+            ' "sliding_dft" updates the spectrum incrementally as samples'
+            ' arrive and costs O(lookback) per sample.  "fft" recomputes'
+            ' a full fft every sample and costs O(lookback**2).  Both'
+            ' return the same weight, up to floating point rounding.')
+    )(parser)
+
+
+@lazy_kwargs
+def config(parser):
+    add_argument(
+        '--config', required=True, help=(
+            'Path to a json file that defines the control loops to run.'
+            ' See relay.fleet for the file format')
+    )(parser)
+
+
+@lazy_kwargs
+def asyncio(parser, default=False):
+    add_argument(
+        '--asyncio', action='store_true', default=default, help=(
+            'Run the control loop with asyncio.  Metric and target are'
+            ' polled concurrently, ticks are scheduled against a fixed'
+            ' deadline and plugins may be async generators or coroutine'
+            ' functions.  See relay.aio')
+    )(parser)
+
+
+@lazy_kwargs
+def max_inflight(parser, default=4):
+    add_argument(
+        '--max_inflight', type=int, default=default, help=(
+            'The max number of calls to the warmer (or to the cooler) that'
+            ' may run at the same time')
+    )(parser)
+
+
+@lazy_kwargs
+def shell_timeout(parser, default=DEFAULT_SHELL_TIMEOUT):
+    add_argument(
+        '--shell_timeout', type=float, default=default, help=(
+            'Seconds to wait for each reply of a shell plugin'
+            ' (ie --metric shell:./my_plugin.sh) before restarting it')
+    )(parser)
+
+
+@lazy_kwargs
+def metric_cache_ttl(parser):
+    add_argument(
+        '--metric_cache_ttl', type=float, help=(
+            'Optional.  Query the --metric at most once every this many'
+            ' seconds, and share its value with every loop (and, see'
+            ' --metric_cache_scope, every relay process on this host) that'
+            ' reads the same metric.  See relay.plugins.cache')
+    )(parser)
+
+
+@lazy_kwargs
+def metric_cache_scope(parser, default=DEFAULT_METRIC_CACHE_SCOPE):
+    add_argument(
+        '--metric_cache_scope', default=default, choices=METRIC_CACHE_SCOPES,
+        help=(
+            'Share a --metric_cache_ttl metric with the loops of this'
+            ' process, or with every relay process on this host')
+    )(parser)
+
+
+@lazy_kwargs
+def metric_cache_dir(parser):
+    add_argument(
+        '--metric_cache_dir', help=(
+            'Where relay processes on this host share'
+            ' --metric_cache_ttl metrics.  Defaults to relay-metrics in'
+            ' /dev/shm, or in the temp directory')
+    )(parser)
+
+
+@lazy_kwargs
+def backpressure(parser, default='merge'):
+    add_argument(
+        '--backpressure', default=default, choices=BACKPRESSURE_POLICIES,
+        help=(
+            'What to do with a new MV when --max_inflight calls to the'
+            ' warmer or cooler are already running.  "merge" adds it to'
+            ' the MV that the next call will apply.  "drop" discards it.'
+            ' "block" pauses the control loop until a call completes')
+    )(parser)
+
+
+@lazy_kwargs
+def actuation_window(parser, default=0):
+    add_argument(
+        '--actuation_window', type=float, default=default, help=(
+            'Sum MVs over this many seconds and call the warmer or cooler'
+            ' once with the total')
+    )(parser)
+
+
+@lazy_kwargs
+def min_actuation_interval(parser, default=0):
+    add_argument(
+        '--min_actuation_interval', type=float, default=default, help=(
+            'Wait at least this many seconds between two calls to the'
+            ' warmer (or to the cooler)')
+    )(parser)
+
+
+@lazy_kwargs
+def max_step(parser):
+    add_argument(
+        '--max_step', type=int, help=(
+            'Optional.  The largest MV passed to the warmer or cooler in'
+            ' one call.  Any remainder is applied in later calls')
+    )(parser)
+
+
+@lazy_kwargs
+def deadband(parser, default=0):
+    add_argument(
+        '--deadband', type=int, default=default, help=(
+            'Do not call the warmer or cooler if the accumulated MV is'
+            ' smaller than this (in absolute value)')
+    )(parser)
+
+
+@lazy_kwargs
+def sample_period(parser):
+    add_argument(
+        '--sample_period', type=float, help=(
+            'Optional.  If the metric or target yields batches of'
+            ' (timestamp, value) pairs, resample them onto a grid with this'
+            ' many seconds between samples.  Defaults to --delay')
+    )(parser)
+
+
+@lazy_kwargs
+def resample(parser):
+    add_argument(
+        '--resample', choices=RESAMPLE_METHODS, help=(
+            'Optional.  Record the time each error was observed and'
+            ' resample the errors onto a grid of --sample_period seconds'
+            ' before tuning.  Use this if polling the metric takes a'
+            ' variable amount of time.  "linear" interpolates between'
+            ' samples and "zoh" holds the previous sample')
+    )(parser)
+
+
+@lazy_kwargs
+def trace(parser):
+    add_argument(
+        '--trace', help=(
+            'Optional.  Replay the PV and SP values recorded in this file.'
+            ' It may be a csv file with "PV" and "SP" columns, or the json'
+            ' log messages that --sendstats publishes, one per line.'
+            ' If a --plant is also given, only the SP values are replayed')
+    )(parser)
+
+
+@lazy_kwargs
+def plant(parser):
+    add_argument(
+        '--plant', choices=['first_order'], help=(
+            'Optional.  Simulate the response of the metric to the MV with'
+            ' a model: "first_order" accumulates MVs and the metric'
+            ' follows them with a first order lag, after a dead time')
+    )(parser)
+
+
+@lazy_kwargs
+def plant_gain(parser, default=1.):
+    add_argument(
+        '--plant_gain', type=float, default=default,
+        help='Change in the metric per unit of MV'
+    )(parser)
+
+
+@lazy_kwargs
+def plant_tau(parser, default=0.):
+    add_argument(
+        '--plant_tau', type=float, default=default,
+        help='Time constant (in seconds) of the first order lag'
+    )(parser)
+
+
+@lazy_kwargs
+def plant_dead_time(parser, default=0.):
+    add_argument(
+        '--plant_dead_time', type=float, default=default,
+        help='Seconds before an MV starts to affect the metric'
+    )(parser)
+
+
+@lazy_kwargs
+def plant_noise(parser, default=0.):
+    add_argument(
+        '--plant_noise', type=float, default=default,
+        help='Standard deviation of gaussian noise added to the metric'
+    )(parser)
+
+
+@lazy_kwargs
+def initial_pv(parser, default=0.):
+    add_argument(
+        '--initial_pv', type=float, default=default,
+        help='Value of the metric at the start of the simulation'
+    )(parser)
+
+
+@lazy_kwargs
+def ticks(parser, default=10000):
+    add_argument(
+        '--ticks', type=int, default=default, help=(
+            'Number of ticks to simulate.  When replaying a --trace,'
+            ' the simulation also ends at the end of the trace')
+    )(parser)
+
+
+@lazy_kwargs
+def seed(parser):
+    add_argument(
+        '--seed', type=int, help='Optional.  Seed for the random noise'
+    )(parser)
+
+
+@lazy_kwargs
+def output(parser):
+    add_argument(
+        '-o', '--output', help=(
+            'Optional.  Write results to this csv file instead of stdout')
+    )(parser)
@@ -0,0 +1,142 @@
+"""
+Save the state of a ControlLoop to a file and restore it on startup, so a
+restarted Relay neither ramps up again nor waits `lookback` samples before
+its weight is meaningful.  Enable it with `relay --checkpoint <path>`.
+
+A checkpoint holds the error history, its timestamps, the position in the
+ramp and the last weight.  The file is a fixed size header (HEADER) followed
+by the error history's buffer and then its timestamp buffer, each
+2 * lookback little endian doubles (see relay.history.ErrorHistory).
+
+Checkpoints are written to a temporary file that is renamed over the
+previous one, so a crash never leaves a partial checkpoint behind.  They are
+loaded with a copy-on-write memmap: the error history uses the pages of the
+file directly instead of reading and parsing it.  Only the timestamps are
+rewritten, to move them onto the new process's clock.
+"""
+from __future__ import division
+
+import os
+import struct
+import time
+
+import numpy as np
+
+from relay import log
+from relay import util
+
+MAGIC = b'RELAYCKP'
+VERSION = 1
+# magic, version, lookback, head, count, ramp_index, last_weight,
+# wall clock time and loop clock time of the checkpoint
+HEADER = struct.Struct('<8sBqqqqddd')
+HEADER_SIZE = 128  # HEADER is padded to this size to align the buffers
+
+
+def save(path, loop):
+    """Write a checkpoint of the given relay.loop.ControlLoop to `path`"""
+    buf, tbuf, head, count = loop.history.buffers()
+    last_weight = float('nan') if loop.last_weight is None \
+        else loop.last_weight
+    header = HEADER.pack(
+        MAGIC, VERSION, loop.history.n, head, count, loop.ramp_index,
+        last_weight, time.time(), loop.clock())
+    tmp = '%s.tmp' % path
+    with open(tmp, 'wb') as fp:
+        fp.write(header.ljust(HEADER_SIZE, b'\0'))
+        np.asarray(buf, dtype='<f8').tofile(fp)
+        np.asarray(tbuf, dtype='<f8').tofile(fp)
+    os.rename(tmp, path)
+
+
+def load(path, loop, max_age=None):
+    """
+    Restore the state of `loop` from the checkpoint at `path`.  Return True
+    if it was restored, or False if there was no usable checkpoint.
+
+    `max_age` ignore checkpoints older than this many seconds.  Defaults to
+        the time the error history spans (lookback * sample period), since
+        Relay would have forgotten all of it by now anyway.
+    """
+    try:
+        with open(path, 'rb') as fp:
+            header = fp.read(HEADER_SIZE)
+    except IOError:
+        return False
+    try:
+        magic, version, n, head, count, ramp_index, last_weight, saved_at, \
+            saved_clock = HEADER.unpack(header[:HEADER.size])
+    except struct.error:
+        magic = version = n = None
+    if magic != MAGIC or version != VERSION \
+            or os.path.getsize(path) < HEADER_SIZE + 2 * 2 * n * 8:
+        log.warn('ignoring an unrecognized checkpoint', extra=dict(
+            checkpoint=path))
+        return False
+    if n != loop.history.n:
+        log.warn('ignoring a checkpoint of a different lookback', extra=dict(
+            checkpoint=path, lookback=n))
+        return False
+    if max_age is None and loop.sample_period:
+        max_age = n * loop.sample_period
+    age = time.time() - saved_at
+    if max_age is not None and age > max_age:
+        log.info('ignoring a stale checkpoint', extra=dict(
+            checkpoint=path, age=age, max_age=max_age))
+        return False
+
+    data = np.memmap(
+        path, dtype='<f8', mode='c', offset=HEADER_SIZE, shape=(2, 2 * n))
+    buf, tbuf = data[0], data[1]
+    # errors observed `age` seconds before saved_clock on the old clock
+    tbuf += loop.clock() - age - saved_clock
+    loop.restore(
+        buf, tbuf, head, count, ramp_index,
+        None if np.isnan(last_weight) else last_weight)
+    log.info('restored a checkpoint', extra=dict(
+        checkpoint=path, age=age, num_samples=count, ramp_index=ramp_index))
+    return True
+
+
+class Checkpointer(object):
+    """
+    Restore a ControlLoop from `path` and save it there every `interval`
+    seconds.
+
+    `max_age` see `load`
+    `clock` returns the current (monotonic) time in seconds
+    """
+    def __init__(self, path, loop, interval=60, max_age=None,
+                 clock=util.monotonic):
+        self.path = path
+        self.loop = loop
+        self.interval = interval
+        self.clock = clock
+        self.restored = load(path, loop, max_age)
+        self._next_save = clock() + interval
+
+    @classmethod
+    def from_ns(cls, ns, loop, name=None):
+        """Return a Checkpointer for `loop` or None, as requested on the
+        command-line.  If given a `name`, the loop's checkpoint is
+        <checkpoint>.<name>, so that loops of one process don't overwrite
+        each other's checkpoints"""
+        if getattr(ns, 'checkpoint', None):
+            path = ns.checkpoint if name is None \
+                else '%s.%s' % (ns.checkpoint, name)
+            return cls(path, loop, ns.checkpoint_interval,
+                       ns.checkpoint_max_age)
+
+    def maybe_save(self):
+        """Save a checkpoint if one is due"""
+        now = self.clock()
+        if now >= self._next_save:
+            self.save()
+            self._next_save = now + self.interval
+
+    def save(self):
+        try:
+            save(self.path, self.loop)
+        except (IOError, OSError) as err:
+            log.error('could not save a checkpoint', extra=dict(
+                checkpoint=self.path, error=err))
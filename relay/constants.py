@@ -0,0 +1,29 @@
+"""
+The choices and defaults of Relay's options, in one place.
+
+Both relay.argparse_shared, which defines the options, and the modules that
+implement them (which import numpy & co) take these from here, so building
+the parser stays cheap (see --profile_startup) and the two never disagree.
+This module must not import anything but the standard library.
+"""
+
+# relay.actuators
+BACKPRESSURE_POLICIES = ('merge', 'drop', 'block')
+# relay.controllers
+CONTROLLERS = ('fft_pi', 'mpc', 'pid')
+DEFAULT_CONTROLLER = 'fft_pi'
+# relay.coordination
+COORDINATION_MODES = ('split', 'leader')
+# relay.loop
+RAMP_SHAPES = ('linear', 'exponential', 'scurve')
+# relay.sampling
+RESAMPLE_METHODS = ('linear', 'zoh')
+# relay.tuning
+TUNING_ENGINES = ('fft', 'sliding_dft')
+DEFAULT_TUNING_ENGINE = 'sliding_dft'
+# relay.plugins.cache
+METRIC_CACHE_SCOPES = ('process', 'host')
+DEFAULT_METRIC_CACHE_SCOPE = 'host'
+# relay.plugins.shell
+SHELL_PREFIX = 'shell:'
+DEFAULT_SHELL_TIMEOUT = 10
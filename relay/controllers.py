@@ -0,0 +1,171 @@
+"""
+Controllers turn the state of a relay.loop.ControlLoop into an MV.  Pick one
+with `relay --controller <name>`.
+
+    fft_pi - Relay's classic controller: MV = err - weight * mean(errors),
+        where the weight comes from the spectrum of the error history (see
+        relay.tuning).  It costs an fft, or a sliding DFT update, per tick
+    pid - a textbook PID controller with anti-windup.  The cheapest
+        controller, but its gains (--pid_kp, --pid_ki, --pid_kd) must be
+        tuned by hand
+    mpc - a model predictive controller.  It fits a first order plus dead
+        time (FOPDT) model of the metric's response to past MVs, and
+        requests the MV that brings the predicted PV to the SP
+        --mpc_horizon samples after the dead time.  Its cost grows with the
+        lookback and --mpc_max_dead_time
+
+A controller has a `compute(loop, pending)` method that returns the MV and
+a list of three numbers that are logged as `data` with the MV, and an
+`observe(loop, MV)` method that is called with every MV the loop returns,
+including those of the ramp.  The time spent in `compute` is logged as
+`controller_seconds`.
+"""
+from __future__ import division
+
+import numpy as np
+
+from relay.constants import DEFAULT_CONTROLLER
+from relay.history import ErrorHistory
+
+
+def fft_pi(loop, weight, pending=0):
+    """The MV of Relay's classic controller, given the weight of the error
+    history.  Return the MV and [err, weight, mean]"""
+    mean = loop.history.mean
+    loop.last_weight = weight
+    return loop.err - pending - weight * mean, [loop.err, weight, mean]
+
+
+class FFTPIController(object):
+    name = 'fft_pi'
+    uses_weight = True
+
+    def compute(self, loop, pending=0):
+        return fft_pi(loop, loop.weight(), pending)
+
+    def observe(self, loop, MV):
+        pass
+
+
+class PIDController(object):
+    """
+    MV = kp * err + ki * integral(err) - kd * d(PV)/dt
+
+    The derivative is of the PV rather than the error, so changes of the
+    SP don't cause a spike in the MV.  The integral term is clamped to
+    +/- `windup` so it can't grow without bound while the metric can't
+    follow the MVs (anti-windup).  Time is measured in units of the loop's
+    sample period.
+    """
+    name = 'pid'
+    uses_weight = False
+
+    def __init__(self, kp=1., ki=0., kd=0., windup=None):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.windup = windup
+        self.integral = 0.
+        self._last_PV = None
+
+    def compute(self, loop, pending=0):
+        self.integral += loop.err
+        integral = self.ki * self.integral
+        if self.windup is not None and abs(integral) > self.windup:
+            integral = np.sign(integral) * self.windup
+            self.integral = integral / self.ki
+        derivative = 0. if self._last_PV is None \
+            else -self.kd * (loop.PV - self._last_PV)
+        self._last_PV = loop.PV
+        proportional = self.kp * loop.err
+        return (proportional + integral + derivative - pending,
+                [proportional, integral, derivative])
+
+    def observe(self, loop, MV):
+        pass
+
+
+def fit_fopdt(y, u, max_dead_time):
+    """
+    Fit y[k + 1] = a * y[k] + b * u[k - d] + c by least squares, for every
+    dead time d in [0, max_dead_time].  Return (a, b, c, d) of the best fit,
+    or None if there isn't enough data.
+
+    `y` the PV observed on each tick
+    `u` the cumulative MV requested on each tick, ie the level of heat
+    """
+    best = None
+    for d in range(max_dead_time + 1):
+        rows = len(y) - 1 - d
+        if rows < 4:
+            break
+        X = np.column_stack([y[d:-1], u[:-1 - d], np.ones(rows)])
+        coef, residuals = np.linalg.lstsq(X, y[d + 1:], rcond=None)[:2]
+        err = residuals[0] if len(residuals) else np.inf
+        if best is None or err < best[0]:
+            best = (err, coef, d)
+    if best is not None:
+        (a, b, c), d = best[1], best[2]
+        return a, b, c, d
+
+
+class MPCController(object):
+    """
+    Refit a FOPDT model over the last `lookback` PVs and MVs on every tick,
+    then choose the MV that, held constant, brings the predicted PV to the
+    SP `horizon` samples after the dead time.
+
+    Until the fit is usable (0 <= a < 1 and b != 0), the MV is the error,
+    ie the fft_pi controller with a weight of 0.
+    """
+    name = 'mpc'
+    uses_weight = False
+
+    def __init__(self, horizon=10, max_dead_time=5):
+        self.horizon = horizon
+        self.max_dead_time = max_dead_time
+        self._PV = self._U = None
+        self._level = 0.
+
+    def observe(self, loop, MV):
+        if self._PV is None:
+            self._PV = ErrorHistory(loop.history.n)
+            self._U = ErrorHistory(loop.history.n)
+        self._level += MV
+        self._PV.append(loop.PV)
+        self._U.append(self._level)
+
+    def compute(self, loop, pending=0):
+        fit = None
+        if self._PV is not None:
+            fit = fit_fopdt(
+                self._PV.view(), self._U.view(), self.max_dead_time)
+        if fit is None or not 0 <= fit[0] < 1 or fit[1] == 0:
+            return loop.err - pending, [np.nan, np.nan, np.nan]
+        a, b, c, d = fit
+        # predict the PV with no new MV.  Past MVs keep arriving for d ticks
+        u = self._U.view()
+        y = loop.PV
+        for j in range(d + self.horizon):
+            y = a * y + b * (u[j - d] if j < d else u[-1]) + c
+        # the response to a step of 1 held for `horizon` ticks
+        gain = b * (1 - a ** self.horizon) / (1 - a)
+        tau = -1 / np.log(a) if a > 0 else 0.
+        return (loop.SP - y) / gain, [b / (1 - a), tau, d]
+
+
+CONTROLLERS = {
+    'fft_pi': FFTPIController,
+    'pid': PIDController,
+    'mpc': MPCController,
+}
+
+
+def from_ns(ns):
+    """Instantiate the controller selected on the command-line"""
+    name = getattr(ns, 'controller', None) or DEFAULT_CONTROLLER
+    if name == 'pid':
+        return PIDController(ns.pid_kp, ns.pid_ki, ns.pid_kd, ns.pid_windup)
+    if name == 'mpc':
+        return MPCController(ns.mpc_horizon, ns.mpc_max_dead_time)
+    return CONTROLLERS[name]()
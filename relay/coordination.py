@@ -0,0 +1,153 @@
+"""
+Coordinate several Relay processes that control the same metric, so they
+don't each apply the full MV.  Enable it with `relay --coordinate <mode>`.
+
+Every instance binds a PUB socket to its own --coordinate_bind address and
+subscribes to the addresses of its --coordinate_peers.  On every tick, it
+publishes a heartbeat with the MV it computed and its error, and logs the
+mean MV and error of its peers (see Coordinator.stats) so a disagreement
+between instances shows up.  An instance is alive if its last heartbeat is
+more recent than --coordinate_timeout.
+
+Modes:
+
+    split - every alive instance applies an equal share of the MV.  The
+        shares of all instances add up to the MV, since every instance
+        observes the same metric and computes (nearly) the same MV.
+    leader - only the alive instance with the smallest address applies the
+        MV.  The others keep their error history up to date and take over
+        as soon as the leader's heartbeats stop.
+
+An instance applies no MV until it has listened for heartbeats for one
+timeout, so instances that start together don't all act alone.  Meanwhile,
+it's `discovering`, and the MVs it computes stay pending in the
+ActuationShaper (see relay.runner.release) until it knows its share of
+them.  When an instance dies, its peers keep splitting the MV as if it were
+alive until its heartbeats time out, so they briefly undershoot rather than
+overshoot.
+"""
+from __future__ import division
+
+import json
+
+from relay import log
+from relay import util
+from relay.constants import COORDINATION_MODES as MODES
+
+
+def _mean(values):
+    values = [v for v in values if v is not None]
+    return sum(values) / len(values) if values else None
+
+
+class Coordinator(object):
+    """
+    Decide which part of each MV this instance applies.
+
+    `mode` one of MODES
+    `address` zmq uri this instance publishes its heartbeats on.  It also
+        identifies this instance
+    `peers` zmq uris of the other instances
+    `timeout` seconds after their last heartbeat that peers are presumed dead
+    `clock` returns the current (monotonic) time in seconds
+    """
+    def __init__(self, mode, address, peers, timeout, clock=util.monotonic):
+        if mode not in MODES:
+            raise ValueError("Unrecognized coordination mode: %s" % mode)
+        import zmq
+        self._zmq = zmq
+        self.mode = mode
+        self.id = address
+        self.timeout = timeout
+        self.clock = clock
+        self.peers = {}  # id: (time of last heartbeat, heartbeat)
+        self._discover_until = clock() + timeout
+        ctx = zmq.Context.instance()
+        self._pub = ctx.socket(zmq.PUB)
+        self._pub.setsockopt(zmq.LINGER, 0)
+        self._pub.bind(address)
+        self._sub = ctx.socket(zmq.SUB)
+        self._sub.setsockopt(zmq.LINGER, 0)
+        self._sub.setsockopt(zmq.SUBSCRIBE, b'')
+        for peer in peers:
+            if peer != address:
+                self._sub.connect(peer)
+
+    @classmethod
+    def from_ns(cls, ns):
+        """Return a Coordinator or None, as requested on the command-line"""
+        if getattr(ns, 'coordinate', None):
+            return cls(ns.coordinate, ns.coordinate_bind, ns.coordinate_peers,
+                       ns.coordinate_timeout or max(3 * ns.delay, 1))
+
+    def _receive(self):
+        now = self.clock()
+        while True:
+            try:
+                msg = self._sub.recv(self._zmq.NOBLOCK)
+            except self._zmq.Again:
+                break
+            try:
+                heartbeat = json.loads(msg.decode('utf8'))
+                peer = heartbeat['id']
+            except (ValueError, KeyError, TypeError):
+                log.warn('ignoring a malformed heartbeat', extra=dict(
+                    heartbeat=msg))
+                continue
+            if peer not in self.peers:
+                log.info('a peer joined', extra=dict(peer=peer))
+            self.peers[peer] = (now, heartbeat)
+        for peer, (t, _) in list(self.peers.items()):
+            if now - t > self.timeout:
+                log.warn('lost a peer', extra=dict(peer=peer))
+                del self.peers[peer]
+
+    def alive(self):
+        """Sorted ids of the instances that are alive, including this one"""
+        return sorted(set(self.peers).union([self.id]))
+
+    @property
+    def is_leader(self):
+        return self.alive()[0] == self.id
+
+    @property
+    def discovering(self):
+        """Is this instance still listening for its peers' heartbeats?"""
+        return self.clock() < self._discover_until
+
+    def heartbeat(self, MV=None, err=None):
+        """Receive the peers' heartbeats and publish this instance's.  `MV`
+        is None while this instance applies no MV, ie while discovering"""
+        self._receive()
+        try:
+            self._pub.send(json.dumps(dict(
+                id=self.id, MV=MV, err=err)).encode('utf8'),
+                self._zmq.NOBLOCK)
+        except self._zmq.Again:
+            pass
+
+    def share(self, MV, err=None):
+        """Publish a heartbeat and return the part of `MV` that this
+        instance should apply.  Don't call it while `discovering`: the
+        MV isn't applied yet, so keep it pending"""
+        self.heartbeat(MV, err)
+        if self.mode == 'leader':
+            return MV if self.is_leader else 0
+        alive = self.alive()
+        q, r = divmod(abs(MV), len(alive))
+        share = q + (1 if alive.index(self.id) < r else 0)
+        return share if MV >= 0 else -share
+
+    def stats(self):
+        """How many peers are alive and the mean MV and error of their last
+        heartbeats.  If the peers' MV or error differ much from this
+        instance's, they don't observe the same metric or target"""
+        heartbeats = [heartbeat for _, heartbeat in self.peers.values()]
+        return dict(
+            peers_alive=len(self.peers), is_leader=self.is_leader,
+            peers_MV=_mean(h.get('MV') for h in heartbeats),
+            peers_err=_mean(h.get('err') for h in heartbeats))
+
+    def close(self):
+        self._pub.close()
+        self._sub.close()
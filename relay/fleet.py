@@ -0,0 +1,284 @@
+"""
+Run many Relay control loops in one process.
+
+A fleet is defined in a json config file:
+
+    {
+        "defaults": {"delay": 1, "lookback": 1000},
+        "loops": [
+            {"name": "queue1", "metric": "mycode.queue1_size",
+             "target": 0, "warmer": "mycode.add_queue1_consumers"},
+            {"name": "queue2", "metric": "mycode.queue2_size",
+             "target": 0, "warmer": "mycode.add_queue2_consumers",
+             "delay": 0.1, "ramp": 10}
+        ]
+    }
+
+Each loop accepts the same options as the `relay` command (ie metric,
+target, warmer, cooler, delay, lookback, ramp, stop_condition, ...), except
+for the ones in UNSUPPORTED_OPTIONS: the fleet computes every weight with
+the batch engine, and logging, telemetry and profiling are configured on
+the `relay fleet` command-line.  Plugins must be sync.  "defaults" apply to
+every loop, and RELAY_* environment variables apply as usual.  When a
+loop's stop condition triggers, that loop stops.  The process exits when
+every loop has stopped.  Each loop's --checkpoint is saved to
+<checkpoint>.<name> and its --archive to <archive>/<name>.
+
+All loops share one scheduler, and all loops that are due at the same time
+with the same amount of error history compute their weights with one
+vectorized call to relay.tuning.calc_weight_batch.  Loops that read the
+same metric can share one query of it with --metric_cache_ttl (see
+relay.plugins.cache).
+"""
+from __future__ import division
+
+from collections import defaultdict
+import heapq
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from relay import log, configure_logging
+from relay import tuning
+from relay.actuators import Actuator
+from relay.archive import ArchiveWriter
+from relay.checkpoint import Checkpointer
+from relay import stop_conditions
+from relay import util
+from relay.loop import ControlLoop
+from relay.scheduling import AdaptiveDelay
+from relay import parsers
+from relay import runner
+
+
+UNSUPPORTED_OPTIONS = (
+    'asyncio', 'gain_schedule', 'tuning_engine',
+    'coordinate', 'coordinate_bind', 'coordinate_peers', 'coordinate_timeout',
+    'sendstats', 'telemetry', 'log_async', 'log_debug_every',
+    'log_debug_rate', 'profile_startup', 'profile_ticks', 'profile_window',
+    'profile_interval', 'profile_sample_interval')
+# the options of `relay fleet` itself.  Their RELAY_* environment variables
+# are meant for it, not for the loops
+FLEET_OPTIONS = (
+    'sendstats', 'telemetry', 'log_async', 'log_debug_every',
+    'log_debug_rate')
+PLUGINS = ('metric', 'target', 'warmer', 'cooler', 'stop_condition')
+
+
+class InvalidFleetConfig(Exception):
+    pass
+
+
+class FleetMember(object):
+    """One control loop in the fleet, and the plugins it polls and drives"""
+    def __init__(self, name, ns):
+        self.name = name
+        self.ns = ns
+        self.metric = ns.metric()
+        self.target = ns.target()
+        self.shaper = runner.build_shaper(ns)
+        self.actuate = Actuator(
+            ns.warmer, ns.cooler, ns.max_inflight, ns.backpressure)
+        # weights are computed for the whole fleet by calc_weight_batch
+        self.loop = ControlLoop.from_ns(ns, tuning_engine=None, name=name)
+        self.checkpoint = Checkpointer.from_ns(ns, self.loop, name)
+        self.archive = ArchiveWriter.from_ns(ns, name)
+        self.stop = stop_conditions.Monitor.from_ns(ns, self.loop)
+        self.scheduler = AdaptiveDelay.from_ns(ns)
+        self.closed = False
+
+    def close(self, wait=True):
+        """Stop actuating, and save the archive and the checkpoint"""
+        if self.closed:
+            return
+        self.closed = True
+        self.actuate.shutdown(wait=wait)
+        if self.archive:
+            self.archive.close()
+        if self.checkpoint:
+            self.checkpoint.save()
+
+    def next_delay(self):
+        """Seconds until this member is due again"""
+        if self.scheduler:
+            return self.scheduler.update(self.loop)
+        return self.ns.delay
+
+
+def _to_argv(options):
+    argv = []
+    for k, v in options.items():
+        argv.extend(['--%s' % k, str(v)])
+    return argv
+
+
+def _from_env(option):
+    """Is `option` set with a RELAY_* environment variable?"""
+    return ('RELAY_%s' % option).upper() in os.environ
+
+
+def validate(name, options, ns):
+    """Raise InvalidFleetConfig unless relay fleet supports the `options`
+    (and the resulting `ns`) of loop `name`, or the RELAY_* environment
+    variables"""
+    if None in [ns.target, ns.metric]:
+        raise InvalidFleetConfig(
+            "Loop %s must define a metric and target" % name)
+    if ns.warmer is None and ns.cooler is None:
+        raise InvalidFleetConfig(
+            "Loop %s must define a warmer or a cooler" % name)
+    unsupported = [
+        k for k in UNSUPPORTED_OPTIONS
+        if k in options or (k not in FLEET_OPTIONS and _from_env(k))]
+    if unsupported:
+        raise InvalidFleetConfig(
+            "Loop %s has options that relay fleet doesn't support: %s"
+            % (name, ', '.join(unsupported)))
+    for k in PLUGINS:
+        if util.is_async_plugin(getattr(ns, k)):
+            raise InvalidFleetConfig(
+                "Loop %s: %s is an async plugin, which relay fleet doesn't"
+                " support" % (name, k))
+
+
+def load_config(fp):
+    """Return a list of FleetMember instances defined by a json config file"""
+    config = json.load(fp)
+    defaults = config.get('defaults', {})
+    members = []
+    parser = runner.build_arg_parser()
+    for i, options in enumerate(config.get('loops', [])):
+        options = dict(defaults, **options)
+        name = str(options.pop('name', i))
+        try:
+            ns = parser.parse_args(_to_argv(options))
+        except SystemExit:
+            raise InvalidFleetConfig(
+                "Could not parse the options of loop %s" % name)
+        validate(name, options, ns)
+        runner.configure_shell_plugins(ns)
+        runner.configure_metric_cache(ns)
+        members.append(FleetMember(name, ns))
+    if not members:
+        raise InvalidFleetConfig("The fleet config doesn't define any loops")
+    return members
+
+
+def compute_weights(members):
+    """Compute the weight of each member's error history.  Histories of the
+    same length are stacked into a matrix and computed in one call"""
+    by_length = defaultdict(list)
+    for m in members:
+        by_length[len(m.loop.history)].append(m)
+    weights = {}
+    for group in by_length.values():
+        errmatrix = np.stack([m.loop.history.view() for m in group])
+        for m, w in zip(group, tuning.calc_weight_batch(errmatrix)):
+            weights[m] = float(w)
+    return weights
+
+
+def tick(members, telemetry=None):
+    """Poll, compute and actuate every given member.  Return the members
+    whose stop condition triggered.
+
+    `telemetry` (optional) a relay.telemetry.TelemetryPublisher"""
+    MVs = {}
+    for m in members:
+        if not m.loop.push(next(m.target), next(m.metric)):
+            MVs[m] = 0  # no new samples
+        elif m.loop.ramping:
+            MVs[m] = m.loop.ramp_output()
+        elif not m.loop.controller.uses_weight:
+            MVs[m] = m.loop.control(m.shaper.pending + m.actuate.pending)
+    start = util.perf_counter()
+    weights = compute_weights([m for m in members if m not in MVs])
+    # every loop of the batch is charged an equal share of its time
+    weight_seconds = \
+        (util.perf_counter() - start) / len(weights) if weights else 0
+    stopped = []
+    for m in members:
+        if m not in MVs:
+            MVs[m] = m.loop.output(
+                weights[m], m.shaper.pending + m.actuate.pending,
+                weight_seconds)
+        m.shaper.add(MVs[m])
+        MV = m.shaper.release()
+        m.actuate(MV, err=m.loop.err, loop=m.name, **m.shaper.stats())
+        now = time.time()
+        if telemetry:
+            telemetry.publish_tick(now, m.loop, MV)
+        if m.archive:
+            m.archive.append_tick(now, m.loop, MV)
+        if m.checkpoint:
+            m.checkpoint.maybe_save()
+        return_code = m.stop.check() if m.stop else None
+        if return_code is not None:
+            log.info('Stop condition triggered!  Loop is terminating.',
+                     extra=dict(loop=m.name, return_code=return_code))
+            m.close(wait=False)
+            stopped.append(m)
+    return stopped
+
+
+def run(members, clock=util.monotonic, sleep=time.sleep, telemetry=None):
+    """
+    Drive all members until every one of them has stopped.
+
+    Each member is due once every `delay` seconds, or as often as its
+    --min_delay and --max_delay let relay.scheduling decide.  Deadlines are
+    fixed in advance so the time spent polling and computing doesn't
+    stretch a member's sample period.  If a member falls more than one
+    period behind, it skips the missed deadlines rather than running in a
+    burst.
+    """
+    now = clock()
+    heap = [(now, i) for i in range(len(members))]
+    while heap:
+        now = clock()
+        if heap[0][0] > now:
+            sleep(heap[0][0] - now)
+            continue
+        due = []
+        while heap and heap[0][0] <= now:
+            due.append(heapq.heappop(heap))
+        stopped = tick([members[i] for _, i in due], telemetry)
+        for deadline, i in due:
+            if members[i] in stopped:
+                continue
+            delay = members[i].next_delay()
+            deadline += delay
+            if deadline < now:
+                deadline = now + delay
+            heapq.heappush(heap, (deadline, i))
+
+
+def main(ns):
+    configure_logging(True)
+    runner.configure_sendstats(ns.sendstats)
+    runner.configure_log_pipeline(ns)
+    try:
+        with open(ns.config) as fp:
+            members = load_config(fp)
+    except (IOError, ValueError, InvalidFleetConfig) as err:
+        log.error("Could not load the fleet config", extra=dict(
+            config=ns.config, error=err))
+        sys.exit(1)
+    log.info("Starting relay fleet!", extra=dict(
+        config=ns.config, num_loops=len(members)))
+    telemetry = runner.build_telemetry(ns)
+    runner.exit_on_sigterm()
+    try:
+        run(members, telemetry=telemetry)
+    finally:
+        for m in members:
+            m.close()
+        if telemetry:
+            telemetry.close()
+
+
+# the parser lives in relay.parsers, so it's built without importing this
+build_arg_parser = parsers.build_fleet_arg_parser
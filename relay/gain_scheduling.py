@@ -0,0 +1,232 @@
+"""
+Gain scheduling: use different control parameters in different regions of
+the PV (or SP).  Enable it with `relay --gain_schedule schedule.json`.
+
+A metric may behave very differently at 10 than at 10 million (ie a queue
+size), so one set of parameters rarely fits the whole range.  A schedule is
+defined in a json file:
+
+    {
+        "by": "PV",
+        "hysteresis": 5,
+        "regions": [
+            {"below": 100, "gain": 1, "lookback": 100},
+            {"below": 100000, "gain": 0.5, "lookback": 1000},
+            {"gain": 0.1, "lookback": 10000, "weight": 0}
+        ]
+    }
+
+"by" (PV or SP) is the value that selects the region.  Regions are sorted by
+their "below" bound.  The last region has no bound and catches everything
+else.  Each region may override these relay options: lookback, ramp,
+ramp_shape, tuning_engine and controller, and may define:
+
+    gain - multiply the region's MVs by this.  Defaults to 1
+    weight - a fixed weight for the error history instead of the one the
+        tuning engine computes
+
+The PV (or SP) must move past a bound by more than "hysteresis" (default 0)
+before the region changes, so a metric that hovers around a bound doesn't
+flip between regions on every sample.
+
+Every region is a separate relay.loop.ControlLoop with its own error
+history, which only records errors observed while the region is active.
+Only the first active region ramps up: a region that becomes active later
+starts controlling right away, so MV that is already pending isn't
+requested again.  Stop conditions see the errors of every region, in the
+order they were observed, in one history of --lookback errors.
+
+Finding the region is a binary search over the bounds, and only the active
+region does any work, so a tick costs the same however many regions there
+are.
+"""
+from __future__ import division
+
+import argparse
+import bisect
+import json
+import numbers
+
+from relay import log
+from relay import controllers
+from relay import tuning
+from relay.history import ErrorHistory
+from relay.loop import ControlLoop, RAMP_SHAPES
+from relay.sampling import normalize
+
+REGION_OPTIONS = (
+    'lookback', 'ramp', 'ramp_shape', 'tuning_engine', 'controller')
+# the values that the region options that name something may take
+REGION_CHOICES = {
+    'ramp_shape': RAMP_SHAPES,
+    'tuning_engine': tuning.ENGINES,
+    'controller': controllers.CONTROLLERS,
+}
+
+
+class InvalidGainSchedule(Exception):
+    pass
+
+
+def _latest(sample):
+    """The most recent value in a sample yielded by a plugin, or None"""
+    if isinstance(sample, numbers.Number):
+        return sample
+    values = normalize(sample)[1]
+    return values[-1] if len(values) else None
+
+
+class Region(object):
+    """One region of a gain schedule"""
+    def __init__(self, loop, gain=1., weight=None, below=None):
+        self.loop = loop
+        self.gain = gain
+        self.weight = weight
+        self.below = below
+
+
+class GainScheduledLoop(object):
+    """
+    A control loop that delegates every tick to the ControlLoop of the
+    region the PV (or SP) is in.  It has the interface of a ControlLoop, and
+    `history`, `last_weight` and `ramp_index` are those of the active
+    region.  `errors` holds the errors of every region.
+
+    `regions` a list of Region instances, sorted by their `below` bound.
+        The last one must not have a bound
+    `by` 'PV' or 'SP'
+    `hysteresis` how far past a bound the value must move to change regions
+    `lookback` the number of errors, of all regions, that stop conditions
+        see.  Defaults to the longest lookback of the regions
+    """
+    def __init__(self, regions, by='PV', hysteresis=0, name=None,
+                 lookback=None):
+        if by not in ('PV', 'SP'):
+            raise InvalidGainSchedule("Regions must be selected by PV or SP")
+        if not regions or regions[-1].below is not None:
+            raise InvalidGainSchedule(
+                "The last region of a gain schedule must not have a bound")
+        self.regions = regions
+        self.bounds = [r.below for r in regions[:-1]]
+        if self.bounds != sorted(self.bounds):
+            raise InvalidGainSchedule("Regions must be sorted by their bound")
+        self.by = by
+        self.hysteresis = hysteresis
+        self.name = name
+        self.index = None  # of the active region
+        self.err = self.SP = self.PV = None
+        self.errors = ErrorHistory(
+            lookback or max(r.loop.history.n for r in regions))
+
+    @classmethod
+    def from_ns(cls, ns, **kwargs):
+        """Build a GainScheduledLoop from the relay command-line options and
+        the schedule in the --gain_schedule file"""
+        with open(ns.gain_schedule) as fp:
+            schedule = json.load(fp)
+        regions = []
+        for i, options in enumerate(schedule.get('regions', [])):
+            unknown = set(options).difference(
+                REGION_OPTIONS + ('below', 'gain', 'weight'))
+            if unknown:
+                raise InvalidGainSchedule(
+                    "Region %s has unrecognized options: %s"
+                    % (i, ', '.join(sorted(unknown))))
+            for k, choices in REGION_CHOICES.items():
+                if k in options and options[k] not in choices:
+                    raise InvalidGainSchedule(
+                        "Region %s has an unrecognized %s: %s.  Choose from"
+                        " %s" % (i, k, options[k], ', '.join(sorted(choices))))
+            region_ns = argparse.Namespace(**vars(ns))
+            for k in REGION_OPTIONS:
+                if k in options:
+                    setattr(region_ns, k, options[k])
+            loop_kwargs = dict(kwargs)
+            if options.get('weight') is not None:
+                loop_kwargs['tuning_engine'] = None
+            regions.append(Region(
+                ControlLoop.from_ns(region_ns, **loop_kwargs),
+                options.get('gain', 1.), options.get('weight'),
+                options.get('below')))
+        return cls(
+            regions, schedule.get('by', 'PV'), schedule.get('hysteresis', 0),
+            kwargs.get('name'), ns.lookback)
+
+    def select(self, value):
+        """Return the index of the region that `value` selects, given the
+        region that is active now"""
+        i = bisect.bisect_right(self.bounds, value)
+        if self.index is None or i == self.index or not self.hysteresis:
+            return i
+        # the value must move past the active region's bound by the
+        # hysteresis
+        if i > self.index:
+            if value < self.bounds[self.index] + self.hysteresis:
+                return self.index
+        elif value >= self.bounds[self.index - 1] - self.hysteresis:
+            return self.index
+        return i
+
+    @property
+    def region(self):
+        return self.regions[self.index or 0]
+
+    @property
+    def history(self):
+        return self.region.loop.history
+
+    @property
+    def ticks(self):
+        return self.region.loop.ticks
+
+    @property
+    def last_weight(self):
+        return self.region.loop.last_weight
+
+    @property
+    def ramp_index(self):
+        return self.region.loop.ramp_index
+
+    @property
+    def ramping(self):
+        return self.region.loop.ramping
+
+    def spectrum(self):
+        return self.region.loop.spectrum()
+
+    def _record(self, history, n):
+        """Copy the `n` errors that just entered the region's `history`
+        to the errors of the whole scheduled loop"""
+        if n == 1:
+            self.errors.append(history.view()[-1])
+        elif n:
+            self.errors.extend(history.view()[-min(n, len(history)):])
+
+    def update(self, SP, PV, pending=0):
+        """Record a new sample in the active region and return its MV"""
+        value = _latest(PV if self.by == 'PV' else SP)
+        if value is not None:
+            i = self.select(value)
+            if i != self.index:
+                log.info('entering a new gain scheduling region', extra=dict(
+                    region=i, gain=self.regions[i].gain,
+                    **{self.by: value}))
+                if self.index is not None:
+                    # the loop already ramped up in its first region
+                    self.regions[i].loop.end_ramp()
+                self.index = i
+        region = self.region
+        loop = region.loop
+        total = loop.history.total
+        if not loop.push(SP, PV):
+            return 0
+        self._record(loop.history, loop.history.total - total)
+        self.err, self.SP, self.PV = loop.err, loop.SP, loop.PV
+        pending = pending / region.gain if region.gain else pending
+        if loop.ramping:
+            MV = loop.ramp_output()
+        elif region.weight is None:
+            MV = loop.control(pending)
+        else:
+            MV = loop.output(region.weight, pending)
+        return int(round(region.gain * MV))
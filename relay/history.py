@@ -0,0 +1,209 @@
+"""
+Relay's error history: the last `lookback` errors between target and metric
+"""
+from __future__ import division
+
+import numpy as np
+
+
+class ErrorHistory(object):
+    """
+    A fixed size, preallocated circular buffer of error samples.
+
+    Every sample is written twice, once in each half of a buffer of size 2n,
+    so the last n samples are always available as one contiguous slice.
+    This means `view()` never copies data, and appending a sample never
+    allocates memory.
+
+    The sum of the samples is updated as they enter and leave the buffer.
+    It is recomputed from scratch every n samples so floating point
+    rounding doesn't accumulate.
+
+    `n` the maximum number of samples to remember
+    `initial_data` (optional) an iterable of samples to start with
+    `timestamps` if True, also remember when each sample was taken.  Samples
+        must then be added with a timestamp, in increasing order.  The
+        achieved sample rate and its jitter are kept up to date the same way
+        as the sum.
+    """
+    def __init__(self, n, initial_data=(), timestamps=False):
+        if n < 1:
+            raise ValueError("ErrorHistory needs room for at least 1 sample")
+        self.n = n
+        self._buf = np.zeros(2 * n)
+        self._tbuf = np.zeros(2 * n) if timestamps else None
+        self._head = 0  # index where the next sample will be written
+        self._count = 0
+        self._total = 0  # samples ever added
+        self._sum = 0.
+        self._isum = 0.  # sum of the intervals between timestamps
+        self._isumsq = 0.  # sum of the squared intervals
+        self._nupdates = 0
+        for x in initial_data:
+            self.append(x)
+
+    @classmethod
+    def from_buffers(cls, buf, tbuf=None, head=0, count=0):
+        """Build a history that uses the given buffers, as returned by
+        `buffers()`, without copying them.  `buf` (and `tbuf`) may be numpy
+        memmaps, but must be writable (ie opened in copy-on-write mode)"""
+        n = len(buf) // 2
+        if len(buf) != 2 * n or (tbuf is not None and len(tbuf) != 2 * n):
+            raise ValueError("Buffers of an ErrorHistory must have size 2n")
+        if not 0 <= head < n or not 0 <= count <= n:
+            raise ValueError("Invalid head or count for an ErrorHistory")
+        self = cls(1, timestamps=tbuf is not None)  # don't allocate 2n
+        self.n, self._buf, self._tbuf = n, buf, tbuf
+        self._head, self._count = head, count
+        self._total = count
+        self._resum()
+        return self
+
+    def buffers(self):
+        """Return (buf, tbuf, head, count): the internal state needed to
+        rebuild this history with `from_buffers`.  tbuf may be None"""
+        return self._buf, self._tbuf, self._head, self._count
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def total(self):
+        """The number of samples ever added, including those that fell out
+        of the history"""
+        return self._total
+
+    @property
+    def full(self):
+        return self._count == self.n
+
+    @property
+    def sum(self):
+        return self._sum
+
+    @property
+    def mean(self):
+        return self._sum / self._count if self._count else 0.
+
+    @property
+    def sample_rate(self):
+        """Average number of samples per second, or None if unknown"""
+        if self._count < 2 or self._isum <= 0:
+            return None
+        return (self._count - 1) / self._isum
+
+    @property
+    def jitter(self):
+        """Standard deviation of the seconds between samples, or None"""
+        if self._count < 2:
+            return None
+        m = self._count - 1
+        mean = self._isum / m
+        return max(self._isumsq / m - mean ** 2, 0.) ** .5
+
+    def append(self, x, t=None):
+        """Add a sample, taken at time `t`, to the history.  Return the
+        sample that fell out of the history, or None if the history wasn't
+        full yet"""
+        x = float(x)
+        n, i = self.n, self._head
+        if self._count == n:
+            evicted = float(self._buf[i])
+        else:
+            evicted = None
+        if self._tbuf is not None:
+            self._update_intervals(t, i)
+        if evicted is None:
+            self._count += 1
+        self._total += 1
+        self._buf[i] = self._buf[i + n] = x
+        self._head = (i + 1) % n
+
+        self._nupdates += 1
+        if self._nupdates >= n:
+            self._resum()
+        else:
+            self._sum += x if evicted is None else x - evicted
+        return evicted
+
+    def _update_intervals(self, t, i):
+        if t is None:
+            raise ValueError("This history needs a timestamp for each sample")
+        tbuf, n = self._tbuf, self.n
+        if self._count:
+            d = t - tbuf[(i - 1) % n]
+            self._isum += d
+            self._isumsq += d * d
+        if self._count == n and n > 1:
+            # the oldest interval falls out of the history
+            d = tbuf[i + 1] - tbuf[i]
+            self._isum -= d
+            self._isumsq -= d * d
+        tbuf[i] = tbuf[i + n] = t
+
+    def _resum(self):
+        self._sum = float(self.view().sum())
+        if self._tbuf is not None:
+            intervals = np.diff(self.times())
+            self._isum = float(intervals.sum())
+            self._isumsq = float(intervals.dot(intervals))
+        self._nupdates = 0
+
+    def extend(self, xs, ts=None):
+        """Add an array of samples (taken at times `ts`) to the history in
+        one vectorized step.  Return an array of the samples that fell out
+        of the history, one per sample in `xs`, or None if the history
+        wasn't full yet"""
+        xs = np.asarray(xs, dtype=float)
+        n, k = self.n, len(xs)
+        if self._tbuf is not None:
+            if ts is None:
+                raise ValueError(
+                    "This history needs a timestamp for each sample")
+            ts = np.asarray(ts, dtype=float)
+        if not k:
+            return np.empty(0) if self.full else None
+        self._total += k
+        evicted = self.view()[:k].copy() if self.full and k <= n else None
+        if k >= n:
+            self._buf[:n] = self._buf[n:] = xs[-n:]
+            if ts is not None:
+                self._tbuf[:n] = self._tbuf[n:] = ts[-n:]
+            self._head = 0
+            self._count = n
+            self._resum()
+            return evicted
+        idxs = (self._head + np.arange(k)) % n
+        self._buf[idxs] = self._buf[idxs + n] = xs
+        if ts is not None:
+            self._tbuf[idxs] = self._tbuf[idxs + n] = ts
+        self._head = (self._head + k) % n
+        self._count = min(self._count + k, n)
+
+        self._nupdates += k
+        if self._nupdates >= n or evicted is None or ts is not None:
+            self._resum()
+        else:
+            self._sum += float(xs.sum() - evicted.sum())
+        return evicted
+
+    def _slice(self, buf):
+        if self._count == self.n:
+            rv = buf[self._head: self._head + self.n]
+        else:
+            rv = buf[:self._count]
+        rv.flags.writeable = False
+        return rv
+
+    def view(self):
+        """Return a read-only numpy view of the samples, oldest first.
+        The view is invalidated by the next call to `append`"""
+        return self._slice(self._buf)
+
+    def times(self):
+        """Return a read-only numpy view of the timestamps of the samples,
+        oldest first.  The view is invalidated by the next call to
+        `append`"""
+        if self._tbuf is None:
+            raise ValueError("This history doesn't keep timestamps")
+        return self._slice(self._tbuf)
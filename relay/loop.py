@@ -0,0 +1,328 @@
+"""
+The state and arithmetic of one Relay control loop, without any I/O.
+
+Runners (relay.runner, relay.fleet, ...) poll the metric and target, feed
+the values to a ControlLoop and pass the resulting MV to a warmer or cooler.
+"""
+from __future__ import division
+
+import numpy as np
+
+from relay import log
+from relay import controllers
+from relay import scheduling
+from relay import tuning
+from relay import util
+from relay.constants import RAMP_SHAPES
+from relay.history import ErrorHistory
+from relay.sampling import Resampler, Sampler
+
+# the shapes of ramp that ramp_weights supports
+RAMP_SHAPES
+
+
+def ramp_weights(ramp, shape='linear'):
+    """
+    The fraction of the error to add on each of `ramp` samples.  The
+    fractions are positive and sum to 1.
+
+    `shape`
+        linear - decreases linearly, ie 5, 4, 3, 2, 1 (/ 15)
+        exponential - decays exponentially, so most of the heat is added
+            over the first third of the ramp
+        scurve - starts and ends slowly, following the derivative of
+            smoothstep (3x^2 - 2x^3)
+    """
+    x = np.arange(ramp + 1) / ramp
+    if shape == 'linear':
+        w = np.arange(ramp, 0, -1, dtype=float)
+    elif shape == 'exponential':
+        w = np.exp(-5 * x[:-1])
+    elif shape == 'scurve':
+        w = np.diff(3 * x ** 2 - 2 * x ** 3)
+    else:
+        raise ValueError("Unrecognized ramp shape: %s" % shape)
+    return w / w.sum()
+
+
+def ramp_schedule(err, ramp, shape='linear'):
+    """
+    Return an array of `ramp` integer MVs that sum to exactly int(err),
+    distributed according to `ramp_weights(ramp, shape)`.
+
+    The cumulative sum of the MVs is the rounded cumulative sum of the
+    weights times the error, so rounding errors never accumulate.
+    """
+    total = int(err)
+    if ramp <= 1:
+        return np.array([total] * ramp, dtype=int)
+    cumulative = np.round(total * np.cumsum(ramp_weights(ramp, shape)))
+    cumulative[-1] = total
+    return np.diff(cumulative, prepend=0).astype(int)
+
+
+def create_ramp_plan(err, ramp, shape='linear'):
+    """
+    Formulate and execute on a plan to slowly add heat or cooling to the system
+
+    `err` initial error (PV - SP)
+    `ramp` the size of the ramp
+    `shape` one of RAMP_SHAPES.  See `ramp_weights`
+
+    A linear ramp plan yields MVs in this order at every timestep:
+        [5, 4, 3, 2, 1, 0, 0, ...]
+        where err == 5 + 4 + 3 + 2 + 1
+    """
+    log.info('Initializing a ramp plan', extra=dict(
+        ramp_size=ramp, err=err, shape=shape))
+    for MV in ramp_schedule(err, ramp, shape):
+        yield int(MV)
+    while True:
+        yield 0
+
+
+class ControlLoop(object):
+    """
+    Turn a stream of (SP, PV) pairs into a stream of MVs.
+
+    `lookback` the number of errors to remember
+    `ramp` add heat or cooling over the first `ramp` samples
+    `ramp_shape` how to spread the heat over the ramp.  See RAMP_SHAPES
+    `tuning_engine` name of the engine in relay.tuning.ENGINES that computes
+        the weight of the error history.  If None, the caller computes the
+        weight and passes it to `output(weight)`
+    `controller` (optional) computes the MV.  See relay.controllers.
+        Defaults to the fft_pi controller.  The tuning engine is only used
+        by controllers that use the weight
+    `name` (optional) identifies this loop in log messages
+    `sample_period` seconds between samples.  Needed to resample timestamped
+        batches (see relay.sampling) and when `resample` is set
+    `resample` (optional) one of relay.sampling.METHODS.  If set, the time
+        between ticks is assumed to be irregular: errors are recorded with
+        the time they were observed and resampled onto a grid of
+        `sample_period` seconds before they reach the error history.
+    `clock` returns the current (monotonic) time in seconds
+
+    SP and PV may be numbers or batches of samples, as described in
+    relay.sampling.  A batch of PVs is compared to a batch of SPs of the same
+    length or else to the latest SP.  Batches are already evenly spaced, so
+    they are never resampled again.
+
+    The error history keeps a timestamp for each sample.  `ticks` is the
+    history of errors as they were observed, which is the error history
+    itself unless `resample` is set.  Its achieved sample rate and jitter
+    are reported with every MV.
+    """
+    def __init__(self, lookback, ramp=1, tuning_engine=tuning.DEFAULT_ENGINE,
+                 name=None, sample_period=None, resample=None,
+                 clock=util.monotonic, ramp_shape='linear', controller=None):
+        self.name = name
+        self.ramp = ramp
+        self.ramp_shape = ramp_shape
+        self.clock = clock
+        self.sample_period = sample_period
+        self.controller = controller or controllers.FFTPIController()
+        self.controller_seconds = None
+        self.history = ErrorHistory(lookback, timestamps=True)
+        self.tuner = tuning_engine and self.controller.uses_weight and \
+            tuning.get_engine(tuning_engine, lookback)
+        if resample:
+            self.ticks = ErrorHistory(lookback, timestamps=True)
+            self._tick_resampler = Resampler(sample_period, resample)
+        else:
+            self.ticks = self.history
+            self._tick_resampler = None
+        self.ramp_index = 0
+        self.err = self.SP = self.PV = None
+        self.last_weight = None
+        self._sp_sampler = Sampler(sample_period)
+        self._pv_sampler = Sampler(sample_period)
+        self._plan = None  # the MVs of the rest of the ramp
+        self._plan_SP = None  # the SP the plan was made for
+        self._extra = dict(loop=name) if name is not None else {}
+
+    @classmethod
+    def from_ns(cls, ns, **kwargs):
+        """Build a ControlLoop from the relay command-line options"""
+        kwargs.setdefault('tuning_engine', ns.tuning_engine)
+        kwargs.setdefault('sample_period', ns.sample_period or ns.delay)
+        # an adaptive delay makes ticks irregular.  See relay.scheduling
+        kwargs.setdefault(
+            'resample',
+            ns.resample or ('linear' if scheduling.enabled(ns) else None))
+        kwargs.setdefault('ramp_shape', ns.ramp_shape)
+        kwargs.setdefault('controller', controllers.from_ns(ns))
+        return cls(ns.lookback, ns.ramp, **kwargs)
+
+    @property
+    def ramping(self):
+        return self.ramp_index < self.ramp
+
+    @property
+    def errors(self):
+        """The errors that stop conditions see.  See relay.stop_conditions"""
+        return self.history
+
+    def end_ramp(self):
+        """Skip the rest of the ramp, ie because another loop already
+        ramped up on behalf of this one"""
+        self.ramp_index = max(self.ramp_index, self.ramp)
+        self._plan = self._plan_SP = None
+
+    def push(self, SP, PV):
+        """Record new samples and return True.  Afterwards, if the loop is
+        still ramping, call `ramp_output()`.  Otherwise, call
+        `output(self.weight())`.
+
+        Return False if the plugins didn't yield any new samples"""
+        SP, PV = self._sp_sampler(SP), self._pv_sampler(PV)
+        if isinstance(SP, float) and isinstance(PV, float):
+            self.SP, self.PV = SP, PV
+            self.err = err = SP - PV
+            log.debug('got metric value', extra=dict(
+                PV=PV, SP=SP, **self._extra))
+            self._record(0 if self.ramping else err, self.clock())
+        elif not self._push_batch(np.atleast_1d(SP), np.atleast_1d(PV)):
+            return False
+        if self.ramping:
+            self._plan_ramp()
+        return True
+
+    def _plan_ramp(self):
+        """Plan the rest of the ramp from the current error, or, if the SP
+        changed since the last plan, spread the change over the rest of
+        the ramp in addition to the MV that is still planned"""
+        remaining = self.ramp - self.ramp_index
+        if self._plan is None:
+            err = self.err
+            log.info('Initializing a ramp plan', extra=dict(
+                ramp_size=remaining, err=err, shape=self.ramp_shape,
+                **self._extra))
+        elif self.SP != self._plan_SP:
+            err = self._plan.sum() + self.SP - self._plan_SP
+            log.debug('SP changed.  Re-planning the ramp', extra=dict(
+                ramp_size=remaining, err=err, **self._extra))
+        else:
+            return
+        self._plan = ramp_schedule(err, remaining, self.ramp_shape)
+        self._plan_SP = self.SP
+
+    def _push_batch(self, SP, PV):
+        """Push a batch of samples.  Return False if there were none"""
+        if len(SP):
+            self.SP = float(SP[-1])
+        if not len(PV) or self.SP is None:
+            return False
+        if len(SP) != len(PV):
+            SP = self.SP
+        errs = SP - PV
+        self.PV, self.err = float(PV[-1]), float(errs[-1])
+        log.debug('got metric value', extra=dict(
+            PV=self.PV, SP=self.SP, nsamples=len(PV), **self._extra))
+        samples = np.zeros(len(errs)) if self.ramping else errs
+        period = self.sample_period or 0
+        ts = self.clock() - period * np.arange(len(samples))[::-1]
+        if self.ticks is not self.history:
+            self.ticks.extend(samples, ts)
+        self._record_many(samples, ts)
+        return True
+
+    def _record(self, sample, t):
+        if self._tick_resampler is not None:
+            self.ticks.append(sample, t)
+            grid = self._tick_resampler(np.array([t]), np.array([sample]))
+            if len(grid) != 1:
+                self._record_many(
+                    grid, self._tick_resampler.grid_times(len(grid)))
+                return
+            sample, t = grid[0], self._tick_resampler.grid_times(1)[0]
+        evicted = self.history.append(sample, t)
+        if self.tuner:
+            self.tuner.push(sample, evicted)
+
+    def _record_many(self, samples, ts):
+        if not len(samples):
+            return
+        evicted = self.history.extend(samples, ts)
+        if self.tuner:
+            self.tuner.extend(samples, evicted)
+
+    def restore(self, buf, tbuf, head, count, ramp_index=0, last_weight=None):
+        """Replace the error history with the given buffers (see
+        ErrorHistory.from_buffers), ie to resume from a checkpoint.  If
+        the loop was still ramping, the rest of the ramp is planned again
+        from the next error"""
+        self.history = ErrorHistory.from_buffers(buf, tbuf, head, count)
+        if self._tick_resampler is None:
+            self.ticks = self.history
+        if self.tuner:
+            self.tuner.reset()
+        self.ramp_index = ramp_index
+        self.last_weight = last_weight
+        self._plan = self._plan_SP = None
+
+    def timing_stats(self):
+        """The achieved sample rate (in Hz) and the standard deviation of
+        the seconds between samples"""
+        return dict(sample_rate=self.ticks.sample_rate,
+                    jitter=self.ticks.jitter)
+
+    def ramp_output(self):
+        MV = int(self._plan[0])
+        self._plan = self._plan[1:]
+        self.ramp_index += 1
+        self.controller.observe(self, MV)
+        return MV
+
+    def weight(self):
+        return self.tuner.weight(self.history.view())
+
+    def spectrum(self):
+        """fft(errdata)[1: n // 2] of the error history.  The tuning
+        engine's, if it keeps one up to date"""
+        errdata = self.history.view()
+        if self.tuner:
+            return self.tuner.spectrum(errdata)
+        return np.fft.fft(errdata)[1: len(errdata) // 2]
+
+    def output(self, weight, pending=0, weight_seconds=0):
+        """Compute the MV of the fft_pi controller given the weight of the
+        error history.
+
+        `pending` MV that was requested on previous ticks but hasn't been
+            applied yet.  The metric doesn't reflect it, so it is subtracted
+            from the current error rather than requested a second time.
+        `weight_seconds` time spent computing the weight, ie this loop's
+            share of a batch.  It's logged as part of `controller_seconds`
+        """
+        start = util.perf_counter()
+        MV, data = controllers.fft_pi(self, weight, pending)
+        self.controller_seconds = \
+            weight_seconds + util.perf_counter() - start
+        return self.emit(MV, data)
+
+    def control(self, pending=0):
+        """Compute the MV with the loop's controller.  See `output`"""
+        start = util.perf_counter()
+        MV, data = self.controller.compute(self, pending)
+        self.controller_seconds = util.perf_counter() - start
+        return self.emit(MV, data)
+
+    def emit(self, MV, data):
+        """Log the MV computed by a controller and the `data` it was
+        computed from, and return it as an integer"""
+        MV = int(round(MV)) if np.isfinite(MV) else 0
+        self.controller.observe(self, MV)
+        log.info('data', extra=dict(
+            data=data, controller=self.controller.name,
+            controller_seconds=self.controller_seconds,
+            **dict(self._extra, **self.timing_stats())))
+        return MV
+
+    def update(self, SP, PV, pending=0):
+        """Record a new sample and return the MV"""
+        if not self.push(SP, PV):
+            return 0
+        if self.ramping:
+            return self.ramp_output()
+        return self.control(pending)
@@ -0,0 +1,80 @@
+"""
+The parsers of the relay commands.
+
+They only need relay.argparse_shared, so `python -m relay` parses the
+command-line (and answers --help or a mistyped option) before it imports the
+module that runs the command, which imports numpy & co.
+"""
+from relay import argparse_shared as at
+
+
+build_relay_arg_parser = at.build_arg_parser([
+    at.group(
+        "What is Relay optimizing?",
+        at.metric, at.target),
+    at.group(
+        "Share the metric between loops and relay processes",
+        at.metric_cache_ttl, at.metric_cache_scope, at.metric_cache_dir),
+    at.group(
+        "Instruct Relay how to heat or cool your metric",
+        at.warmer, at.cooler),
+    at.group(
+        "Control how Relay calls your warmer and cooler",
+        at.max_inflight, at.backpressure, at.actuation_window,
+        at.min_actuation_interval, at.max_step, at.deadband,
+        at.shell_timeout),
+    at.group(
+        "Some optional Relay parameters",
+        at.delay, at.min_delay, at.max_delay, at.lookback, at.ramp,
+        at.ramp_shape, at.gain_schedule,
+        at.sendstats,
+        at.telemetry, at.archive, at.archive_segment_size,
+        at.stop_condition, at.profile_startup,
+        at.log_async, at.log_debug_every, at.log_debug_rate,
+        at.checkpoint, at.checkpoint_interval, at.checkpoint_max_age,
+        at.coordinate, at.coordinate_bind, at.coordinate_peers,
+        at.coordinate_timeout,
+        at.sample_period, at.resample,
+        at.tuning_engine, at.asyncio),
+    at.group(
+        "Find out where the time of each tick goes",
+        at.profile_ticks, at.profile_window, at.profile_interval,
+        at.profile_sample_interval),
+    at.group(
+        "Choose and tune the controller that computes the MV",
+        at.controller, at.pid_kp, at.pid_ki, at.pid_kd, at.pid_windup,
+        at.mpc_horizon, at.mpc_max_dead_time),
+])
+
+
+build_fleet_arg_parser = at.build_arg_parser([
+    at.group(
+        "Run many Relay control loops in one process",
+        at.config, at.sendstats, at.telemetry,
+        at.log_async, at.log_debug_every, at.log_debug_rate),
+])
+
+
+build_simulate_arg_parser = at.build_arg_parser([
+    at.group(
+        "What should Relay simulate?",
+        at.trace, at.plant, at.target, at.ticks, at.output),
+    at.group(
+        "Parameters of the plant model",
+        at.plant_gain, at.plant_tau, at.plant_dead_time, at.plant_noise,
+        at.initial_pv, at.seed),
+    at.group(
+        "Relay parameters to simulate.  Comma separated lists of values"
+        " for --lookback, --ramp and --delay are swept",
+        at.lookback(type=at.csv_list(int), default=[1000]),
+        at.ramp(type=at.csv_list(int), default=[1]),
+        at.delay(type=at.csv_list(float), default=[1.]),
+        at.min_delay, at.max_delay, at.ramp_shape, at.tuning_engine,
+        at.sample_period, at.resample,
+        at.actuation_window, at.min_actuation_interval, at.max_step,
+        at.deadband),
+    at.group(
+        "The controller to simulate",
+        at.controller, at.pid_kp, at.pid_ki, at.pid_kd, at.pid_windup,
+        at.mpc_horizon, at.mpc_max_dead_time),
+])
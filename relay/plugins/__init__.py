@@ -14,6 +14,7 @@ In a distributed environment, Relay may help you to:
       the stream
 
 """
+from relay.stop_conditions import DivergenceRatio, StopCondition
 
 
 def warmer(n):
@@ -35,7 +36,9 @@ def metric():
 
     This function could, for instance, yield the current temperature
 
-    This function should be a generator.
+    This function should be a generator.  Each value it yields may also be
+    a batch of samples: a list of numbers, or a list of (timestamp, value)
+    pairs.  See relay.sampling
     """
     while True:
         yield 0
@@ -52,15 +55,21 @@ def target():
         yield 0
 
 
-def stop_condition(errdata):
-    """A stop condition is an optional function that
+class stop_condition(StopCondition):
+    """A stop condition is an optional plugin that
     determines whether Relay should exit.
 
-    The input is an array of the error history between the target and metric.
+    Relay creates one per control loop, passing the loop's lookback, and
+    calls update(err) with each error between the target and metric that
+    enters the error history.  Keep whatever counters you need on self.
     The output is -1 or an integer return code that gets passed to sys.exit(...)
       You should return -1 as long as you want Relay to continue operating
+
+    Functions of the whole error history (a read-only numpy array, oldest
+    sample first) still work too.  See relay.stop_conditions
     """
-    return -1
+    def update(self, err):
+        return -1
 
 
 ######
@@ -98,75 +107,80 @@ def squarewave_setpoint():
     return oscillating_setpoint(True)
 
 
-def bash_echo_metric():
-    """A very basic example that monitors
-    a number of currently running processes"""
-    import subprocess
-    # import random
-
-    # more predictable version of the metric
-    cmd = (
-        'set -o pipefail '
-        ' ; pgrep -f "^bash.*sleep .*from bash: started relay launcher"'
-        ' | wc -l '
-    )
+# the bash_echo_* plugins share one long-lived bash co-process (see
+# relay.plugins.shell).  The strings that pgrep looks for are split or
+# bracketed so the co-process's own command line never matches them
+BASH_ECHO_SCRIPT = r'''
+task="from bash: started relay"" launcher task"
+while read cmd n; do
+  case $cmd in
+    metric)
+      pgrep -f "^bash.*sleep .*from [b]ash: started relay launcher" | wc -l
+      ;;
+    warmer)
+      for i in $(seq $n); do
+        delay=1.$((RANDOM % 1000))
+        length=$((4 + RANDOM % 4)).$((RANDOM % 1000))
+        bash -c "sleep $delay ; sh -c 'echo $task && sleep $length'" \
+          </dev/null >/dev/null 2>&1 &
+      done
+      echo ok
+      ;;
+    cooler)
+      tasks=$(pgrep -f "from [b]ash: started relay launcher task" | tail -n $n)
+      kill $tasks 2>/dev/null
+      echo ok
+      ;;
+  esac
+done
+'''
+_bash_echo = []
+
+
+def _bash_echo_worker():
+    if not _bash_echo:
+        from relay.plugins.shell import ShellWorker
+        _bash_echo.append(ShellWorker(BASH_ECHO_SCRIPT))
+    return _bash_echo[0]
 
-    # less predictable version of the metric
-    # cmd = 'ps aux|wc -l'
 
+def bash_echo_metric():
+    """A very basic example that monitors
+    a number of currently running processes.  Relays that watch the same
+    tasks can share one pgrep scan with --metric_cache_ttl"""
+    worker = _bash_echo_worker()
     while True:
-        yield (
-            int(subprocess.check_output(cmd, shell=True, executable='bash'))
-            # + random.choice([-2, -1, 0, 1, 2, 3, 4, 5, 6, 7, 8])
-        )
+        yield int(worker.call('metric'))
 
 
 def bash_echo_warmer(n):
     """A very basic example of how to create n additional tasks.
     This is a warmer function with randomly delayed effects on the
     bash_echo_metric and random task lengths to make the metric less
-    predictable
+    predictable.  All n tasks are started by one call to the co-process
     """
-    import subprocess
-    import random
-    cmd = (
-        'set -o pipefail '
-        " ; sleep %s "
-        " ; sh -c 'echo from bash: started relay launcher task && sleep %s'"
-    )
-    for i in range(n):
-        subprocess.Popen(
-            cmd % ((1 + random.random()) * 1, (1 + random.random()) * 4),
-            shell=True, stdout=subprocess.PIPE, executable='bash')
+    _bash_echo_worker().call('warmer %s' % n)
 
 
 def bash_echo_cooler(n):
     """A very basic example of how to destroy n running tasks
     This is a cooler function
     """
-    import subprocess
-    cmd = (
-        'set -o pipefile '
-        ' ; kill `pgrep -f "from bash: started relay launcher task"'
-        ' | tail -n %s` 2>/dev/null' % n)
-    subprocess.Popen(cmd, shell=True, executable='bash').wait()
+    _bash_echo_worker().call('cooler %s' % n)
 
 
-def stop_if_mostly_diverging(errdata):
+class stop_if_mostly_diverging(DivergenceRatio):
     """This is an example stop condition that asks Relay to quit if
     the error difference between consecutive samples is increasing more than
     half of the time.
 
     It's quite sensitive and designed for the demo, so you probably shouldn't
     use this is a production setting
+
+    It counts the increases among the last `lookback` samples as they
+    arrive, so each tick costs the same however long the history is.  If most
+    of the time, the next sample is worse than the previous sample, relay is
+    not healthy and it returns 0.  Otherwise, relay is in a healthy state and
+    it returns -1
     """
-    n_increases = sum([
-        abs(y) - abs(x) > 0 for x, y in zip(errdata, errdata[1:])])
-    if len(errdata) * 0.5 < n_increases:
-        # most of the time, the next sample is worse than the previous sample
-        # relay is not healthy
-        return 0
-    else:
-        # most of the time, the next sample is better than the previous sample
-        # realy is in a healthy state
-        return -1
+    ratio = 0.5
@@ -0,0 +1,202 @@
+"""
+Share a metric between control loops, and between relay processes on the
+same host, so that polling it costs one query per --metric_cache_ttl
+seconds however many loops read it.  Enable it with:
+
+    relay --metric mycode.queue_depth --metric_cache_ttl 5 ...
+
+Loops whose metric has the same import path (or the same shell: command)
+read the same cached value.  When the value is older than the TTL, the
+first loop to poll it queries the metric (ie advances its generator), and
+the others wait for that value instead of querying the backend too.
+
+    --metric_cache_scope process - loops in this process share the value
+        (ie the loops of a `relay fleet`)
+    --metric_cache_scope host - (default) relay processes on this host share
+        it too, through a file per metric in --metric_cache_dir, which is
+        in shared memory (/dev/shm) where there is one.  Processes take
+        turns with a lock file, so only one of them queries the metric per
+        TTL
+
+A value is reused for as long as it's fresh, so a loop that polls more often
+than the TTL sees the same value again.  A batch of samples (see
+relay.sampling) is only given to each loop once: until the next query, the
+loop gets an empty batch, ie no new samples.
+
+Metrics with the same import path are assumed to be the same source, so
+give relays that run different code under the same import path different
+--metric_cache_dir.  Async metrics (see relay.aio) aren't supported.
+"""
+from __future__ import division
+
+import hashlib
+import json
+import numbers
+import os
+import tempfile
+import threading
+import time
+
+from relay import log
+from relay.constants import (
+    METRIC_CACHE_SCOPES, DEFAULT_METRIC_CACHE_SCOPE)
+
+try:
+    import fcntl
+except ImportError:  # ie windows.  Only share metrics within a process
+    fcntl = None
+
+SCOPES = METRIC_CACHE_SCOPES
+DEFAULT_SCOPE = DEFAULT_METRIC_CACHE_SCOPE
+DEFAULT_DIR = os.path.join(
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+    'relay-metrics')
+_sources = {}  # (key, path): MetricSource
+_sources_lock = threading.Lock()
+
+
+def source_key(plugin):
+    """What identifies the metric `plugin` across loops and processes"""
+    command = getattr(plugin, 'command', None)
+    if command is not None:  # see relay.plugins.shell
+        return 'shell:%s#%s' % (command, plugin.kind)
+    return '%s.%s' % (
+        plugin.__module__, getattr(plugin, '__qualname__', plugin.__name__))
+
+
+def _tolist(obj):
+    """Serialize numpy arrays and scalars in json"""
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    raise TypeError("%r is not JSON serializable" % (obj, ))
+
+
+class MetricSource(object):
+    """
+    One metric, polled on behalf of every loop in this process that reads
+    it.
+
+    `key` identifies the metric.  See source_key
+    `plugin` the metric plugin.  It's called once, and its generator is
+        advanced each time the value is refreshed
+    `path` (optional) a file to share the value with other processes
+    `clock` returns the current (wall clock) time in seconds
+    """
+    def __init__(self, key, plugin, path=None, clock=time.time):
+        self.key = key
+        self.plugin = plugin
+        self.path = path
+        self.clock = clock
+        self.queries = 0  # times this process queried the metric
+        self._it = None
+        self._lock = threading.Lock()
+        self._t = self._seq = self._value = None
+
+    def get(self, ttl):
+        """Return (sequence number, value) of the metric, querying it if
+        the value is older than `ttl` seconds.  The sequence number changes
+        each time the metric is queried"""
+        with self._lock:
+            if not self._fresh(self._t, ttl):
+                if self.path:
+                    record = self._refresh_shared(ttl)
+                else:
+                    record = self._query(self._seq or 0)
+                self._t, self._seq, self._value = \
+                    record['t'], record['seq'], record['value']
+            return self._seq, self._value
+
+    def _fresh(self, t, ttl):
+        return t is not None and self.clock() - t < ttl
+
+    def _query(self, seq):
+        if self._it is None:
+            self._it = self.plugin()
+        value = next(self._it)
+        self.queries += 1
+        return dict(t=self.clock(), seq=seq + 1, value=value)
+
+    def _refresh_shared(self, ttl):
+        record = self._read()
+        if record is not None and self._fresh(record['t'], ttl):
+            return record
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # until the file is closed
+            # another process may have queried it while we waited
+            record = self._read()
+            if record is not None and self._fresh(record['t'], ttl):
+                return record
+            record = self._query(record['seq'] if record else 0)
+            self._write(record)
+        return record
+
+    def _read(self):
+        try:
+            with open(self.path) as fp:
+                return json.load(fp)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write(self, record):
+        tmp = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(tmp, 'w') as fp:
+            json.dump(record, fp, default=_tolist)
+        os.rename(tmp, self.path)  # readers never see a partial file
+
+
+def _shared_path(key, directory):
+    """The file that shares the metric `key` between processes, or None if
+    it can't be shared"""
+    if fcntl is None:
+        return None
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    except OSError:
+        pass  # another process may have just created it
+    if not os.access(directory, os.W_OK):
+        log.warn(
+            "Can't share the metric cache with other processes."
+            "  Sharing it within this process only", extra=dict(
+                metric_cache_dir=directory))
+        return None
+    name = hashlib.sha1(key.encode('utf8')).hexdigest()
+    return os.path.join(directory, name + '.json')
+
+
+def get_source(plugin, scope=DEFAULT_SCOPE, directory=DEFAULT_DIR):
+    """The MetricSource of `plugin` that every loop of this process shares"""
+    key = source_key(plugin)
+    directory = directory or DEFAULT_DIR
+    path = _shared_path(key, directory) if scope == 'host' else None
+    with _sources_lock:
+        if (key, path) not in _sources:
+            _sources[(key, path)] = MetricSource(key, plugin, path)
+        return _sources[(key, path)]
+
+
+def cached(plugin, ttl, scope=DEFAULT_SCOPE, directory=DEFAULT_DIR):
+    """
+    Return a metric plugin that reads `plugin` through its shared
+    MetricSource, querying it at most once every `ttl` seconds.
+
+    `scope` one of SCOPES
+    `directory` where processes share metrics, if `scope` is 'host'.
+        Defaults to DEFAULT_DIR
+    """
+    source = get_source(plugin, scope, directory)
+
+    def cached_metric():
+        seen = None
+        while True:
+            try:
+                seq, value = source.get(ttl)
+            except StopIteration:
+                return
+            if seq == seen and not isinstance(value, numbers.Number):
+                yield []  # this loop already got this batch
+                continue
+            seen = seq
+            yield value
+    cached_metric.source = source
+    return cached_metric
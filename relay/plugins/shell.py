@@ -0,0 +1,171 @@
+"""
+Shell plugins: write a metric, target, warmer or cooler in bash (or any
+language) instead of python.
+
+    relay --metric shell:./myplugin.sh --warmer shell:./myplugin.sh ...
+
+Relay starts the command once, as a long-lived co-process, and talks to it
+with one line per call on its stdin and stdout:
+
+    Relay writes          the co-process replies with
+    ------------          ---------------------------
+    metric                the metric's current value.  Several
+                              space-separated values are a batch (see
+                              relay.sampling)
+    target                the target's current value
+    warmer <n>            any line, once it has added n units of heat
+    cooler <n>            any line, once it has removed n units of heat
+
+For instance:
+
+    while read cmd n; do
+      case $cmd in
+        metric) pgrep -f my_worker | wc -l ;;
+        warmer) for i in $(seq $n); do ./my_worker & done ; echo ok ;;
+        cooler) pkill -n -f my_worker ; echo ok ;;
+      esac
+    done
+
+A warmer or cooler gets the whole MV in one call, rather than one call per
+unit of MV.  If the co-process doesn't reply within --shell_timeout
+seconds, it is killed, the call fails with a ShellPluginError and the
+co-process is started again on the next call.  Plugins with the same command
+share one co-process, which answers one call at a time, so a script can keep
+its state (ie the metric can count the tasks that its warmer started).
+"""
+from __future__ import division
+
+import atexit
+import os
+import select
+import subprocess
+import threading
+
+from relay import util
+from relay.constants import DEFAULT_SHELL_TIMEOUT, SHELL_PREFIX
+
+DEFAULT_TIMEOUT = DEFAULT_SHELL_TIMEOUT
+PREFIX = SHELL_PREFIX
+_workers = {}  # command: ShellWorker
+
+
+class ShellPluginError(Exception):
+    pass
+
+
+class ShellWorker(object):
+    """
+    A long-lived co-process that answers one line with one line.
+
+    `command` a bash command that reads requests from stdin
+    `timeout` seconds to wait for each reply
+    """
+    def __init__(self, command, timeout=DEFAULT_TIMEOUT):
+        self.command = command
+        self.timeout = timeout
+        self._proc = None
+        self._buf = b''
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _start(self):
+        self._proc = subprocess.Popen(
+            self.command, shell=True, executable='bash',
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+        self._buf = b''
+
+    def call(self, line):
+        """Send a line to the co-process and return its reply, without the
+        trailing newline"""
+        with self._lock:
+            if self._proc is None or self._proc.poll() is not None:
+                self._start()
+            try:
+                self._proc.stdin.write(line.encode('utf8') + b'\n')
+                return self._readline().decode('utf8')
+            except (IOError, OSError) as err:
+                self._kill()
+                raise ShellPluginError(
+                    "shell plugin %r failed: %s" % (self.command, err))
+
+    def _readline(self):
+        deadline = util.monotonic() + self.timeout
+        fd = self._proc.stdout.fileno()
+        while b'\n' not in self._buf:
+            remaining = deadline - util.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                self._kill()
+                raise ShellPluginError(
+                    "shell plugin %r didn't reply within %s seconds"
+                    % (self.command, self.timeout))
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                self._kill()
+                raise ShellPluginError(
+                    "shell plugin %r exited" % self.command)
+            self._buf += chunk
+        line, self._buf = self._buf.split(b'\n', 1)
+        return line
+
+    def _kill(self):
+        # tasks that the co-process started in the background keep running
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.kill()
+            self._proc.wait()
+        self._proc = None
+
+    def close(self):
+        with self._lock:
+            self._kill()
+
+
+def parse_values(reply):
+    """A number, or a list of numbers (a batch), from a reply"""
+    values = [float(x) for x in reply.split()]
+    if not values:
+        raise ShellPluginError("shell plugin replied with an empty line")
+    return values[0] if len(values) == 1 else values
+
+
+def get_worker(command):
+    """The ShellWorker that every plugin with this command shares"""
+    if command not in _workers:
+        _workers[command] = ShellWorker(command)
+    return _workers[command]
+
+
+class ShellStream(object):
+    """A metric or target plugin.  Calling it returns a generator"""
+    def __init__(self, kind, command):
+        self.kind = kind
+        self.command = command
+        self.worker = get_worker(command)
+
+    def __call__(self):
+        while True:
+            yield parse_values(self.worker.call(self.kind))
+
+
+class ShellActuator(object):
+    """A warmer or cooler plugin"""
+    def __init__(self, kind, command):
+        self.kind = kind
+        self.worker = get_worker(command)
+
+    def __call__(self, n):
+        self.worker.call('%s %s' % (self.kind, n))
+
+
+def load(kind, spec):
+    """Return the `kind` of plugin (metric, target, warmer or cooler) that
+    a 'shell:<command>' spec defines"""
+    command = spec[len(PREFIX):]
+    if kind in ('metric', 'target'):
+        return ShellStream(kind, command)
+    return ShellActuator(kind, command)
+
+
+def set_timeout(plugin, timeout):
+    """Set the timeout of a shell plugin.  Other plugins are ignored"""
+    if isinstance(plugin, (ShellStream, ShellActuator)):
+        plugin.worker.timeout = timeout
@@ -0,0 +1,230 @@
+"""
+Find out where the time of each tick goes.  Enable it with
+`relay --profile_ticks`.
+
+Every tick is split into phases (see relay.runner.PHASES), ie polling the
+target, polling the metric, computing the MV and calling the actuators.
+Each phase is timed with a monotonic clock, and the last --profile_window
+ticks are kept to compute rolling percentiles.  The time spent in log
+handlers is also reported on its own, as `log`, although it's included in
+the phase that logged.  A tick overruns when its phases take longer than
+--delay.
+
+Every --profile_interval seconds, the percentiles are logged as
+'tick timing', which --sendstats publishes like any other log message.
+Signals:
+
+    SIGUSR1 - log 'tick timing' now, with the phase that is running.  This
+        helps to find out where a stuck Relay is stuck
+    SIGUSR2 - start a sampling profiler.  The next SIGUSR2 stops it and logs
+        the functions it found running most often as 'sampling profile'
+
+When --profile_ticks isn't given, the runner gets a NullTickTimer, whose
+methods do nothing.
+"""
+from __future__ import division
+
+from collections import Counter
+import logging
+import signal
+import sys
+import threading
+
+import numpy as np
+
+from relay import log
+from relay import util
+
+PERCENTILES = (50, 90, 99)
+
+
+class NullTickTimer(object):
+    """A TickTimer that doesn't time anything"""
+    def start(self):
+        pass
+
+    def mark(self, phase):
+        pass
+
+    def end(self):
+        pass
+
+
+class TickTimer(object):
+    """
+    Time the phases of every tick.  Call `start()` when a tick begins,
+    `mark(phase)` when each phase ends and `end()` when the tick's work is
+    done.
+
+    `phases` the names of the phases, in the order they run
+    `budget` a tick overruns if its phases take longer than this many seconds
+    `window` compute percentiles over this many of the most recent ticks
+    `interval` seconds between reports
+    `clock` returns the current (monotonic) time in seconds
+    """
+    def __init__(self, phases, budget, window=1000, interval=60,
+                 clock=util.perf_counter):
+        self.phases = tuple(phases)
+        self.columns = self.phases + ('log', 'total')
+        self._index = {k: i for i, k in enumerate(self.phases)}
+        self.budget = budget
+        self.window = window
+        self.interval = interval
+        self.clock = clock
+        self._samples = np.full((window, len(self.columns)), np.nan)
+        self._row = None
+        self.ticks = 0
+        self.overruns = 0
+        self.log_seconds = 0.  # in log handlers, during this tick
+        self.phase = None  # that is running now
+        self._next_report = clock() + interval
+
+    @classmethod
+    def from_ns(cls, ns, phases):
+        """Return a TickTimer, or a NullTickTimer, as requested on the
+        command-line"""
+        if not getattr(ns, 'profile_ticks', False):
+            return NullTickTimer()
+        return cls(phases, ns.delay, ns.profile_window, ns.profile_interval)
+
+    def start(self):
+        self._row = [np.nan] * len(self.columns)
+        self.log_seconds = 0.
+        self.phase = self.phases[0]
+        self._t0 = self._t = self.clock()
+
+    def mark(self, phase):
+        now = self.clock()
+        i = self._index[phase]
+        self._row[i] = now - self._t
+        self._t = now
+        self.phase = self.phases[i + 1] if i + 1 < len(self.phases) else None
+
+    def end(self):
+        now = self.clock()
+        total = now - self._t0
+        self._row[-2] = self.log_seconds
+        self._row[-1] = total
+        self._samples[self.ticks % self.window] = self._row
+        self.ticks += 1
+        self.phase = None
+        if total > self.budget:
+            self.overruns += 1
+        if now >= self._next_report:
+            self._next_report = now + self.interval
+            self.report()
+
+    def stats(self):
+        """Percentiles of the seconds each phase took over the window"""
+        data = self._samples[:min(self.ticks, self.window)]
+        phases = {}
+        if len(data):
+            with np.errstate(invalid='ignore'):
+                pct = np.nanpercentile(data, PERCENTILES, axis=0)
+                worst = np.nanmax(data, axis=0)
+            for j, name in enumerate(self.columns):
+                phases[name] = dict(
+                    ('p%s' % p, float(pct[k, j]))
+                    for k, p in enumerate(PERCENTILES))
+                phases[name]['max'] = float(worst[j])
+        return dict(ticks=self.ticks, overruns=self.overruns,
+                    budget_seconds=self.budget, phase_seconds=phases)
+
+    def report(self):
+        log.info('tick timing', extra=dict(
+            running_phase=self.phase, **self.stats()))
+
+
+class _TimedHandler(logging.Handler):
+    """Time a log handler and add the time to a TickTimer"""
+    def __init__(self, handler, timer):
+        super(_TimedHandler, self).__init__(handler.level)
+        self.handler = handler
+        self.timer = timer
+
+    def handle(self, record):
+        t = self.timer.clock()
+        rv = self.handler.handle(record)
+        self.timer.log_seconds += self.timer.clock() - t
+        return rv
+
+
+def time_log_handlers(timer, log=log):
+    """Add the time spent in the handlers of `log` to `timer`.  Call this
+    after all handlers were added"""
+    log.handlers = [_TimedHandler(h, timer) for h in log.handlers]
+
+
+class SamplingProfiler(object):
+    """
+    Every `interval` seconds, look at what a thread is running.  Count the
+    line it's on (self) and every function on its stack (cumulative).
+
+    `thread_id` the thread to profile.  Defaults to the calling thread
+    `top` how many functions to report
+    """
+    def __init__(self, thread_id=None, interval=0.005, top=15):
+        self.thread_id = thread_id or threading.current_thread().ident
+        self.interval = interval
+        self.top = top
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        self.samples = 0
+        self.self_counts = Counter()
+        self.cumulative_counts = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name='relay-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            code = frame.f_code
+            self.self_counts['%s:%s %s' % (
+                code.co_filename, frame.f_lineno, code.co_name)] += 1
+            seen = set()
+            while frame is not None:
+                code = frame.f_code
+                key = '%s:%s %s' % (
+                    code.co_filename, code.co_firstlineno, code.co_name)
+                if key not in seen:
+                    seen.add(key)
+                    self.cumulative_counts[key] += 1
+                frame = frame.f_back
+
+    def stop(self):
+        """Stop profiling and return the most common lines and functions"""
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        return dict(
+            samples=self.samples, interval_seconds=self.interval,
+            self=self.self_counts.most_common(self.top),
+            cumulative=self.cumulative_counts.most_common(self.top))
+
+    def toggle(self):
+        if self.running:
+            log.info('sampling profile', extra=self.stop())
+        else:
+            log.info('starting the sampling profiler', extra=dict(
+                interval_seconds=self.interval))
+            self.start()
+
+
+def install_signal_handlers(timer, profiler):
+    """Dump `timer` on SIGUSR1 and toggle `profiler` on SIGUSR2"""
+    if not hasattr(signal, 'SIGUSR1'):  # ie windows
+        log.warn("This platform doesn't support SIGUSR1 and SIGUSR2")
+        return
+    signal.signal(signal.SIGUSR1, lambda signum, frame: timer.report())
+    signal.signal(signal.SIGUSR2, lambda signum, frame: profiler.toggle())
@@ -1,7 +1,58 @@
-import logging
+import atexit
+from collections import defaultdict
+import copy
 import json
-from colorlog import ColoredFormatter
+import logging
+try:
+    from logging.handlers import QueueHandler, QueueListener
+    from queue import Full, Queue
+except ImportError:  # python 2
+    QueueHandler = QueueListener = None
+
 from relay import log
+from relay import util
+
+# the attributes every LogRecord has, or gets when it is formatted.
+# Anything else was passed via `extra`
+_RECORD_KEYS = frozenset(logging.makeLogRecord({}).__dict__).union(
+    ['message', 'asctime'])
+
+
+class JSONFormatter(logging.Formatter):
+    """Format the message and the extra data of a record as a line of json,
+    rather than every attribute of the LogRecord"""
+    def format(self, record):
+        data = dict(
+            (k, v) for k, v in record.__dict__.items()
+            if k not in _RECORD_KEYS)
+        data.update(
+            msg=record.getMessage(), levelname=record.levelname,
+            name=record.name, created=record.created)
+        return json.dumps(data, default=str)
+
+
+class ColoredJsonFormatter(logging.Formatter):
+    """Append the extra data of a record to its message, ie
+        log.info('msg', extra=dict(a=1))
+        generates  'msg    a=1'
+    The record itself isn't modified, so other handlers see it unchanged.
+
+    Accepts the arguments of colorlog.ColoredFormatter, which does the
+    coloring.  colorlog is imported when the first formatter is created
+    rather than when Relay is imported"""
+    def __init__(self, *args, **kwargs):
+        from colorlog import ColoredFormatter
+        super(ColoredJsonFormatter, self).__init__()
+        self._colored = ColoredFormatter(*args, **kwargs)
+
+    def format(self, record):
+        extras = ' '.join(
+            "%s=%s" % (k, v) for k, v in record.__dict__.items()
+            if k not in _RECORD_KEYS)
+        if extras:
+            record = copy.copy(record)
+            record.msg = "%s    %s" % (record.msg, extras)
+        return self._colored.format(record)
 
 
 def configure_logging(add_handler, log=log):
@@ -16,20 +67,6 @@ def configure_logging(add_handler, log=log):
         if False, do not add any handlers.
         if given a handler instance, add that the the logger
     """
-    _ignore_log_keys = set(logging.makeLogRecord({}).__dict__)
-
-    def _json_format(record):
-        extras = ' '.join(
-            "%s=%s" % (k, record.__dict__[k])
-            for k in set(record.__dict__).difference(_ignore_log_keys))
-        if extras:
-            record.msg = "%s    %s" % (record.msg, extras)
-        return record
-
-    class ColoredJsonFormatter(ColoredFormatter):
-        def format(self, record):
-            record = _json_format(record)
-            return super(ColoredJsonFormatter, self).format(record)
     if isinstance(add_handler, logging.Handler):
         log.addHandler(add_handler)
     elif add_handler is True:
@@ -47,12 +84,91 @@ def configure_logging(add_handler, log=log):
     return log
 
 
+class DebugSampler(logging.Filter):
+    """
+    Thin out debug records, which Relay logs on every tick.  Records of
+    other levels always pass.
+
+    `every` keep only 1 in every `every` debug records with the same message
+    `max_rate` (optional) keep at most this many debug records per second
+        with the same message
+    `clock` returns the current (monotonic) time in seconds
+    """
+    def __init__(self, every=1, max_rate=None, clock=util.monotonic):
+        super(DebugSampler, self).__init__()
+        self.every = every
+        self.max_rate = max_rate
+        self.clock = clock
+        self.dropped = 0
+        self._counts = defaultdict(int)
+        self._allowance = {}  # msg: (tokens, time they were counted)
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        keep = self._sample(record.msg) and self._rate_limit(record.msg)
+        if not keep:
+            self.dropped += 1
+        return keep
+
+    def _sample(self, msg):
+        if self.every <= 1:
+            return True
+        self._counts[msg] += 1
+        return self._counts[msg] % self.every == 1
+
+    def _rate_limit(self, msg):
+        if not self.max_rate:
+            return True
+        now = self.clock()
+        tokens, t = self._allowance.get(msg, (self.max_rate, now))
+        tokens = min(self.max_rate, tokens + (now - t) * self.max_rate)
+        if tokens < 1:
+            self._allowance[msg] = (tokens, now)
+            return False
+        self._allowance[msg] = (tokens - 1, now)
+        return True
+
+
+def start_async_logging(log=log, maxsize=10000):
+    """
+    Move the handlers of `log` to a background thread, so formatting and
+    writing log records never blocks the caller.  Records are passed to the
+    thread through a queue of `maxsize` records and dropped if it is full.
+    The queue is flushed when the process exits.
+
+    Return the logging.handlers.QueueListener, or None if this version of
+    Python doesn't support it.
+    """
+    if QueueHandler is None:
+        log.warn("Async logging needs Python 3.  Logging synchronously")
+        return
+
+    class DroppingQueueHandler(QueueHandler):
+        """Drop records rather than block on a full queue"""
+        dropped = 0
+
+        def enqueue(self, record):
+            try:
+                self.queue.put_nowait(record)
+            except Full:
+                self.dropped += 1
+
+    q = Queue(maxsize)
+    listener = QueueListener(q, *log.handlers, respect_handler_level=True)
+    log.handlers = [DroppingQueueHandler(q)]
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
 def add_zmq_log_handler(address):
     import zmq.log.handlers
 
     class JSONPubHandler(zmq.log.handlers.PUBHandler):
-        def format(self, record):
-            return json.dumps(record.__dict__)
+        """Publish the message and the extra data of a record.  See
+        JSONFormatter"""
+        format = JSONFormatter().format
 
     sock = zmq.Context().socket(zmq.PUB)
     sock.connect(address)
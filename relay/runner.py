@@ -1,17 +1,39 @@
 from __future__ import division
 
-from collections import deque
-import numpy as np
 import os
 from os.path import abspath, dirname, join
+import signal
 import subprocess
 import sys
 import time
-import threading
 
 from relay import log, configure_logging, add_zmq_log_handler
+from relay import relay_logging
 from relay import util
-from relay import argparse_shared as at
+from relay import stop_conditions
+from relay import tuning
+from relay.actuators import Actuator, ActuationShaper
+from relay.archive import ArchiveWriter
+from relay.checkpoint import Checkpointer
+from relay.coordination import Coordinator
+from relay.gain_scheduling import GainScheduledLoop, InvalidGainSchedule
+from relay.loop import ControlLoop, create_ramp_plan
+from relay.parsers import build_relay_arg_parser
+from relay.plugins import cache
+from relay.plugins import shell
+from relay.profiling import (
+    TickTimer, SamplingProfiler, install_signal_handlers, time_log_handlers)
+from relay.scheduling import AdaptiveDelay
+from relay.telemetry import TelemetryPublisher
+
+# expose code that now lives in relay.tuning, relay.loop and relay.parsers
+calc_weight = tuning.calc_weight
+create_ramp_plan
+build_arg_parser = build_relay_arg_parser
+
+# the phases of a tick that --profile_ticks times, in order
+PHASES = (
+    'target', 'metric', 'compute', 'actuate', 'publish', 'stop_condition')
 
 
 def start_webui():
@@ -22,85 +44,6 @@ def start_webui():
         preexec_fn=os.setsid)  # guarantee that the child process exits with me
 
 
-@util.coroutine
-def window(n, initial_data=()):
-    win = deque(initial_data, n)
-    while 1:
-        win.append((yield win))
-
-
-def calc_weight(errdata):
-    sp = np.fft.fft(errdata)[1: len(errdata) // 2]
-    if sp.sum() == 0:  # there is no variation in the signal
-        log.warn('no variation in the signal.  fft cannot continue')
-        return 1
-
-    # get the phase in radians  # -np.pi < phase <= +np.pi
-    phase = np.angle(sp)  # radians
-
-    # find the amplitude integral of neighboring samples.
-    # search <360 degrees to left of most recent sample's phase
-    # p_k = phase - degrees_between_samples * k  # kth phase
-    amplitude_integrals = np.abs(np.sin(phase))  # iteratively updated
-    # samples per cycle
-    kth = len(errdata) / np.arange(1, len(errdata) // 2)
-    num_degrees_between_samples = 2 * np.pi / kth
-    p_k = phase.copy()
-    while (kth > 0).any():
-        # find amplitude of a sign wave at specific phase
-        p_k -= num_degrees_between_samples
-        amplitude_integrals += np.abs(np.sin(p_k))
-        kth -= 1
-        idxs = kth > 0
-        not_idxs = ~idxs
-        kth = kth[idxs]
-        p_k[not_idxs] = 0
-        num_degrees_between_samples[not_idxs] = 0
-
-    # get the amplitude of each frequency in the fft spectrum
-    amplitude = np.abs(sp)
-    return (
-        # np.sin(phase)
-        (np.sin(phase) / amplitude_integrals)
-        * (amplitude / amplitude.sum())
-    ).sum()
-
-
-def create_ramp_plan(err, ramp):
-    """
-    Formulate and execute on a plan to slowly add heat or cooling to the system
-
-    `err` initial error (PV - SP)
-    `ramp` the size of the ramp
-
-    A ramp plan might yield MVs in this order at every timestep:
-        [5, 0, 4, 0, 3, 0, 2, 0, 1]
-        where err == 5 + 4 + 3 + 2 + 1
-    """
-    if ramp == 1:  # basecase
-        yield int(err)
-        while True:
-            yield 0
-    # np.arange(n).sum() == err
-    # --> solve for n
-    # err = (n - 1) * (n // 2) == .5 * n**2 - .5 * n
-    # 0 = n**2 - n  --> solve for n
-    n = np.abs(np.roots([.5, -.5, 0]).max())
-    niter = int(ramp // (2 * n))  # 2 means add all MV in first half of ramp
-    MV = n
-    log.info('Initializing a ramp plan', extra=dict(
-        ramp_size=ramp, err=err, niter=niter))
-    for x in range(int(n)):
-        budget = MV
-        for x in range(niter):
-            budget -= MV // niter
-            yield int(np.sign(err) * (MV // niter))
-        yield int(budget * np.sign(err))
-        MV -= 1
-    while True:
-        yield 0
-
-
 def validate_ns_or_sysexit(ns):
     ex = 0
     if None in [ns.target, ns.metric]:
@@ -109,88 +52,235 @@ def validate_ns_or_sysexit(ns):
     if ns.warmer is None and ns.cooler is None:
         log.error("you must define either a --warmer or a --cooler!")
         ex = 1
+    if ns.coordinate and not ns.coordinate_bind:
+        log.error("--coordinate needs a --coordinate_bind address")
+        ex = 1
+    if (ns.min_delay or ns.delay) > (ns.max_delay or ns.delay):
+        log.error("--min_delay must not exceed --max_delay (or --delay)")
+        ex = 1
+    if ns.metric_cache_ttl and util.is_async_plugin(ns.metric):
+        log.error("--metric_cache_ttl doesn't support async metrics")
+        ex = 1
+    if ns.gain_schedule and ns.checkpoint:
+        log.error("--checkpoint doesn't support a --gain_schedule yet")
+        ex = 1
+    if not ns.asyncio:
+        for k in ['metric', 'target', 'warmer', 'cooler', 'stop_condition']:
+            if util.is_async_plugin(getattr(ns, k)):
+                log.error(
+                    "--%s is an async plugin.  Run relay with --asyncio" % k)
+                ex = 1
     if ex:
         build_arg_parser().print_usage()
         sys.exit(1)
 
 
-def evaluate_stop_condition(errdata, stop_condition):
+def check_stop_condition(errdata, stop_condition):
     """
     Call the user-defined function: stop_condition(errdata)
-    If the function returns -1, do nothing.  Otherwise, sys.exit.
+    Return None if Relay should keep going, or the function's return code.
+
+    `errdata` is passed to the function as is (ie a read-only numpy view
+    of the error history), so don't copy it here.
     """
     if stop_condition:
-        return_code = stop_condition(list(errdata))
+        return_code = stop_condition(errdata)
         if return_code != -1:
-            log.info(
-                'Stop condition triggered!  Relay is terminating.',
-                extra=dict(return_code=return_code))
-            sys.exit(return_code)
+            return return_code
 
 
-def main(ns):
-    validate_ns_or_sysexit(ns)
-    configure_logging(True)
-    if ns.sendstats:
-        if ns.sendstats == 'webui':
+def evaluate_stop_condition(errdata, stop_condition):
+    """
+    Call the user-defined function: stop_condition(errdata)
+    If the function returns -1, do nothing.  Otherwise, sys.exit.
+    """
+    exit_if_stopped(check_stop_condition(errdata, stop_condition))
+
+
+def exit_if_stopped(return_code):
+    """sys.exit if a stop condition returned a return code (not None)"""
+    if return_code is not None:
+        log.info(
+            'Stop condition triggered!  Relay is terminating.',
+            extra=dict(return_code=return_code))
+        sys.exit(return_code)
+
+
+def build_shaper(ns, clock=util.monotonic):
+    return ActuationShaper(
+        ns.actuation_window, ns.min_actuation_interval, ns.max_step,
+        ns.deadband, clock)
+
+
+def configure_sendstats(sendstats):
+    if sendstats:
+        if sendstats == 'webui':
             add_zmq_log_handler('ipc:///tmp/relaylog')
             start_webui()
         else:
-            add_zmq_log_handler(ns.sendstats)
+            add_zmq_log_handler(sendstats)
+
+
+def configure_log_pipeline(ns):
+    """Thin out debug messages and move log I/O to a background thread, as
+    requested on the command-line.  Call this after adding handlers"""
+    if ns.log_debug_every > 1 or ns.log_debug_rate:
+        log.addFilter(relay_logging.DebugSampler(
+            ns.log_debug_every, ns.log_debug_rate))
+    if ns.log_async:
+        relay_logging.start_async_logging(log)
+
+
+def configure_shell_plugins(ns):
+    """Apply --shell_timeout to the plugins defined as 'shell:<command>'"""
+    for k in ['metric', 'target', 'warmer', 'cooler']:
+        shell.set_timeout(getattr(ns, k), ns.shell_timeout)
+
+
+def configure_metric_cache(ns):
+    """Read the --metric through a shared cache, if --metric_cache_ttl is
+    given (see relay.plugins.cache)"""
+    if getattr(ns, 'metric_cache_ttl', None):
+        ns.metric = cache.cached(
+            ns.metric, ns.metric_cache_ttl, ns.metric_cache_scope,
+            ns.metric_cache_dir)
+
+
+def report_startup(ns):
+    """Call this after the first tick"""
+    util.STARTUP.mark('first_tick')
+    if ns.profile_startup:
+        log.info('startup profile', extra=util.STARTUP.report())
+    util.STARTUP.done = True
+
+
+def _exit_on_signal(signum, frame):
+    sys.exit(128 + signum)
+
+
+def exit_on_sigterm():
+    """Exit on SIGTERM (ie `kill` or a process manager stopping Relay) the
+    way Relay exits on Ctrl-C: by raising SystemExit, so that `finally`
+    blocks shut down the actuator and save the checkpoint"""
+    signal.signal(signal.SIGTERM, _exit_on_signal)
+
+
+def build_tick_timer(ns, phases=PHASES):
+    """Time the phases of each tick, if requested on the command-line, and
+    listen for the profiling signals (see relay.profiling)"""
+    timer = TickTimer.from_ns(ns, phases)
+    if isinstance(timer, TickTimer):
+        time_log_handlers(timer)
+        install_signal_handlers(timer, SamplingProfiler(
+            interval=ns.profile_sample_interval))
+    return timer
+
+
+def build_loop(ns, **kwargs):
+    """Build the ControlLoop, or the GainScheduledLoop, that the command-line
+    options define"""
+    if not getattr(ns, 'gain_schedule', None):
+        return ControlLoop.from_ns(ns, **kwargs)
+    try:
+        return GainScheduledLoop.from_ns(ns, **kwargs)
+    except (IOError, ValueError, InvalidGainSchedule) as err:
+        log.error("Could not load the gain schedule", extra=dict(
+            gain_schedule=ns.gain_schedule, error=err))
+        sys.exit(1)
+
+
+def release(shaper, coordinator=None, err=None):
+    """Return the MV to apply this tick.  While the `coordinator` is still
+    discovering its peers, the MV stays pending in the `shaper`, so it's
+    neither lost nor requested again"""
+    if coordinator and coordinator.discovering:
+        coordinator.heartbeat(err=err)
+        return 0
+    MV = shaper.release()
+    if coordinator:
+        MV = coordinator.share(MV, err)
+    return MV
+
+
+def tick_stats(shaper, coordinator=None):
+    """The stats of the shaper and coordinator to log with the MV"""
+    stats = shaper.stats()
+    if coordinator:
+        stats.update(coordinator.stats())
+    return stats
+
+
+def build_telemetry(ns):
+    if getattr(ns, 'telemetry', None):
+        return TelemetryPublisher(ns.telemetry)
+
+
+def main(ns):
+    if ns.asyncio:
+        from relay import aio
+        return aio.main(ns)
+    validate_ns_or_sysexit(ns)
+    configure_logging(True)
+    configure_sendstats(ns.sendstats)
+    configure_log_pipeline(ns)
+    configure_shell_plugins(ns)
+    configure_metric_cache(ns)
+    exit_on_sigterm()
     log.info(
         "Starting relay!", extra={k: str(v) for k, v in ns.__dict__.items()})
+    util.STARTUP.mark('configure')
 
     metric = ns.metric()
     target = ns.target()
-    errhist = window(ns.lookback)
-    ramp_index = 0
-
-    while True:
-        SP = next(target)  # set point
-        PV = next(metric)  # process variable
-        err = (SP - PV)
-        log.debug('got metric value', extra=dict(PV=PV, SP=SP))
-        if ramp_index < ns.ramp:
-            if ramp_index == 0:
-                plan = create_ramp_plan(err, ns.ramp)
-            ramp_index += 1
-            MV = next(plan)
-            errdata = errhist.send(0)
-        else:
-            errdata = errhist.send(err)
-            weight = calc_weight(errdata)
-            MV = int(round(err - weight * sum(errdata) / len(errdata)))
-            log.info('data', extra=dict(data=[
-                err, weight,
-                sum(errdata) / len(errdata)]))
-
-        if MV > 0:
-            if ns.warmer:
-                log.debug('adding heat', extra=dict(MV=MV, err=err))
-                threading.Thread(target=ns.warmer, args=(MV,)).start()
-            else:
-                log.warn('too cold')
-        elif MV < 0:
-            if ns.cooler:
-                log.debug('removing heat', extra=dict(MV=MV, err=err))
-                threading.Thread(target=ns.cooler, args=(MV,)).start()
-            else:
-                log.warn('too hot')
-        else:
-            log.debug(
-                'stabilized PV at setpoint', extra=dict(MV=MV, PV=PV, SP=SP))
-        time.sleep(ns.delay)
-        evaluate_stop_condition(list(errdata), ns.stop_condition)
-
-
-build_arg_parser = at.build_arg_parser([
-    at.group(
-        "What is Relay optimizing?",
-        at.metric, at.target),
-    at.group(
-        "Instruct Relay how to heat or cool your metric",
-        at.warmer, at.cooler),
-    at.group(
-        "Some optional Relay parameters",
-        at.delay, at.lookback, at.ramp, at.sendstats, at.stop_condition),
-])
+    loop = build_loop(ns)
+    shaper = build_shaper(ns)
+    actuate = Actuator(
+        ns.warmer, ns.cooler, ns.max_inflight, ns.backpressure)
+    telemetry = build_telemetry(ns)
+    archive = ArchiveWriter.from_ns(ns)
+    checkpoint = Checkpointer.from_ns(ns, loop)
+    coordinator = Coordinator.from_ns(ns)
+    timer = build_tick_timer(ns)
+    scheduler = AdaptiveDelay.from_ns(ns)
+    stop = stop_conditions.Monitor.from_ns(ns, loop)
+    util.STARTUP.mark('build')
+
+    try:
+        while True:
+            timer.start()
+            SP = next(target)  # set point
+            timer.mark('target')
+            PV = next(metric)  # process variable
+            timer.mark('metric')
+            MV = loop.update(SP, PV, shaper.pending + actuate.pending)
+            shaper.add(MV)
+            MV = release(shaper, coordinator, loop.err)
+            timer.mark('compute')
+            actuate(MV, err=loop.err, PV=PV, SP=SP,
+                    **tick_stats(shaper, coordinator))
+            timer.mark('actuate')
+            now = time.time()
+            if telemetry:
+                telemetry.publish_tick(now, loop, MV)
+            if archive:
+                archive.append_tick(now, loop, MV)
+            if checkpoint:
+                checkpoint.maybe_save()
+            timer.mark('publish')
+            if stop:
+                exit_if_stopped(stop.check())
+            timer.mark('stop_condition')
+            timer.end()
+            if not util.STARTUP.done:
+                report_startup(ns)
+            time.sleep(scheduler.update(loop) if scheduler else ns.delay)
+    finally:
+        actuate.shutdown()
+        if telemetry:
+            telemetry.close()
+        if archive:
+            archive.close()
+        if checkpoint:
+            checkpoint.save()
+        if coordinator:
+            coordinator.close()
@@ -0,0 +1,111 @@
+"""
+Convert the values that metric and target plugins yield into samples.
+
+A plugin may yield, on every poll:
+
+    a number - one sample (the classic protocol)
+    a list or 1-D array of numbers - several samples, oldest first, that are
+        already evenly spaced
+    a list of (timestamp, value) pairs, or an (n, 2) array - several samples
+        taken at the given times (in seconds).  They are resampled onto a
+        uniform grid by linear interpolation, because the tuning engines
+        assume evenly spaced samples.
+"""
+from __future__ import division
+
+import numbers
+
+import numpy as np
+
+from relay.constants import RESAMPLE_METHODS
+
+
+def normalize(sample):
+    """Return (timestamps, values) for a value yielded by a plugin.
+    `timestamps` is None if the plugin didn't provide any"""
+    if isinstance(sample, numbers.Number):
+        return None, np.array([sample], dtype=float)
+    arr = np.asarray(sample, dtype=float)
+    if arr.ndim == 0:
+        return None, arr.reshape(1)
+    if arr.ndim == 1:
+        return None, arr
+    if arr.ndim == 2 and arr.shape[1] == 2:
+        return arr[:, 0], arr[:, 1]
+    raise ValueError(
+        "A plugin must yield a number, a list of numbers or a list of"
+        " (timestamp, value) pairs.  Got an array of shape %s"
+        % (arr.shape, ))
+
+
+METHODS = RESAMPLE_METHODS
+
+
+class Resampler(object):
+    """
+    Resample timestamped batches onto a grid with a fixed `period`.
+
+    The grid is continuous across batches: every call returns the grid
+    points between the end of the previous batch and the end of this one.
+    Points between two batches are interpolated from the last sample of the
+    previous batch.
+
+    `method` how to fill in grid points between two samples:
+        linear - linear interpolation
+        zoh - zero-order hold, ie the value of the previous sample
+    """
+    def __init__(self, period, method='linear'):
+        if period <= 0:
+            raise ValueError("Resampling needs a period > 0")
+        if method not in METHODS:
+            raise ValueError("Unrecognized resampling method: %s" % method)
+        self.period = period
+        self.method = method
+        self._next_t = None  # the next grid point to emit
+        self._last = None  # (timestamp, value) of the latest sample seen
+
+    def __call__(self, timestamps, values):
+        order = np.argsort(timestamps, kind='mergesort')
+        timestamps, values = timestamps[order], values[order]
+        if self._last is not None:
+            timestamps = np.concatenate([[self._last[0]], timestamps])
+            values = np.concatenate([[self._last[1]], values])
+        if self._next_t is None:
+            self._next_t = timestamps[0]
+        self._last = (timestamps[-1], values[-1])
+
+        npoints = int(np.floor((timestamps[-1] - self._next_t) / self.period))
+        if npoints < 0:
+            return np.empty(0)
+        grid = self._next_t + self.period * np.arange(npoints + 1)
+        self._next_t = grid[-1] + self.period
+        if self.method == 'zoh':
+            return values[np.searchsorted(timestamps, grid, 'right') - 1]
+        return np.interp(grid, timestamps, values)
+
+    def grid_times(self, npoints):
+        """Return the timestamps of the last `npoints` grid points returned"""
+        return self._next_t - self.period * np.arange(npoints, 0, -1)
+
+
+class Sampler(object):
+    """
+    Turn whatever a plugin yields into a 1-D array of evenly spaced samples,
+    or a float if the plugin yielded a single number.
+
+    `period` seconds between samples of the uniform grid that timestamped
+        batches are resampled onto
+    """
+    def __init__(self, period):
+        self.period = period
+        self._resampler = None
+
+    def __call__(self, sample):
+        if isinstance(sample, numbers.Number):
+            return float(sample)
+        timestamps, values = normalize(sample)
+        if timestamps is not None:
+            if self._resampler is None:
+                self._resampler = Resampler(self.period)
+            values = self._resampler(timestamps, values)
+        return values
@@ -0,0 +1,156 @@
+"""
+Adapt the delay between ticks to what the error is doing.  Enable it with
+`relay --min_delay <seconds> --max_delay <seconds>`.
+
+A loop whose error is just noise around the set point polls its metric
+every --max_delay seconds.  When the error moves away from zero, or
+oscillates, the delay shrinks right away, down to --min_delay, and then
+grows back by at most GROWTH per tick once things are quiet again.
+
+Each tick, AdaptiveDelay looks at:
+
+    the recent errors - the mean square of the last `window` errors Relay
+        observed, compared to the variance of the noise (estimated from the
+        differences between consecutive errors).  The delay is --max_delay
+        divided by this ratio, so a loop that sits at its set point backs
+        off, and a loop that is away from it, or was just disturbed, polls
+        faster
+    the spectrum of the error history - the same one the tuning engine
+        computes K_i from (see relay.tuning).  If one frequency stands out
+        of the noise, the delay is capped so each of its cycles is sampled
+        SAMPLES_PER_CYCLE times
+
+While the loop ramps, it ticks every --delay.
+
+The error history stays evenly spaced when the delay changes: errors are
+recorded with the time they were observed and resampled onto a grid of
+--sample_period (by default --delay) seconds, as with --resample, so
+--lookback is always a number of grid periods and the spectrum keeps its
+meaning.  A long delay fills several grid points per tick.
+"""
+from __future__ import division
+
+import numpy as np
+
+from relay import log
+
+# how many times faster the delay may grow per tick.  It shrinks at once
+GROWTH = 1.25
+SAMPLES_PER_CYCLE = 10
+# a frequency stands out if its power is this many times the noise's
+PEAK_RATIO = 20
+# the median over the mean of the power of white noise in one frequency bin
+# (exponentially distributed), and of the square of gaussian noise
+# (chi-squared with 1 degree of freedom)
+MEDIAN_OF_POWER = np.log(2)
+MEDIAN_OF_SQUARE = 0.4549
+# estimate the noise from at most this many errors, or frequencies
+NOISE_WINDOW = 1024
+
+
+def enabled(ns):
+    """Did the command-line ask to adapt the delay?"""
+    lo = getattr(ns, 'min_delay', None)
+    hi = getattr(ns, 'max_delay', None)
+    return (lo or ns.delay) < (hi or ns.delay)
+
+
+def noise_variance(errs):
+    """A robust estimate of the variance of the noise in `errs`, from the
+    differences between consecutive errors, so a trend or an offset doesn't
+    count as noise"""
+    sq = np.diff(errs) ** 2
+    if not len(sq):
+        return 0.
+    median = np.median(sq) / MEDIAN_OF_SQUARE
+    # differences of independent samples have twice their variance
+    return (median if median > 0 else sq.mean()) / 2
+
+
+def dominant_period(sp, n, period, delay):
+    """
+    The period, in seconds, of the frequency that stands out of the
+    spectrum `sp` (fft(errdata)[1: n // 2]) of `n` errors sampled every
+    `period` seconds, or None.  Only the frequencies that ticking every
+    `delay` seconds can see are considered.
+    """
+    # bin j has j cycles per window.  Nyquist of a delay is half a cycle
+    nbins = min(len(sp), int(n * period / (2 * delay)))
+    if nbins < 4:
+        return None
+    power = sp[:nbins].real ** 2 + sp[:nbins].imag ** 2
+    stride = max(nbins // NOISE_WINDOW, 1)
+    mean = np.median(power[::stride]) / MEDIAN_OF_POWER
+    j = int(np.argmax(power))
+    if not mean or power[j] < PEAK_RATIO * mean:
+        return None
+    return n * period / (j + 1)
+
+
+class AdaptiveDelay(object):
+    """
+    Choose the delay before each tick.
+
+    `delay` the delay to start with, and to use while ramping
+    `min_delay`, `max_delay` bounds of the delay
+    `period` seconds between samples of the error history
+    `window` how many of the latest errors show what the loop is doing now
+    """
+    def __init__(self, delay, min_delay, max_delay, period, window=16):
+        if min_delay > max_delay:
+            raise ValueError("--min_delay must not exceed --max_delay")
+        self.initial_delay = delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.period = period
+        self.window = window
+        self.delay = delay
+
+    @classmethod
+    def from_ns(cls, ns):
+        """Return an AdaptiveDelay, or None, as requested on the
+        command-line"""
+        if not enabled(ns):
+            return None
+        return cls(
+            ns.delay, ns.min_delay or ns.delay, ns.max_delay or ns.delay,
+            ns.sample_period or ns.delay)
+
+    def target(self, ticks, sp, n):
+        """
+        The delay the loop's errors call for, or None if there aren't
+        enough of them yet.
+
+        `ticks` the errors as they were observed, oldest first
+        `sp` the spectrum of the (evenly spaced) error history
+        `n` the number of errors in the error history
+        """
+        if len(ticks) < 2 * self.window:
+            return None
+        recent = ticks[-self.window:]
+        mean_square = np.dot(recent, recent) / len(recent)
+        if not mean_square:
+            return self.max_delay  # right on the set point
+        noise = noise_variance(ticks[-NOISE_WINDOW:])
+        activity = mean_square / noise if noise else 1.
+        delay = self.max_delay / max(activity, 1.)
+        cycle = dominant_period(sp, n, self.period, self.delay)
+        if cycle is not None:
+            delay = min(delay, cycle / SAMPLES_PER_CYCLE)
+        return min(max(delay, self.min_delay), self.max_delay)
+
+    def update(self, loop):
+        """Return the delay before the next tick of the control `loop`"""
+        if loop.ramping:
+            self.delay = self.initial_delay
+            return self.delay
+        target = self.target(
+            loop.ticks.view(), loop.spectrum(), len(loop.history))
+        if target is None:
+            return self.delay
+        delay = min(target, self.delay * GROWTH)
+        if abs(delay - self.delay) > .01 * self.delay:
+            log.debug('adapting the delay', extra=dict(
+                delay=delay, previous_delay=self.delay))
+        self.delay = delay
+        return delay
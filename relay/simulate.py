@@ -0,0 +1,220 @@
+"""
+Simulate Relay offline, in virtual time, to see how it would tune a metric.
+
+    relay simulate --plant first_order --plant_tau 5 --target 20 \\
+        --delay .1 --ticks 5000
+
+The PV comes from a plant model (see FirstOrderPlant) that responds to the
+MVs Relay computes, or is replayed from a --trace recorded earlier, in which
+case Relay's MVs don't affect it.  Nothing sleeps and no warmer or cooler is
+called, so a simulation runs thousands of ticks per second.
+
+If --lookback, --ramp or --delay are given comma separated lists of values,
+every combination of them is simulated and one summary row per combination
+is written.  Otherwise, the PV, SP, err and MV of every tick are written.
+"""
+from __future__ import division
+
+import argparse
+from collections import deque
+import csv
+import itertools
+import json
+import logging
+import sys
+
+import numpy as np
+
+from relay import log, configure_logging
+from relay import util
+from relay.loop import ControlLoop
+from relay.scheduling import AdaptiveDelay
+from relay import parsers
+from relay import runner
+
+# the log message that records the SP and PV of a tick.  See relay.loop
+TRACE_MSG = 'got metric value'
+
+
+class VirtualClock(object):
+    """A clock whose time only changes when you set `now`"""
+    def __init__(self, now=0.):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class FirstOrderPlant(object):
+    """
+    A simple model of how a metric responds to a warmer and cooler.
+
+    Each MV changes the level the metric settles at by `gain * MV`, starting
+    `dead_time` seconds after it was applied.  The metric follows that level
+    with a first order lag of time constant `tau` seconds.  Gaussian noise
+    with standard deviation `noise` is added to every observation.
+    """
+    def __init__(self, gain=1., tau=0., dead_time=0., noise=0., initial=0.,
+                 seed=None):
+        self.gain = gain
+        self.tau = tau
+        self.dead_time = dead_time
+        self.noise = noise
+        self.level = self.pv = initial
+        self._queue = deque()  # (time the MV takes effect, change in level)
+        self._t = None
+        self._rng = np.random.RandomState(seed)
+
+    def actuate(self, MV, t):
+        if MV:
+            self._queue.append((t + self.dead_time, self.gain * MV))
+
+    def observe(self, t):
+        while self._queue and self._queue[0][0] <= t:
+            self.level += self._queue.popleft()[1]
+        dt = 0 if self._t is None else t - self._t
+        self._t = t
+        if self.tau > 0:
+            self.pv += (self.level - self.pv) * (1 - np.exp(-dt / self.tau))
+        else:
+            self.pv = self.level
+        if self.noise:
+            return self.pv + self.noise * self._rng.randn()
+        return self.pv
+
+
+def load_trace(path):
+    """Return arrays of the (SP, PV) values recorded in a csv file or in a
+    file of json log messages, one per line.  Of the log messages, only the
+    "got metric value" ones are used: other messages of the same tick (ie
+    "adding heat") repeat its SP and PV"""
+    SP, PV = [], []
+    with open(path) as fp:
+        first_line = fp.readline()
+        fp.seek(0)
+        if first_line.lstrip().startswith('{'):
+            records = (json.loads(line) for line in fp if line.strip())
+        else:
+            records = csv.DictReader(fp)
+        for record in records:
+            if record.get('msg', TRACE_MSG) != TRACE_MSG:
+                continue
+            if record.get('SP') is not None and record.get('PV') is not None:
+                SP.append(float(record['SP']))
+                PV.append(float(record['PV']))
+    return np.array(SP), np.array(PV)
+
+
+def simulate(ns, trace=None, plant=None):
+    """
+    Run Relay's control logic for `ns.ticks` ticks of `ns.delay` virtual
+    seconds, or of an adaptive delay (see relay.scheduling).  Return a dict
+    of arrays: t, SP, PV, err, MV
+
+    `trace` (optional) a tuple of (SP, PV) arrays to replay
+    `plant` (optional) a plant model.  If given, PV comes from the plant
+    """
+    clock = VirtualClock()
+    loop = ControlLoop.from_ns(ns, clock=clock)
+    shaper = runner.build_shaper(ns, clock)
+    scheduler = AdaptiveDelay.from_ns(ns)
+    target = ns.target() if trace is None else iter(trace[0])
+    nticks = ns.ticks if trace is None else min(ns.ticks, len(trace[0]))
+
+    rv = dict((k, np.zeros(nticks)) for k in ['t', 'SP', 'PV', 'err', 'MV'])
+    t = 0.
+    for i in range(nticks):
+        clock.now = t
+        SP = next(target)
+        PV = plant.observe(t) if plant else trace[1][i]
+        shaper.add(loop.update(SP, PV, shaper.pending))
+        MV = shaper.release()
+        if plant:
+            plant.actuate(MV, t)
+        rv['t'][i], rv['SP'][i], rv['PV'][i] = t, SP, PV
+        rv['err'][i], rv['MV'][i] = loop.err, MV
+        t = t + scheduler.update(loop) if scheduler else (i + 1) * ns.delay
+    return rv
+
+
+def summarize(result):
+    """Summary statistics of a simulation, for comparing parameters"""
+    err = result['err']
+    return dict(
+        mean_abs_err=float(np.abs(err).mean()) if len(err) else None,
+        rmse=float(np.sqrt((err ** 2).mean())) if len(err) else None,
+        num_actuations=int(np.count_nonzero(result['MV'])),
+        total_abs_MV=float(np.abs(result['MV']).sum()),
+        mean_delay=float(np.diff(result['t']).mean())
+        if len(result['t']) > 1 else None,
+    )
+
+
+def sweep(ns, trace=None):
+    """Simulate every combination of the given lookbacks, ramps and delays.
+    Yield a summary dict for each"""
+    for lookback, ramp, delay in itertools.product(
+            ns.lookback, ns.ramp, ns.delay):
+        _ns = argparse.Namespace(**vars(ns))
+        _ns.lookback, _ns.ramp, _ns.delay = lookback, ramp, delay
+        plant = build_plant(_ns)
+        start = util.monotonic()
+        result = simulate(_ns, trace, plant)
+        elapsed = util.monotonic() - start
+        summary = dict(lookback=lookback, ramp=ramp, delay=delay)
+        summary.update(summarize(result))
+        summary['ticks_per_second'] = len(result['t']) / elapsed \
+            if elapsed else None
+        yield summary
+
+
+def build_plant(ns):
+    if ns.plant == 'first_order':
+        return FirstOrderPlant(
+            ns.plant_gain, ns.plant_tau, ns.plant_dead_time, ns.plant_noise,
+            ns.initial_pv, ns.seed)
+
+
+def write_csv(fp, rows, columns):
+    writer = csv.writer(fp)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([row[k] for k in columns])
+
+
+def main(ns):
+    configure_logging(True)
+    if ns.trace is None and ns.plant is None:
+        log.error("you must define a --trace or a --plant to simulate!")
+        sys.exit(1)
+    if ns.trace is None and ns.target is None:
+        log.error("you must define a --target or a --trace!")
+        sys.exit(1)
+    # logging every tick would dominate the cost of the simulation
+    log.setLevel(logging.ERROR)
+
+    trace = load_trace(ns.trace) if ns.trace else None
+    if trace is not None and ns.plant is not None:
+        trace = (trace[0], None)
+    fp = open(ns.output, 'w') if ns.output else sys.stdout
+    try:
+        if len(ns.lookback) * len(ns.ramp) * len(ns.delay) == 1:
+            _ns = argparse.Namespace(**vars(ns))
+            _ns.lookback, _ns.ramp, _ns.delay = \
+                ns.lookback[0], ns.ramp[0], ns.delay[0]
+            result = simulate(_ns, trace, build_plant(_ns))
+            columns = ['t', 'SP', 'PV', 'err', 'MV']
+            write_csv(fp, (dict((k, result[k][i]) for k in columns)
+                           for i in range(len(result['t']))), columns)
+        else:
+            write_csv(fp, sweep(ns, trace), [
+                'lookback', 'ramp', 'delay', 'mean_abs_err', 'rmse',
+                'num_actuations', 'total_abs_MV', 'mean_delay',
+                'ticks_per_second'])
+    finally:
+        if fp is not sys.stdout:
+            fp.close()
+
+
+# the parser lives in relay.parsers, so it's built without importing this
+build_arg_parser = parsers.build_simulate_arg_parser
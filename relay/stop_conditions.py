@@ -0,0 +1,321 @@
+"""
+Stop conditions decide whether Relay should exit.  Pass one with
+`relay --stop_condition <import path>`.
+
+A stop condition is a class.  Relay creates one instance per control loop,
+passing the loop's --lookback, and calls its `update(err)` method with every
+error that enters the loop's error history, oldest first.  `update` keeps
+whatever running counters it needs, so each tick costs O(1) however long
+the history is.  It returns -1 as long as Relay should keep going, or an
+integer return code that gets passed to sys.exit(...).  When a batch of
+samples arrives in one tick (see relay.sampling), `extend(errs)` is called
+with the numpy array of new errors instead.  StopCondition.extend calls
+`update` for each of them, and the conditions below override it with
+vectorized versions.  A class with only an `update` method works too: its
+`update` is called for each error of the batch.
+
+Relay comes with a few conditions, which you can subclass to change their
+parameters:
+
+    class stop_if_stuck(relay.stop_conditions.SustainedError):
+        bound = 10
+        samples = 60
+
+    relay --stop_condition mycode.stop_if_stuck ...
+
+    DivergenceRatio - the error grew between most consecutive samples
+    SustainedError - the error stayed out of bounds for too long
+    Oscillation - the error changed sign too often
+
+Functions of the whole error history, ie `stop_condition(errdata)`, still
+work: LegacyStopCondition calls them once per tick with a read-only numpy
+view of the history.  They cost O(lookback) per tick.
+"""
+from __future__ import division
+
+import inspect
+
+import numpy as np
+
+CONTINUE = -1
+
+
+class StopCondition(object):
+    """
+    The base class of stop conditions.
+
+    `lookback` the number of samples in the loop's error history
+    """
+    return_code = 0
+
+    def __init__(self, lookback):
+        self.lookback = lookback
+
+    def update(self, err):
+        """Return -1 to keep going or a return code to exit with"""
+        return CONTINUE
+
+    def extend(self, errs):
+        """Like update, for an array of errors"""
+        for err in errs:
+            rv = self.update(err)
+            if rv != CONTINUE:
+                return rv
+        return CONTINUE
+
+
+class _SlidingCount(object):
+    """Count the flags that are set among the last `window` flags"""
+    def __init__(self, window):
+        self.window = window
+        self._flags = [0] * window  # ring buffer
+        self._i = 0
+        self.n = 0  # flags in the window
+        self.count = 0
+
+    def push(self, flag):
+        """Add a flag and return the new count"""
+        flag = int(flag)
+        self.count += flag - self._flags[self._i]
+        self._flags[self._i] = flag
+        self._i = (self._i + 1) % self.window
+        if self.n < self.window:
+            self.n += 1
+        return self.count
+
+    def extend(self, flags):
+        """Add an array of flags.  Return (count, n) after each of them, as
+        arrays"""
+        k, w = len(flags), self.window
+        old = np.array(self._flags[self._i:] + self._flags[:self._i])
+        seq = np.concatenate([old, np.asarray(flags, dtype=int)])
+        csum = np.concatenate([[0], np.cumsum(seq)])
+        counts = csum[w + 1:] - csum[1:k + 1]
+        ns = np.minimum(self.n + np.arange(1, k + 1), w)
+        self._flags = seq[-w:].tolist()
+        self._i = 0
+        self.n = int(ns[-1]) if k else self.n
+        self.count = int(counts[-1]) if k else self.count
+        return counts, ns
+
+
+class DivergenceRatio(StopCondition):
+    """
+    Stop if the absolute error grew between more than `ratio` of the
+    consecutive samples in the last `window` samples (by default, the
+    lookback).  It's the streaming version of comparing every pair of
+    samples in the error history.
+    """
+    ratio = .5
+    window = None
+
+    def __init__(self, lookback, ratio=None, window=None):
+        super(DivergenceRatio, self).__init__(lookback)
+        if ratio is not None:
+            self.ratio = ratio
+        self.window = window or self.window or lookback
+        # consecutive pairs of samples in the window
+        self._increases = _SlidingCount(max(self.window - 1, 1))
+        self._last = None
+
+    def update(self, err):
+        err = abs(err)
+        last, self._last = self._last, err
+        if last is None:
+            return CONTINUE
+        count = self._increases.push(err > last)
+        if count > self.ratio * (self._increases.n + 1):
+            return self.return_code
+        return CONTINUE
+
+    def extend(self, errs):
+        errs = np.abs(np.asarray(errs, dtype=float))
+        if not len(errs):
+            return CONTINUE
+        prev = errs if self._last is None \
+            else np.concatenate([[self._last], errs])
+        self._last = float(errs[-1])
+        if len(prev) < 2:
+            return CONTINUE
+        counts, ns = self._increases.extend(prev[1:] > prev[:-1])
+        if (counts > self.ratio * (ns + 1)).any():
+            return self.return_code
+        return CONTINUE
+
+
+class SustainedError(StopCondition):
+    """
+    Stop if the absolute error stayed above `bound` for `samples`
+    consecutive samples (by default, the lookback).  Subclasses must set
+    `bound`.
+    """
+    bound = None
+    samples = None
+
+    def __init__(self, lookback, bound=None, samples=None):
+        super(SustainedError, self).__init__(lookback)
+        if bound is not None:
+            self.bound = bound
+        if self.bound is None:
+            raise ValueError("%s needs an error bound" % type(self).__name__)
+        self.samples = samples or self.samples or lookback
+        self._run = 0  # consecutive samples out of bounds
+
+    def update(self, err):
+        self._run = self._run + 1 if abs(err) > self.bound else 0
+        if self._run >= self.samples:
+            return self.return_code
+        return CONTINUE
+
+    def extend(self, errs):
+        out = np.abs(np.asarray(errs, dtype=float)) > self.bound
+        if not len(out):
+            return CONTINUE
+        # the length of the run ending at each sample
+        i = np.arange(len(out))
+        last_reset = np.maximum.accumulate(np.where(out, -1, i))
+        runs = i - last_reset
+        runs[last_reset == -1] += self._run
+        self._run = int(runs[-1])
+        if (runs >= self.samples).any():
+            return self.return_code
+        return CONTINUE
+
+
+class Oscillation(StopCondition):
+    """
+    Stop if the error changed sign more than `crossings` times in the last
+    `window` samples (by default, the lookback).  Errors within
+    +/-`deadband` of zero don't count as a sign, so noise around the set
+    point doesn't look like an oscillation.  `crossings` defaults to half
+    of the window, ie the error flips almost every sample.
+    """
+    window = None
+    crossings = None
+    deadband = 0
+
+    def __init__(self, lookback, window=None, crossings=None,
+                 deadband=None):
+        super(Oscillation, self).__init__(lookback)
+        self.window = window or self.window or lookback
+        if crossings is not None:
+            self.crossings = crossings
+        if self.crossings is None:
+            self.crossings = self.window // 2
+        if deadband is not None:
+            self.deadband = deadband
+        self._crossed = _SlidingCount(self.window)
+        self._sign = 0  # of the last error outside of the deadband
+
+    def update(self, err):
+        sign = 1 if err > self.deadband else -1 if err < -self.deadband \
+            else 0
+        crossed = sign and self._sign and sign != self._sign
+        if sign:
+            self._sign = sign
+        if self._crossed.push(crossed) > self.crossings:
+            return self.return_code
+        return CONTINUE
+
+    def extend(self, errs):
+        errs = np.asarray(errs, dtype=float)
+        if not len(errs):
+            return CONTINUE
+        signs = np.where(
+            errs > self.deadband, 1, np.where(errs < -self.deadband, -1, 0))
+        # the sign before each sample, carried over the deadband
+        i = np.arange(len(signs))
+        last = np.maximum.accumulate(np.where(signs != 0, i, -1))
+        before = np.concatenate([[-1], last[:-1]])
+        prev = np.where(before >= 0, signs[np.maximum(before, 0)], self._sign)
+        crossed = (signs != 0) & (prev != 0) & (signs != prev)
+        if last[-1] >= 0:
+            self._sign = int(signs[last[-1]])
+        counts, _ = self._crossed.extend(crossed)
+        if (counts > self.crossings).any():
+            return self.return_code
+        return CONTINUE
+
+
+class LegacyStopCondition(StopCondition):
+    """
+    Adapt a function of the whole error history, `func(errdata)`, to the
+    streaming protocol.  It's called once per tick with a read-only view of
+    the error history of `loop` (its `errors`), as it always was.
+    """
+    def __init__(self, func, loop):
+        self.func = func
+        self.loop = loop
+
+    def update(self, err):
+        return self.func(self.loop.errors.view())
+
+    def extend(self, errs):
+        return self.func(self.loop.errors.view())
+
+
+def is_streaming(plugin):
+    """Is `plugin` a stop condition class, rather than a function of the
+    error history?"""
+    return inspect.isclass(plugin) and hasattr(plugin, 'update')
+
+
+class Monitor(object):
+    """
+    Feed the errors that enter the `errors` history of a control loop to a
+    stop condition.  Of a batch bigger than the history, it only sees the
+    errors that the history kept.
+
+    `condition` a stop condition instance
+    `loop` a relay.loop.ControlLoop (or GainScheduledLoop)
+    """
+    def __init__(self, condition, loop):
+        self.condition = condition
+        self.loop = loop
+        self._history = loop.errors
+        self._seen = self._history.total
+
+    @classmethod
+    def from_ns(cls, ns, loop):
+        """Return a Monitor for the --stop_condition, or None"""
+        return build(ns.stop_condition, loop, ns.lookback)
+
+    def check(self):
+        """Return None if Relay should keep going, or a return code"""
+        history = self.loop.errors
+        if history is not self._history:  # ie a restored checkpoint
+            self._history = history
+            self._seen = history.total
+        new = history.total - self._seen
+        self._seen = history.total
+        if not new:
+            return  # no new samples this tick
+        if new == 1:
+            rv = self.condition.update(float(history.view()[-1]))
+        else:
+            errs = history.view()
+            rv = extend(self.condition, errs[len(errs) - min(new, len(errs)):])
+        if rv != CONTINUE:
+            return rv
+
+
+def extend(condition, errs):
+    """Feed an array of errors to `condition`, whether or not it has an
+    `extend` method"""
+    if hasattr(condition, 'extend'):
+        return condition.extend(errs)
+    for err in errs:
+        rv = condition.update(float(err))
+        if rv != CONTINUE:
+            return rv
+    return CONTINUE
+
+
+def build(plugin, loop, lookback):
+    """Return a Monitor of the stop condition `plugin` for `loop`, or None
+    if there's no stop condition"""
+    if not plugin:
+        return None
+    if is_streaming(plugin):
+        return Monitor(plugin(lookback), loop)
+    return Monitor(LegacyStopCondition(plugin, loop), loop)
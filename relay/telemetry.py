@@ -0,0 +1,119 @@
+"""
+A compact, fixed-schema stream of per-tick statistics.  Enable it with
+`relay --telemetry <zmq uri>`.
+
+Every tick, Relay publishes one record with the fields in FIELDS, packed as
+little-endian doubles after a one-byte schema version (see RECORD).  Each
+record is sent as a two-part zmq message: the topic (b'relay' or
+b'relay.<loop name>') and the packed record.  Values that aren't known yet
+(ie the weight while ramping) are NaN.
+
+Records are packed and sent by a background thread.  The control loop only
+puts a tuple on a bounded queue, so a slow subscriber can't delay a tick.
+If the queue is full, the record is dropped and counted.
+
+To read the stream:
+
+    sock = zmq.Context().socket(zmq.SUB)
+    sock.bind(address)
+    sock.setsockopt(zmq.SUBSCRIBE, b'relay')
+    while True:
+        topic, payload = sock.recv_multipart()
+        print(unpack(payload))
+"""
+from __future__ import division
+
+import struct
+import threading
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+from relay import log
+
+FIELDS = ('ts', 'PV', 'SP', 'err', 'MV', 'weight', 'mean')
+VERSION = 1
+RECORD = struct.Struct('<B%sd' % len(FIELDS))
+_STOP = object()
+
+
+def pack(*values):
+    """Pack the values of FIELDS, in order, into a telemetry record"""
+    return RECORD.pack(VERSION, *(
+        float('nan') if v is None else v for v in values))
+
+
+def unpack(payload):
+    """Return a dict of the fields in a packed telemetry record"""
+    rv = RECORD.unpack(payload)
+    if rv[0] != VERSION:
+        raise ValueError("Unrecognized telemetry version: %s" % rv[0])
+    return dict(zip(FIELDS, rv[1:]))
+
+
+class TelemetryPublisher(object):
+    """
+    Send telemetry records to a zmq address from a background thread.
+
+    `address` a zmq uri to connect a PUB socket to
+    `maxsize` the number of records to buffer before dropping new ones
+    """
+    def __init__(self, address, maxsize=1000):
+        self.address = address
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize)
+        self._thread = threading.Thread(
+            target=self._work, name='relay-telemetry')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def publish(self, ts, PV, SP, err, MV, weight=None, mean=None,
+                loop=None):
+        """Queue one record.  Never blocks"""
+        try:
+            self._queue.put_nowait((loop, (ts, PV, SP, err, MV, weight, mean)))
+        except queue.Full:
+            self.dropped += 1
+
+    def publish_tick(self, ts, control_loop, MV):
+        """Queue the state of a relay.loop.ControlLoop after a tick"""
+        if control_loop.err is None:
+            return
+        self.publish(
+            ts, control_loop.PV, control_loop.SP, control_loop.err, MV,
+            control_loop.last_weight, control_loop.history.mean,
+            control_loop.name)
+
+    def _work(self):
+        import zmq
+        sock = zmq.Context.instance().socket(zmq.PUB)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.connect(self.address)
+        topics = {}
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _STOP:
+                    return
+                loop, values = item
+                if loop not in topics:
+                    topics[loop] = (
+                        b'relay' if loop is None
+                        else ('relay.%s' % loop).encode('utf8'))
+                try:
+                    sock.send_multipart(
+                        [topics[loop], pack(*values)], zmq.NOBLOCK)
+                except zmq.Again:
+                    self.dropped += 1
+                except (struct.error, TypeError) as err:
+                    log.warn('could not send telemetry', extra=dict(
+                        error=err, values=values))
+        finally:
+            sock.close()
+
+    def close(self, timeout=1):
+        """Stop the background thread after it sends the queued records"""
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
@@ -0,0 +1,277 @@
+"""
+Tuning engines compute K_i, the weight Relay gives to the error history.
+
+An engine is an object with these methods:
+
+    push(x, evicted)  - called every time a sample enters the error history.
+                        `evicted` is the sample that fell out of the window,
+                        or None if the window was not yet full.
+    extend(xs, evicted) - like push, but for an array of samples.
+                        `evicted` is an array or None.
+    weight(errdata)   - return K_i for the current error history
+    spectrum(errdata) - return fft(errdata)[1: len(errdata) // 2], the
+                        spectrum K_i is computed from
+
+Engines available (see `ENGINES`):
+
+    sliding_dft - (default) keeps the spectrum up to date with a sliding DFT
+                  and computes the amplitude integrals in closed form.
+                  O(lookback) per tick.
+    fft - recomputes a full FFT and iterates over the amplitude integrals
+          on every tick.  O(lookback**2) per tick.
+
+Both engines return the same K_i.  The sliding_dft engine only differs by
+floating point rounding: the absolute difference is below 1e-9 for error
+histories of up to 1e6 samples.  To keep rounding error from accumulating,
+the sliding spectrum is recomputed from scratch once every `lookback` ticks.
+
+A constant error history has no variation, but its spectrum is rarely
+exactly 0: it's rounding error, which differs between an fft and a sliding
+DFT.  A spectrum whose amplitudes are all below FLAT_TOLERANCE times the
+magnitude of the errors it was computed from is treated as 0, so both
+engines return 1.  For the sliding DFT, that includes the errors that slid
+out of the window since the last full fft.
+"""
+from __future__ import division
+
+import numpy as np
+
+from relay import log
+from relay.constants import DEFAULT_TUNING_ENGINE
+
+FLAT_TOLERANCE = 1e-12
+
+
+def is_flat(sp, scale):
+    """Is the spectrum `sp` all rounding error, ie there is no variation in
+    the signal?  `scale` is the sum of the absolute errors the spectrum was
+    computed from.  `sp` may be 2-D, with one `scale` per row"""
+    return np.abs(sp).max(axis=-1, initial=0.) <= FLAT_TOLERANCE * scale
+
+
+def calc_weight(errdata):
+    sp = np.fft.fft(errdata)[1: len(errdata) // 2]
+    if is_flat(sp, np.abs(errdata).sum()):  # no variation in the signal
+        log.warn('no variation in the signal.  fft cannot continue')
+        return 1
+
+    # get the phase in radians  # -np.pi < phase <= +np.pi
+    phase = np.angle(sp)  # radians
+
+    # find the amplitude integral of neighboring samples.
+    # search <360 degrees to left of most recent sample's phase
+    # p_k = phase - degrees_between_samples * k  # kth phase
+    amplitude_integrals = np.abs(np.sin(phase))  # iteratively updated
+    # samples per cycle
+    kth = len(errdata) / np.arange(1, len(errdata) // 2)
+    num_degrees_between_samples = 2 * np.pi / kth
+    p_k = phase.copy()
+    while (kth > 0).any():
+        # find amplitude of a sign wave at specific phase
+        p_k -= num_degrees_between_samples
+        amplitude_integrals += np.abs(np.sin(p_k))
+        kth -= 1
+        not_idxs = kth <= 0
+        p_k[not_idxs] = 0
+        num_degrees_between_samples[not_idxs] = 0
+
+    # get the amplitude of each frequency in the fft spectrum
+    amplitude = np.abs(sp)
+    return (
+        # np.sin(phase)
+        (np.sin(phase) / amplitude_integrals)
+        * (amplitude / amplitude.sum())
+    ).sum()
+
+
+def spectrum_geometry(n):
+    """
+    Return the constants calc_weight derives from the window size, `n`:
+
+        step - radians between consecutive samples at each frequency
+        nterms - number of samples summed in each amplitude integral
+    """
+    bins = np.arange(1, n // 2)
+    step = 2 * np.pi * bins / n
+    nterms = np.ceil(n / bins).astype(int) + 1
+    return step, nterms
+
+
+def amplitude_integrals(phase, step, nterms):
+    """
+    Closed form of the amplitude integral calc_weight computes iteratively:
+
+        sum_k abs(sin(phase - k * step))  where k = [0:nterms)
+
+    The k samples cover less than 3*pi radians, so they fall into at most 4
+    half periods of the sine wave.  Inside a half period, the sign of sin
+    is constant and the sum of equally spaced sines has a closed form.
+
+    All arguments are arrays that broadcast together.
+    """
+    top = np.floor(phase / np.pi)
+    half_step = step / 2
+    total = np.zeros(np.broadcast(phase, step, nterms).shape)
+    for i in range(4):
+        m = top - i
+        # indexes of the samples whose phase is in (m*pi, (m+1)*pi]
+        lo = np.maximum(np.ceil((phase - (m + 1) * np.pi) / step), 0)
+        hi = np.minimum(np.ceil((phase - m * np.pi) / step) - 1, nterms - 1)
+        count = np.maximum(hi - lo + 1, 0)
+        total += (
+            (1 - 2 * (m % 2))  # sign of sin in this half period
+            * np.sin(phase - (lo + hi) * half_step)
+            * np.sin(count * half_step) / np.sin(half_step))
+    return total
+
+
+def weight_from_spectrum(sp, step, nterms, scale):
+    """
+    Compute K_i given the fft spectrum of the error history,
+    `sp` = fft(errdata)[1: len(errdata) // 2], and `scale`, the sum of the
+    absolute errors (see is_flat)
+
+    `sp` may be 2-dimensional, one row per error history, in which case
+    `scale` is an array and an array of weights is returned.
+    """
+    phase = np.angle(sp)
+    amplitude = np.abs(sp)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rv = (
+            (np.sin(phase) / amplitude_integrals(phase, step, nterms))
+            * (amplitude / amplitude.sum(axis=-1, keepdims=True))
+        ).sum(axis=-1)
+    # there is no variation in the signal
+    return np.where(is_flat(sp, scale), 1, rv)
+
+
+def calc_weight_batch(errmatrix):
+    """
+    Compute K_i for many error histories of the same length at once.
+
+    `errmatrix` a 2-D array with one error history per row
+    Returns an array of weights, one per row
+    """
+    n = errmatrix.shape[1]
+    sp = np.fft.fft(errmatrix, axis=1)[:, 1: n // 2]
+    return weight_from_spectrum(
+        sp, *spectrum_geometry(n), scale=np.abs(errmatrix).sum(axis=1))
+
+
+class FFTEngine(object):
+    """Recompute K_i from scratch with `calc_weight` on every tick"""
+    def __init__(self, lookback):
+        self.lookback = lookback
+
+    def push(self, x, evicted=None):
+        pass
+
+    def extend(self, xs, evicted=None):
+        pass
+
+    def reset(self):
+        pass
+
+    def weight(self, errdata):
+        return calc_weight(errdata)
+
+    def spectrum(self, errdata):
+        return np.fft.fft(errdata)[1: len(errdata) // 2]
+
+
+class SlidingDFTEngine(object):
+    """
+    Compute K_i incrementally.  Once the error history is full, each new
+    sample updates the spectrum in place with a sliding DFT:
+
+        X_j = (X_j - evicted + x) * exp(2 * pi * i * j / lookback)
+
+    `resync_interval` number of slides after which the spectrum is
+        recomputed with a full fft to discard accumulated rounding error.
+        Defaults to `lookback`.
+    """
+    def __init__(self, lookback, resync_interval=None):
+        self.lookback = lookback
+        self.resync_interval = resync_interval or lookback
+        self._twiddle = np.exp(2j * np.pi * np.arange(1, lookback // 2)
+                               / lookback)
+        self._geometry = {}
+        self._sp = None
+        self._nslides = 0
+        self._peak = 0.  # the largest error slid in or out since the fft
+
+    def push(self, x, evicted=None):
+        if evicted is None or self._sp is None:
+            self._sp = None  # the window is still growing
+            return
+        self._peak = max(self._peak, abs(x), abs(evicted))
+        self._sp -= evicted
+        self._sp += x
+        self._sp *= self._twiddle
+        self._nslides += 1
+
+    def extend(self, xs, evicted=None):
+        """Slide the spectrum by k samples at once:
+
+            X_j = X_j * w_j**k + sum_i (xs[i] - evicted[i]) * w_j**(k - i)
+            where w_j = exp(2 * pi * i * j / lookback)
+
+        This costs O(lookback * k), so large batches just invalidate the
+        spectrum and let `weight` recompute it with an fft.
+        """
+        k = len(xs)
+        if evicted is None or self._sp is None \
+                or k * 8 > self.lookback:
+            self._sp = None
+            return
+        self._peak = max(
+            self._peak, np.abs(xs).max(initial=0.),
+            np.abs(evicted).max(initial=0.))
+        powers = np.arange(k, 0, -1)
+        bins = np.arange(1, self.lookback // 2)
+        w = np.exp(2j * np.pi * np.outer(bins, powers) / self.lookback)
+        self._sp *= w[:, 0]
+        self._sp += w.dot(np.asarray(xs) - evicted)
+        self._nslides += k
+
+    def reset(self):
+        """Forget the spectrum, ie because the error history was replaced.
+        The next call to `weight` recomputes it with an fft"""
+        self._sp = None
+
+    def spectrum(self, errdata):
+        """The sliding spectrum, or an fft of `errdata` if there is none"""
+        if self._sp is not None and self._nslides < self.resync_interval:
+            return self._sp
+        sp = np.fft.fft(errdata)[1: len(errdata) // 2]
+        self._peak = 0.
+        if len(errdata) == self.lookback:
+            self._sp = sp
+            self._nslides = 0
+        return sp
+
+    def weight(self, errdata):
+        n = len(errdata)
+        sp = self.spectrum(errdata)
+        # the rounding error of a sliding DFT grows with the errors that
+        # slid through it, not only with the errors in the window
+        scale = max(np.abs(errdata).sum(), n * self._peak)
+        if is_flat(sp, scale):  # there is no variation in the signal
+            log.warn('no variation in the signal.  fft cannot continue')
+            return 1
+        if n not in self._geometry:
+            self._geometry = {n: spectrum_geometry(n)}
+        return float(weight_from_spectrum(
+            sp, *self._geometry[n], scale=scale))
+
+
+ENGINES = {
+    'sliding_dft': SlidingDFTEngine,
+    'fft': FFTEngine,
+}
+DEFAULT_ENGINE = DEFAULT_TUNING_ENGINE
+
+
+def get_engine(name, lookback):
+    """Instantiate the tuning engine registered as `name`"""
+    return ENGINES[name](lookback)
@@ -1,5 +1,6 @@
 import importlib
 import logging
+import time
 log = logging.getLogger('relay.util')
 
 
@@ -13,7 +14,27 @@ class InvalidImportPath(Exception):
     pass
 
 
-def load_obj_from_path(import_path, prefix=None, ld=dict()):
+# import paths that load_obj_from_path already resolved.  Every plugin
+# option (and every loop of a fleet) that names the same plugin gets it from
+# here instead of searching for it again
+_plugin_cache = {}
+
+
+def _import_if_exists(path):
+    """Import and return the module at `path`, or None if there is no such
+    module.  Errors raised while importing a module that exists propagate"""
+    try:
+        return importlib.import_module(path)
+    except ImportError as err:
+        # python 2 doesn't say which module is missing
+        missing = getattr(err, 'name', None)
+        if missing is None or path == missing \
+                or path.startswith(missing + '.'):
+            return None
+        raise
+
+
+def load_obj_from_path(import_path, prefix=None, ld=None):
     """
     import a python object from an import path
 
@@ -26,45 +47,43 @@ def load_obj_from_path(import_path, prefix=None, ld=dict()):
             load_obj_from_path('module.func', prefix='mypackage')
         is the same as
             load_obj_from_path('mypackage.module.func')
+        If nothing exists at the prefixed path, the path is tried as given.
     `ld` (dict) key:value data to pass to the logger if an error occurs
     """
+    key = (import_path, prefix)
+    if key in _plugin_cache:
+        return _plugin_cache[key]
+    ld = ld or {}
+    paths = [import_path]
     if prefix and not import_path.startswith(prefix):
-        import_path = '.'.join([prefix, import_path])
+        paths.insert(0, '.'.join([prefix, import_path]))
 
     log.debug(
         'attempting to load a python object from an import path',
-        extra=dict(import_path=import_path, **ld))
-    try:
-        mod = importlib.import_module(import_path)
-        return mod  # yay, we found a module.  return it
-    except:
-        pass  # try to extract an object from a module
-    try:
-        path, obj_name = import_path.rsplit('.', 1)
-    except ValueError:
-        log_raise(
-            ("import path needs at least 1 period in your import path."
-             " An example import path is something like: module.obj"),
-            dict(import_path=import_path, **ld), InvalidImportPath)
-    try:
-        mod = importlib.import_module(path)
-    except ImportError:
-        newpath = path.replace(prefix, '', 1).lstrip('.')
-        log.debug(
-            "Could not load import path.  Trying a different one",
-            extra=dict(oldpath=path, newpath=newpath))
-        path = newpath
-        mod = importlib.import_module(path)
-    try:
-        obj = getattr(mod, obj_name)
-    except AttributeError:
+        extra=dict(import_path=paths[0], **ld))
+    missing_obj = None
+    for path in paths:
+        obj = _import_if_exists(path)  # yay, we found a module
+        if obj is None and '.' in path:
+            modpath, obj_name = path.rsplit('.', 1)
+            mod = _import_if_exists(modpath)
+            obj = getattr(mod, obj_name, None)
+            if mod is not None and obj is None:
+                missing_obj = dict(import_path=modpath, obj_name=obj_name)
+        if obj is not None:
+            _plugin_cache[key] = obj
+            STARTUP.mark('load_%s' % import_path)
+            return obj
+    if missing_obj:
         log_raise(
             ("object does not exist in given module."
              " Your import path is not"
              " properly defined because the given `obj_name` does not exist"),
-            dict(import_path=path, obj_name=obj_name, **ld),
-            InvalidImportPath)
-    return obj
+            dict(missing_obj, **ld), InvalidImportPath)
+    log_raise(
+        ("Could not find a module at the given import path."
+         " An example import path is something like: module.obj"),
+        dict(import_path=import_path, **ld), InvalidImportPath)
 
 
 def coroutine(func):
@@ -73,3 +92,52 @@ def coroutine(func):
         next(g)
         return g
     return f
+
+
+# a clock that never goes backwards, for scheduling
+monotonic = getattr(time, 'monotonic', time.time)
+perf_counter = getattr(time, 'perf_counter', time.time)
+
+
+class StartupProfile(object):
+    """
+    Record how long each phase of startup takes, from the import of Relay
+    to its first tick.  See `relay --profile_startup`
+
+    `clock` returns the current time in seconds
+    """
+    def __init__(self, clock=perf_counter):
+        self.clock = clock
+        self.started = self._last = clock()
+        self.phases = []  # (phase, seconds), in order
+        self.done = False
+
+    def mark(self, phase):
+        """Record that `phase` ended now.  It began when the previous one
+        ended"""
+        if self.done:
+            return
+        now = self.clock()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def report(self):
+        """Stop recording and return the seconds each phase took, as a dict
+        that can be logged"""
+        self.done = True
+        rv = dict(('%s_seconds' % k, v) for k, v in self.phases)
+        rv['total_seconds'] = self._last - self.started
+        return rv
+
+
+# timed from the import of this module, which Relay imports first
+STARTUP = StartupProfile()
+
+
+def is_async_plugin(obj):
+    """Return True if the plugin is an async generator function or a
+    coroutine function, ie it's meant to run with `relay --asyncio`"""
+    import inspect  # slow to import, and only needed at startup
+    return (
+        getattr(inspect, 'isasyncgenfunction', lambda x: False)(obj)
+        or getattr(inspect, 'iscoroutinefunction', lambda x: False)(obj))
@@ -0,0 +1,105 @@
+import threading
+
+import pytest
+
+from relay.actuators import ActuationShaper, Actuator, ActuatorExecutor
+
+
+class Clock(object):
+    t = 0.
+
+    def __call__(self):
+        return self.t
+
+
+def test_the_shaper_releases_every_MV_by_default():
+    shaper = ActuationShaper()
+    shaper.add(3)
+    assert shaper.release() == 3
+    assert shaper.pending == 0
+
+
+def test_the_shaper_sums_MVs_over_its_window():
+    clock = Clock()
+    shaper = ActuationShaper(window=2, clock=clock)
+    shaper.add(3)
+    assert shaper.release() == 0
+    clock.t = 1
+    shaper.add(2)
+    assert shaper.release() == 0
+    assert shaper.pending == 5
+    clock.t = 2
+    assert shaper.release() == 5
+
+
+def test_the_shaper_spaces_out_calls_and_caps_their_size():
+    clock = Clock()
+    shaper = ActuationShaper(min_interval=1, max_step=2, clock=clock)
+    shaper.add(5)
+    assert shaper.release() == 2
+    assert shaper.release() == 0
+    clock.t = 1
+    assert shaper.release() == 2
+    clock.t = 2
+    assert shaper.release() == 1
+
+
+def test_the_shaper_discards_MVs_in_the_deadband():
+    shaper = ActuationShaper(deadband=2)
+    shaper.add(1)
+    assert shaper.release() == 0
+    assert shaper.pending == 0
+    assert shaper.stats()['shaper_deadband_skips'] == 1
+
+
+def _blocked_executor(policy='merge'):
+    """An executor whose calls wait until `release` is set"""
+    release = threading.Event()
+    started = threading.Event()
+    applied = []
+
+    def func(MV):
+        started.set()
+        release.wait()
+        applied.append(MV)
+    executor = ActuatorExecutor(func, 'warmer', 1, policy)
+    return executor, started, release, applied
+
+
+def test_pending_includes_the_MV_in_flight():
+    executor, started, release, applied = _blocked_executor()
+    executor.submit(3)
+    started.wait(1)
+    assert executor.stats()['warmer_inflight'] == 1
+    assert executor.pending == 3
+    executor.submit(2)
+    assert executor.pending == 5
+    release.set()
+    executor.shutdown()
+    assert applied == [3, 2]
+    assert executor.pending == 0
+
+
+@pytest.mark.parametrize('policy, expected', [
+    ('merge', [1, 5]), ('drop', [1])])
+def test_backpressure_policies(policy, expected):
+    executor, started, release, applied = _blocked_executor(policy)
+    executor.submit(1)
+    started.wait(1)
+    executor.submit(2)
+    executor.submit(3)
+    release.set()
+    executor.shutdown()
+    assert applied == expected
+
+
+def test_the_actuator_sends_MVs_by_sign():
+    warmed, cooled = [], []
+    actuate = Actuator(warmed.append, cooled.append)
+    actuate(2)
+    actuate(-3)
+    actuate(0)
+    actuate.shutdown()
+    assert warmed == [2]
+    assert cooled == [-3]
+    assert actuate.pending == 0
@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+
+from relay import aio
+
+
+def _blocked_executor(policy='merge'):
+    """An executor whose calls wait until `release` is set, and the list of
+    MVs it applied"""
+    release = asyncio.Event()
+    applied = []
+
+    async def func(MV):
+        await release.wait()
+        applied.append(MV)
+    return aio.ActuatorExecutor(func, 'warmer', 1, policy), release, applied
+
+
+def test_pending_includes_the_MV_in_flight():
+    async def go():
+        executor, release, applied = _blocked_executor()
+        await executor.submit(3)
+        await asyncio.sleep(0)
+        assert executor.stats()['warmer_inflight'] == 1
+        await executor.submit(2)
+        assert executor.pending == 5
+        release.set()
+        await executor.shutdown()
+        return applied, executor.pending
+    assert asyncio.run(go()) == ([3, 2], 0)
+
+
+@pytest.mark.parametrize('policy, expected', [
+    ('merge', [1, 5]), ('drop', [1])])
+def test_backpressure_policies(policy, expected):
+    async def go():
+        executor, release, applied = _blocked_executor(policy)
+        for MV in (1, 2, 3):
+            await executor.submit(MV)
+            await asyncio.sleep(0)
+        release.set()
+        await executor.shutdown()
+        return applied
+    assert asyncio.run(go()) == expected
+
+
+def test_block_waits_for_a_free_worker():
+    async def go():
+        executor, release, applied = _blocked_executor('block')
+        await executor.submit(1)
+        await asyncio.sleep(0)
+        blocked = asyncio.ensure_future(executor.submit(2))
+        await asyncio.sleep(.01)
+        assert not blocked.done()
+        release.set()
+        await blocked
+        await executor.shutdown()
+        return applied
+    assert asyncio.run(go()) == [1, 2]
+
+
+def test_the_actuator_accepts_sync_and_async_plugins():
+    warmed, cooled = [], []
+
+    async def cooler(MV):
+        cooled.append(MV)
+
+    async def go():
+        actuate = aio.Actuator(warmed.append, cooler)
+        await actuate(2)
+        await actuate(-3)
+        await actuate(0)
+        await actuate.shutdown()
+    asyncio.run(go())
+    assert warmed == [2]
+    assert cooled == [-3]
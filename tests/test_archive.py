@@ -0,0 +1,62 @@
+import os
+
+import numpy as np
+
+from relay import archive
+
+
+def _write(path, ts, capacity=4, loop=None):
+    writer = archive.ArchiveWriter(path, loop, capacity)
+    for t in ts:
+        writer.append(t, t, 10, 10 - t, 1)
+    writer.close()
+
+
+def test_query_spans_segments(tmpdir):
+    _write(str(tmpdir), range(10))
+    a = archive.Archive(str(tmpdir))
+    assert len(a.segments()) == 3
+    data = a.query(start=2, end=8)
+    assert data['ts'].tolist() == list(range(2, 9))
+    assert data['err'].tolist() == [10 - t for t in range(2, 9)]
+    assert np.isnan(data['weight']).all()
+
+
+def test_the_writer_appends_to_the_last_segment(tmpdir):
+    _write(str(tmpdir), range(2))
+    _write(str(tmpdir), range(2, 6))
+    a = archive.Archive(str(tmpdir))
+    assert len(a.segments()) == 2
+    assert a.query()['ts'].tolist() == list(range(6))
+
+
+def test_loops_have_their_own_records(tmpdir):
+    _write(str(tmpdir), range(3), loop='a')
+    _write(str(tmpdir), range(5), loop='b')
+    a = archive.Archive(str(tmpdir))
+    assert a.loops() == ['a', 'b']
+    assert len(a.query('a')['ts']) == 3
+
+
+def test_truncated_segments_are_skipped(tmpdir):
+    _write(str(tmpdir), range(10))
+    a = archive.Archive(str(tmpdir))
+    path = a.segments()[-1][1]
+    with open(path, 'r+b') as fp:
+        fp.truncate(os.path.getsize(path) - 3)
+    assert a.query()['ts'].tolist() == list(range(8))
+    open(path, 'w').close()  # empty
+    assert a.query()['ts'].tolist() == list(range(8))
+    _write(str(tmpdir), [20])
+    assert a.query()['ts'].tolist() == list(range(8)) + [20]
+
+
+def test_a_corrupt_count_is_clamped_to_the_capacity(tmpdir):
+    _write(str(tmpdir), range(3))
+    path = archive.Archive(str(tmpdir)).segments()[0][1]
+    with open(path, 'r+b') as fp:
+        fp.seek(archive.COUNT_OFFSET)
+        fp.write(np.array([100], dtype='<i8').tobytes())
+    segment = archive.Segment(path)
+    assert segment.count == 4
+    assert segment.full
@@ -0,0 +1,60 @@
+import subprocess
+import sys
+
+import pytest
+
+from relay import actuators
+from relay import argparse_shared as at
+from relay import controllers
+from relay import coordination
+from relay import loop
+from relay import sampling
+from relay import tuning
+from relay.plugins import cache
+from relay.plugins import shell
+
+
+def test_choices_match_the_modules_that_use_them():
+    assert at.BACKPRESSURE_POLICIES == actuators.POLICIES
+    assert at.CONTROLLERS == tuple(sorted(controllers.CONTROLLERS))
+    assert at.DEFAULT_CONTROLLER == controllers.DEFAULT_CONTROLLER
+    assert at.COORDINATION_MODES == coordination.MODES
+    assert at.RAMP_SHAPES == loop.RAMP_SHAPES
+    assert at.RESAMPLE_METHODS == sampling.METHODS
+    assert at.TUNING_ENGINES == tuple(sorted(tuning.ENGINES))
+    assert at.DEFAULT_TUNING_ENGINE == tuning.DEFAULT_ENGINE
+    assert at.METRIC_CACHE_SCOPES == cache.SCOPES
+    assert at.DEFAULT_METRIC_CACHE_SCOPE == cache.DEFAULT_SCOPE
+    assert at.SHELL_PREFIX == shell.PREFIX
+    assert at.DEFAULT_SHELL_TIMEOUT == shell.DEFAULT_TIMEOUT
+
+
+def _imports_numpy(code):
+    code = 'import sys\n%s\nprint("numpy" in sys.modules)\n' % code
+    out = subprocess.check_output([sys.executable, '-c', code])
+    return out.strip() == b'True'
+
+
+def test_building_the_parser_does_not_import_numpy():
+    assert not _imports_numpy(
+        'from relay import argparse_shared as at\n'
+        'at.build_arg_parser([at.group("", at.controller, at.resample)])')
+
+
+@pytest.mark.parametrize('command, argv', [
+    ('relay', ['--target', '5']),
+    ('fleet', ['--config', 'fleet.json']),
+    ('simulate', ['--lookback', '10,100']),
+])
+def test_parsing_a_command_line_does_not_import_numpy(command, argv):
+    assert not _imports_numpy(
+        'import relay.__main__\n'
+        'from relay import parsers\n'
+        'parsers.build_%s_arg_parser().parse_args(%r)' % (command, argv))
+
+
+def test_the_commands_expose_their_parser():
+    from relay import fleet, parsers, runner, simulate
+    assert runner.build_arg_parser is parsers.build_relay_arg_parser
+    assert fleet.build_arg_parser is parsers.build_fleet_arg_parser
+    assert simulate.build_arg_parser is parsers.build_simulate_arg_parser
@@ -0,0 +1,16 @@
+import json
+import os
+import subprocess
+import sys
+
+BENCHMARK = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'bin', 'benchmark.py')
+
+
+def test_every_benchmark_runs():
+    out = subprocess.check_output([
+        sys.executable, BENCHMARK, '--sizes', '10', '--seconds', '0.01'])
+    names = set(r['name'] for r in json.loads(out.decode('utf8'))['results'])
+    assert 'stop_condition' in names
+    assert 'stop_condition_legacy' in names
@@ -0,0 +1,69 @@
+import os
+import signal
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from relay import checkpoint
+from relay.loop import ControlLoop
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+
+
+def metric():
+    x = 0
+    while True:
+        x += 1
+        yield x % 7
+
+
+def warmer(MV):
+    pass
+
+
+def _loop(n=10, PVs=()):
+    loop = ControlLoop(n, ramp=0)
+    for PV in PVs:
+        loop.update(5, PV)
+    return loop
+
+
+def test_a_checkpoint_restores_the_error_history(tmpdir):
+    path = str(tmpdir.join('ckp'))
+    loop = _loop(PVs=range(15))
+    checkpoint.save(path, loop)
+    restored = _loop()
+    assert checkpoint.load(path, restored)
+    assert np.array_equal(restored.history.view(), loop.history.view())
+    assert restored.ramp_index == loop.ramp_index
+
+
+def test_a_checkpoint_of_another_lookback_is_ignored(tmpdir):
+    path = str(tmpdir.join('ckp'))
+    checkpoint.save(path, _loop(PVs=range(15)))
+    assert not checkpoint.load(path, _loop(n=20))
+
+
+@pytest.mark.parametrize('argv', [[], ['--asyncio']])
+def test_relay_saves_its_checkpoint_on_sigterm(tmpdir, argv):
+    path = str(tmpdir.join('ckp'))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [TESTS, os.path.dirname(TESTS)]))
+    p = subprocess.Popen([
+        sys.executable, '-m', 'relay', '--metric', 'test_checkpoint.metric',
+        '--warmer', 'test_checkpoint.warmer', '--target', '5',
+        '--lookback', '10', '--delay', '0.01', '--checkpoint', path] + argv,
+        env=env, stderr=subprocess.PIPE)
+    try:
+        for line in iter(p.stderr.readline, b''):
+            if b'got metric value' in line:
+                break
+        p.send_signal(signal.SIGTERM)
+        p.communicate()
+    finally:
+        if p.poll() is None:
+            p.kill()
+    assert p.returncode == 128 + signal.SIGTERM
+    assert checkpoint.load(path, _loop())
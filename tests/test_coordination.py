@@ -0,0 +1,76 @@
+import time
+
+import pytest
+
+from relay import coordination
+from relay import runner
+from relay.actuators import ActuationShaper
+
+
+class Clock(object):
+    t = 0.
+
+    def __call__(self):
+        return self.t
+
+
+clock = Clock()
+
+
+@pytest.fixture
+def coordinators(request):
+    addresses = ['inproc://relay-test-%s-%s' % (request.node.name, i)
+                 for i in range(2)]
+    clock.t = 0.
+    rv = [coordination.Coordinator(
+        'split', address, addresses, timeout=1, clock=clock)
+        for address in addresses]
+    yield rv
+    for c in rv:
+        c.close()
+
+
+def _exchange(coordinators, MVs, errs):
+    """Publish a heartbeat from each coordinator, then return each one's
+    share of its MV"""
+    for c, MV, err in zip(coordinators, MVs, errs):
+        c.heartbeat(MV, err)
+    time.sleep(.05)
+    return [c.share(MV, err) for c, MV, err in zip(coordinators, MVs, errs)]
+
+
+def test_split_shares_add_up_to_the_MV(coordinators):
+    clock.t = 2.
+    assert _exchange(coordinators, [5, 5], [1, 1]) == [3, 2]
+    assert _exchange(coordinators, [-5, -5], [1, 1]) == [-3, -2]
+
+
+def test_stats_describe_the_peers_heartbeats(coordinators):
+    clock.t = 2.
+    _exchange(coordinators, [4, 6], [1., 3.])
+    stats = coordinators[0].stats()
+    assert stats['peers_alive'] == 1
+    assert stats['is_leader']
+    assert stats['peers_MV'] == 6
+    assert stats['peers_err'] == 3.
+
+
+def test_peers_that_stop_sending_heartbeats_are_dead(coordinators):
+    clock.t = 2.
+    _exchange(coordinators, [1, 1], [0, 0])
+    clock.t = 4.
+    assert coordinators[1].share(5) == 5
+    assert coordinators[1].stats()['peers_MV'] is None
+
+
+def test_release_keeps_the_MV_pending_while_discovering(coordinators):
+    shaper = ActuationShaper()
+    shaper.add(5)
+    assert runner.release(shaper, coordinators[0], err=1) == 0
+    assert shaper.pending == 5
+    time.sleep(.05)
+    coordinators[1].heartbeat()
+    assert coordinators[1].stats()['peers_MV'] is None
+    clock.t = 2.
+    assert runner.release(shaper, coordinators[0], err=1) == 3
+    assert shaper.pending == 0
@@ -0,0 +1,134 @@
+import io
+import json
+
+import numpy as np
+import pytest
+
+from relay import fleet
+from relay import tuning
+
+applied = []
+
+
+def metric():
+    x = 0
+    while True:
+        x += 1
+        yield x % 7
+
+
+def warmer(MV):
+    applied.append(MV)
+
+
+async def async_metric():
+    yield 1
+
+
+def stop_after_3(errdata):
+    return 0 if len(errdata) >= 3 else -1
+
+
+def _config(defaults=None, **loop):
+    loop = dict(dict(
+        metric='test_fleet.metric', target=5, warmer='test_fleet.warmer',
+        ramp=0), **loop)
+    loop = dict((k, v) for k, v in loop.items() if v is not None)
+    return io.StringIO(json.dumps(dict(
+        defaults=defaults or {}, loops=[dict(loop, name='a'), loop])))
+
+
+def test_load_config_applies_defaults():
+    members = fleet.load_config(_config(defaults=dict(lookback=7)))
+    assert [m.name for m in members] == ['a', '1']
+    assert [m.ns.lookback for m in members] == [7, 7]
+
+
+def test_load_config_rejects_a_loop_without_a_warmer_or_cooler():
+    with pytest.raises(fleet.InvalidFleetConfig):
+        fleet.load_config(_config(warmer=None))
+
+
+def test_load_config_rejects_unsupported_options():
+    with pytest.raises(fleet.InvalidFleetConfig) as err:
+        fleet.load_config(_config(tuning_engine='fft'))
+    assert 'tuning_engine' in str(err.value)
+
+
+@pytest.mark.parametrize('var, value', [
+    ('RELAY_TUNING_ENGINE', 'fft'),
+    ('RELAY_GAIN_SCHEDULE', 'schedule.json'),
+])
+def test_load_config_rejects_unsupported_options_from_env(
+        monkeypatch, var, value):
+    monkeypatch.setenv(var, value)
+    with pytest.raises(fleet.InvalidFleetConfig) as err:
+        fleet.load_config(_config())
+    assert var[len('RELAY_'):].lower() in str(err.value)
+
+
+def test_load_config_ignores_env_of_the_fleet_command(monkeypatch):
+    monkeypatch.setenv('RELAY_LOG_DEBUG_EVERY', '10')
+    assert len(fleet.load_config(_config())) == 2
+
+
+def test_load_config_rejects_async_plugins():
+    with pytest.raises(fleet.InvalidFleetConfig) as err:
+        fleet.load_config(_config(metric='test_fleet.async_metric'))
+    assert 'async' in str(err.value)
+
+
+def test_compute_weights_matches_calc_weight():
+    members = fleet.load_config(_config(lookback=20))
+    for i in range(30):
+        fleet.tick(members)
+    weights = fleet.compute_weights(members)
+    for m in members:
+        assert abs(
+            weights[m] - tuning.calc_weight(m.loop.history.view())) < 1e-9
+
+
+def test_members_stop_on_their_stop_condition():
+    members = fleet.load_config(_config(
+        stop_condition='test_fleet.stop_after_3'))
+    ticks = []
+
+    def sleep(seconds):
+        clock.t += seconds
+
+    def clock():
+        return clock.t
+    clock.t = 0.
+
+    def tick(due, telemetry=None):
+        ticks.append(len(due))
+        return _tick(due, telemetry)
+    _tick, fleet.tick = fleet.tick, tick
+    try:
+        fleet.run(members, clock=clock, sleep=sleep)
+    finally:
+        fleet.tick = _tick
+    assert ticks == [2, 2, 2]
+    assert np.all([len(m.loop.history) == 3 for m in members])
+
+
+def test_members_save_their_own_checkpoint(tmpdir):
+    path = str(tmpdir.join('ckp'))
+    members = fleet.load_config(_config(
+        defaults=dict(checkpoint=path, lookback=5),
+        stop_condition='test_fleet.stop_after_3'))
+    for i in range(3):
+        fleet.tick(members)
+    assert sorted(f.basename for f in tmpdir.listdir()) == [
+        'ckp.1', 'ckp.a']
+    restored = fleet.load_config(_config(
+        defaults=dict(checkpoint=path, lookback=5)))
+    assert [m.checkpoint.restored for m in restored] == [True, True]
+    assert [len(m.loop.history) for m in restored] == [3, 3]
+
+
+def test_batched_members_log_their_controller_seconds():
+    members = fleet.load_config(_config(lookback=20))
+    for i in range(30):
+        fleet.tick(members)
+    assert all(m.loop.controller_seconds > 0 for m in members)
@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+from relay import runner
+from relay.gain_scheduling import GainScheduledLoop, InvalidGainSchedule
+
+
+def _schedule(tmpdir, regions, **schedule):
+    path = tmpdir.join('schedule.json')
+    path.write(json.dumps(dict(schedule, regions=regions)))
+    ns = runner.build_arg_parser().parse_args([
+        '--gain_schedule', str(path), '--lookback', '10', '--ramp', '0'])
+    return GainScheduledLoop.from_ns(ns)
+
+
+@pytest.mark.parametrize('option', [
+    'tuning_engine', 'controller', 'ramp_shape'])
+def test_unrecognized_region_choices_name_the_region(tmpdir, option):
+    with pytest.raises(InvalidGainSchedule) as err:
+        _schedule(tmpdir, [{'below': 10}, {option: 'nope'}])
+    assert 'Region 1' in str(err.value)
+    assert option in str(err.value)
+
+
+def test_unrecognized_region_options_are_rejected(tmpdir):
+    with pytest.raises(InvalidGainSchedule):
+        _schedule(tmpdir, [{'lookbak': 10}])
+
+
+def test_the_PV_selects_the_region(tmpdir):
+    loop = _schedule(tmpdir, [
+        {'below': 10, 'gain': 1, 'weight': 1},
+        {'gain': 10, 'weight': 1}])
+    loop.update(0, 5)
+    assert loop.index == 0
+    loop.update(0, 50)
+    assert loop.index == 1
+    assert len(loop.regions[0].loop.history) == 1
+    assert len(loop.regions[1].loop.history) == 1
+    assert loop.errors.view().tolist() == [-5, -50]
+
+
+def test_hysteresis_keeps_the_active_region(tmpdir):
+    loop = _schedule(tmpdir, [
+        {'below': 10, 'weight': 1}, {'weight': 1}], hysteresis=5)
+    loop.update(0, 5)
+    loop.update(0, 12)
+    assert loop.index == 0
+    loop.update(0, 15)
+    assert loop.index == 1
+    loop.update(0, 8)
+    assert loop.index == 1
+    loop.update(0, 4)
+    assert loop.index == 0
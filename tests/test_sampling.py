@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from relay import sampling
+from relay.loop import ControlLoop
+
+
+@pytest.mark.parametrize('sample, values', [
+    (3, [3]),
+    ([1, 2, 3], [1, 2, 3]),
+    (np.array([1., 2.]), [1, 2]),
+    ([], []),
+])
+def test_normalize_batches_without_timestamps(sample, values):
+    timestamps, arr = sampling.normalize(sample)
+    assert timestamps is None
+    assert arr.tolist() == values
+
+
+def test_normalize_timestamped_pairs():
+    timestamps, values = sampling.normalize([(10, 1), (11, 2)])
+    assert timestamps.tolist() == [10, 11]
+    assert values.tolist() == [1, 2]
+
+
+def test_normalize_rejects_other_shapes():
+    with pytest.raises(ValueError):
+        sampling.normalize(np.zeros((2, 3)))
+
+
+def test_a_batch_records_every_sample():
+    loop = ControlLoop(10, ramp=0)
+    assert loop.push(5, [1, 2, 3])
+    assert loop.history.view().tolist() == [4, 3, 2]
+    assert (loop.SP, loop.PV, loop.err) == (5, 3, 2)
+
+
+def test_a_batch_of_set_points_matches_the_metric():
+    loop = ControlLoop(10, ramp=0)
+    loop.push([5, 6], [1, 2])
+    assert loop.history.view().tolist() == [4, 4]
+
+
+def test_an_empty_batch_records_nothing():
+    loop = ControlLoop(10, ramp=0)
+    loop.push(5, 1)
+    assert not loop.push(5, [])
+    assert loop.update(5, []) == 0
+    assert len(loop.history) == 1
+
+
+def test_resampling_is_continuous_across_batches():
+    r = sampling.Resampler(1.)
+    assert r(np.array([0., 1.5]), np.array([0., 3.])).tolist() == [0, 2]
+    assert r(np.array([3.]), np.array([6.])).tolist() == [4, 6]
+    assert r.grid_times(2).tolist() == [2, 3]
+
+
+def test_zero_order_hold_keeps_the_previous_sample():
+    r = sampling.Resampler(1., 'zoh')
+    assert r(np.array([1.5, 0.]), np.array([3., 0.])).tolist() == [0, 0]
+    assert r(np.array([3.]), np.array([6.])).tolist() == [3, 6]
+
+
+def test_resampler_rejects_bad_arguments():
+    with pytest.raises(ValueError):
+        sampling.Resampler(0)
+    with pytest.raises(ValueError):
+        sampling.Resampler(1, 'cubic')
+
+
+def test_irregular_ticks_are_resampled_onto_a_grid():
+    clock = iter([0., .5, 2.5, 3.]).__next__
+    loop = ControlLoop(
+        10, ramp=0, sample_period=1., resample='linear', clock=clock)
+    for PV in [0, 1, 5, 6]:
+        loop.push(10, PV)
+    assert loop.history.view().tolist() == [10, 8, 6, 4]
+    assert loop.history.times().tolist() == [0, 1, 2, 3]
+    assert len(loop.ticks) == 4
@@ -0,0 +1,65 @@
+import argparse
+import json
+import logging
+
+import numpy as np
+
+from relay import log
+from relay import simulate
+from relay.actuators import Actuator
+from relay.loop import ControlLoop
+from relay.relay_logging import JSONFormatter
+
+
+def _record_relay_log(path, PVs, SP=10):
+    """Run a control loop over `PVs` and write its log messages to `path`,
+    one json message per line as --sendstats publishes them"""
+    with open(path, 'w') as fp:
+        handler = logging.StreamHandler(fp)
+        handler.setFormatter(JSONFormatter())
+        log.addHandler(handler)
+        level = log.level
+        log.setLevel(logging.DEBUG)
+        try:
+            loop = ControlLoop(5, ramp=0)
+            actuate = Actuator(lambda MV: None, lambda MV: None)
+            for PV in PVs:
+                MV = loop.update(SP, PV)
+                actuate(MV, err=loop.err, PV=PV, SP=SP)
+            actuate.shutdown()
+        finally:
+            log.removeHandler(handler)
+            log.setLevel(level)
+    with open(path) as fp:
+        return [json.loads(line) for line in fp]
+
+
+def test_load_trace_replays_each_tick_of_a_relay_log_once(tmpdir):
+    path = str(tmpdir.join('relay.log'))
+    PVs = [1, 2, 3, 5, 8, 13]
+    records = _record_relay_log(path, PVs)
+    # other messages of a tick repeat its SP and PV
+    assert len([r for r in records if 'PV' in r]) > len(PVs)
+    SP, PV = simulate.load_trace(path)
+    assert PV.tolist() == PVs
+    assert SP.tolist() == [10] * len(PVs)
+
+
+def test_load_trace_reads_csv(tmpdir):
+    path = tmpdir.join('trace.csv')
+    path.write('SP,PV\n10,1\n10,2\n')
+    SP, PV = simulate.load_trace(str(path))
+    assert SP.tolist() == [10, 10]
+    assert PV.tolist() == [1, 2]
+
+
+def test_simulate_a_first_order_plant_reaches_the_target():
+    ns = argparse.Namespace(
+        target=lambda: iter(lambda: 20, None), ticks=2000, lookback=50,
+        ramp=1, delay=1, min_delay=None, max_delay=None, sample_period=None,
+        resample=None, ramp_shape='linear', tuning_engine='sliding_dft',
+        controller='fft_pi', actuation_window=0, min_actuation_interval=0,
+        max_step=None, deadband=0)
+    plant = simulate.FirstOrderPlant(tau=5, gain=1, initial=0)
+    result = simulate.simulate(ns, plant=plant)
+    assert abs(np.mean(result['PV'][-100:]) - 20) < 2
@@ -0,0 +1,46 @@
+import numpy as np
+
+from relay import stop_conditions
+from relay.loop import ControlLoop
+
+
+class only_update(object):
+    """A stop condition with an update method and no extend method"""
+    def __init__(self, lookback):
+        self.errs = []
+
+    def update(self, err):
+        self.errs.append(err)
+        return 3 if len(self.errs) >= 5 else -1
+
+
+def test_update_only_condition_gets_a_batch():
+    loop = ControlLoop(10, ramp=0)
+    stop = stop_conditions.build(only_update, loop, 10)
+    loop.push(10, np.array([1, 2, 3]))
+    assert stop.check() is None
+    assert stop.condition.errs == [9, 8, 7]
+    loop.push(10, np.array([4, 5]))
+    assert stop.check() == 3
+
+
+def test_update_only_condition_when_a_tick_records_nothing():
+    t = [0]
+    loop = ControlLoop(
+        10, ramp=0, sample_period=1, resample='zoh', clock=lambda: t[0])
+    stop = stop_conditions.build(only_update, loop, 10)
+    for i in range(20):
+        t[0] = i * .25  # 4 ticks per grid period
+        loop.push(10, 1)
+        assert stop.check() in (None, 3)
+    assert len(stop.condition.errs) == loop.history.total
+
+
+def test_update_only_condition_with_empty_batches():
+    loop = ControlLoop(10, ramp=0)
+    stop = stop_conditions.build(only_update, loop, 10)
+    loop.push(10, np.array([1]))
+    stop.check()
+    loop.push(10, np.array([]))
+    assert stop.check() is None
+    assert stop.condition.errs == [9]
@@ -0,0 +1,68 @@
+import numpy as np
+
+from relay import tuning
+from relay.history import ErrorHistory
+
+
+def _slide(engine, xs, n):
+    """Push `xs` through an error history of `n` samples, computing the
+    weight on every tick like the control loop does"""
+    history = ErrorHistory(n)
+    for x in xs:
+        engine.push(x, history.append(x))
+        weight = engine.weight(history.view())
+    return weight, history.view()
+
+
+def test_sliding_dft_matches_calc_weight():
+    n = 200
+    xs = np.random.RandomState(0).randn(3 * n)
+    weight, errdata = _slide(tuning.SlidingDFTEngine(n), xs, n)
+    assert abs(weight - tuning.calc_weight(errdata)) < 1e-9
+
+
+def test_constant_error_history_has_no_variation():
+    n = 100
+    for c in (0, 5, -3, 1e6):
+        xs = np.concatenate([
+            np.random.RandomState(0).randn(n + n // 3),
+            np.full(n + n // 2, c)])
+        weight, errdata = _slide(tuning.SlidingDFTEngine(n), xs, n)
+        assert weight == tuning.calc_weight(errdata) == 1
+        assert tuning.calc_weight_batch(np.stack([errdata, errdata])) \
+            .tolist() == [1, 1]
+
+
+def test_sliding_dft_extends_by_a_batch():
+    n = 200
+    xs = np.random.RandomState(1).randn(3 * n)
+    engine = tuning.SlidingDFTEngine(n)
+    history = ErrorHistory(n)
+    for i in range(0, len(xs), 10):
+        engine.extend(xs[i:i + 10], history.extend(xs[i:i + 10]))
+        weight = engine.weight(history.view())
+    assert abs(weight - tuning.calc_weight(history.view())) < 1e-9
+
+
+def test_sliding_dft_resyncs_with_an_fft():
+    n = 64
+    xs = 1e6 * np.random.RandomState(2).randn(50 * n)
+    engine = tuning.SlidingDFTEngine(n, resync_interval=n)
+    weight, errdata = _slide(engine, xs, n)
+    assert engine._nslides < n
+    assert np.allclose(
+        engine.spectrum(errdata), np.fft.fft(errdata)[1: n // 2])
+
+
+def test_calc_weight_batch_matches_calc_weight():
+    errmatrix = np.random.RandomState(3).randn(5, 100)
+    errmatrix[2] = 4.  # no variation
+    weights = tuning.calc_weight_batch(errmatrix)
+    assert np.allclose(weights, [tuning.calc_weight(e) for e in errmatrix])
+
+
+def test_engines_compute_the_same_weight():
+    errdata = np.random.RandomState(4).randn(100)
+    weights = [tuning.get_engine(name, 100).weight(errdata)
+               for name in sorted(tuning.ENGINES)]
+    assert np.allclose(weights, tuning.calc_weight(errdata))
@@ -4,8 +4,35 @@ var server = require('http').Server(app);
 var io = require('socket.io')(server);
 var path = require('path');
 var util = require('util');
+var lttb = require('./lttb');
 
-// receive zmq messages
+// frames per second sent to each browser
+var FRAME_RATE = +process.env.RELAY_WEBUI_FRAME_RATE || 10;
+// points of each series kept in memory
+var HISTORY = +process.env.RELAY_WEBUI_HISTORY || 10000;
+// points of each series sent per frame, unless the browser asks for fewer
+// or more with /?points=n
+var DEFAULT_POINTS = 1000;
+var SERIES = ['PV', 'MV', 'SP'];
+
+// the last HISTORY [time in ms, value] points of each series.  Arrays are
+// trimmed once they hold twice as many, so appending is O(1) on average
+var series = {};
+SERIES.forEach(function (k) { series[k] = []; });
+var dirty = false;  // were there new points since the last frame?
+
+// the value of `k` in a log message, or undefined.  A batch of samples
+// (see relay.sampling) is plotted as its latest value
+function value(payload, k) {
+  var v = payload[k];
+  if (Array.isArray(v)) {
+    v = v[v.length - 1];
+  }
+  return typeof v === 'number' ? v : undefined;
+}
+
+// receive zmq messages.  Each one is parsed once, however many browsers
+// are watching
 var zmq = require('zmq');
 var subscriber = zmq.socket('sub');
 if (process.argv[2]) {
@@ -18,24 +45,67 @@ if (process.argv[2]) {
 subscriber.subscribe('');
 console.log('zmq initialized')
 
-// when a client connects via websockets,
-// forward relevant zmq message data to the client
-io.on('connection', function (socket) {
-
-  subscriber.on('message', function () {
-    var payload = JSON.parse(arguments[1].toString());
-    if (payload.PV) {
-      socket.emit('pvdata', {y: payload.PV});
+subscriber.on('message', function (topic, msg) {
+  var payload;
+  try {
+    payload = JSON.parse(msg.toString());
+  } catch (err) {
+    return;
+  }
+  var t = payload.created ? payload.created * 1000 : Date.now();
+  SERIES.forEach(function (k) {
+    var v = value(payload, k);
+    if (v === undefined) {
+      return;
     }
-    if (payload.MV) {
-      socket.emit('mvdata', {y: payload.MV});
+    var s = series[k];
+    s.push([t, v]);
+    if (s.length >= 2 * HISTORY) {
+      s.splice(0, s.length - HISTORY);
     }
-    if (payload.SP) {
-      socket.emit('spdata', {y: payload.SP});
+    dirty = true;
+  });
+});
+
+// a frame holds every series, decimated to `points` points
+function frame(points) {
+  var rv = {};
+  SERIES.forEach(function (k) {
+    var s = series[k];
+    rv[k] = lttb(s.length > HISTORY ? s.slice(s.length - HISTORY) : s, points);
+  });
+  return rv;
+}
+
+// browsers that want the same number of points share a socket.io room, so
+// each frame is decimated and serialized once per room
+var budgets = {};  // points: number of browsers that want that many
+
+io.on('connection', function (socket) {
+  var points = parseInt(socket.handshake.query.points, 10) || DEFAULT_POINTS;
+  points = Math.max(10, Math.min(points, HISTORY));
+  var room = 'points:' + points;
+  socket.join(room);
+  budgets[points] = (budgets[points] || 0) + 1;
+  socket.emit('frame', frame(points));
+
+  socket.on('disconnect', function () {
+    if (--budgets[points] === 0) {
+      delete budgets[points];
     }
   });
 });
 
+setInterval(function () {
+  if (!dirty) {
+    return;
+  }
+  dirty = false;
+  Object.keys(budgets).forEach(function (points) {
+    io.to('points:' + points).emit('frame', frame(+points));
+  });
+}, 1000 / FRAME_RATE);
+
 // configure webserver
 app.engine('.html', require('ejs').__express);
 var port = 8080;
@@ -44,6 +114,6 @@ app.use('/vendor', express.static(path.join(__dirname, '..', '/vendor')));
 app.get('/', function (req, res) {
   res.render(
     path.join(__dirname, 'index.html'),
-    {webserver_url: util.format('http://%s:%s', req.hostname, port)});
+    {webserver_url: util.format('http://%s:%s', req.hostname, port),
+     points: parseInt(req.query.points, 10) || DEFAULT_POINTS});
 });
-
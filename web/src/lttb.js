@@ -0,0 +1,48 @@
+// Largest-Triangle-Three-Buckets: reduce a series of [x, y] points to
+// `threshold` points that keep its visual shape.  The first and last points
+// are kept.  The others are split into threshold - 2 buckets, and from each
+// bucket we keep the point that makes the largest triangle with the point
+// kept from the previous bucket and the average of the next bucket.
+//
+// See Sveinn Steinarsson, "Downsampling Time Series for Visual
+// Representation", 2013.
+function lttb(data, threshold) {
+  var n = data.length;
+  if (threshold >= n || threshold < 3) {
+    return data.slice();
+  }
+  var sampled = [data[0]];
+  var every = (n - 2) / (threshold - 2);
+  var a = 0;  // index of the point kept from the previous bucket
+  for (var i = 0; i < threshold - 2; i++) {
+    // the average point of the next bucket
+    var avgStart = Math.floor((i + 1) * every) + 1;
+    var avgEnd = Math.min(Math.floor((i + 2) * every) + 1, n);
+    var avgX = 0, avgY = 0;
+    for (var j = avgStart; j < avgEnd; j++) {
+      avgX += data[j][0];
+      avgY += data[j][1];
+    }
+    avgX /= avgEnd - avgStart;
+    avgY /= avgEnd - avgStart;
+
+    // the point of this bucket that makes the largest triangle
+    var ax = data[a][0], ay = data[a][1];
+    var maxArea = -1, next = 0;
+    var end = Math.floor((i + 1) * every) + 1;
+    for (j = Math.floor(i * every) + 1; j < end; j++) {
+      var area = Math.abs(
+        (ax - avgX) * (data[j][1] - ay) - (ax - data[j][0]) * (avgY - ay));
+      if (area > maxArea) {
+        maxArea = area;
+        next = j;
+      }
+    }
+    sampled.push(data[next]);
+    a = next;
+  }
+  sampled.push(data[n - 1]);
+  return sampled;
+}
+
+module.exports = lttb;